@@ -0,0 +1,189 @@
+import argparse
+from datetime import date
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from async_db import get_async_engine
+from db_connection import get_engine
+from mapper import COLUMN_MAPPING
+from portfolio_engine import PURCHASE_TYPES, REDEMPTION_TYPES
+from setup import log
+
+# Dimension name -> (column, expression on the holdings side, expression on the transactions side).
+# Holdings take the AMC, scheme type and brokers of their latest transaction (LATEST_TRANSACTION_JOIN).
+DIMENSIONS = {
+    "amc": ("AMC_CODE", 'd."AMC_CODE"', 'w2."AMC_CODE"'),
+    "scheme_type": ("SCHEME_TYP", 'd."SCHEME_TYP"', 'w2."SCHEME_TYP"'),
+    "broker": ("BROKCODE", 'd."BROKCODE"', 'w2."BROKCODE"'),
+    "sub_broker": ("SUBBROK", 'd."SUBBROK"', 'w2."SUBBROK"'),
+    "pan": ("PAN_NO", 'w9."PAN_NO"', 'w9."PAN_NO"'),
+}
+# The latest transaction of each holding, read backwards from ix_cams_wbr2_folio_scheme_trade
+LATEST_TRANSACTION_JOIN = '''
+            LEFT JOIN LATERAL (
+                SELECT "AMC_CODE", "SCHEME_TYP", "BROKCODE", "SUBBROK"
+                FROM "CAMS_WBR2"
+                WHERE "FOLIO_NO" = w9."FOLIOCHK" AND "SCHEME" = w9."SCH_NAME"
+                ORDER BY "TRADDATE" DESC NULLS LAST, "SEQ_NO" DESC NULLS LAST
+                LIMIT 1
+            ) d ON TRUE'''
+MEASURES = ["AUM", "Units", "Folios", "Gross Purchases", "Gross Redemptions", "Net Flows", "Transactions"]
+
+
+def _type_condition(prefixes):
+    return '"TRXNTYPE" LIKE ANY (ARRAY[' + ", ".join(f"'{prefix}%'" for prefix in prefixes) + "])"
+
+
+def aggregate_sql(group_by, rollup=False, pan_no=False, trade_date_from=False, trade_date_to=False,
+                  rep_date_from=False, rep_date_to=False):
+    """
+    Build the aggregation query. The filter arguments only say whether the
+    filter is used; their values are bound as :pan_no, :trade_date_from etc.
+
+    AUM (RUPEE_BAL), units (CLOS_BAL) and folio counts are current balances
+    and ignore the date filters; purchases, redemptions and transaction counts
+    only cover the transactions within them.
+
+    Raises:
+        ValueError: When `group_by` names an unknown dimension.
+    """
+    unknown = [name for name in group_by if name not in DIMENSIONS]
+    if unknown:
+        raise ValueError(f"Unknown dimension(s) {', '.join(unknown)}; expected any of {', '.join(DIMENSIONS)}.")
+    group_by = list(dict.fromkeys(group_by))
+
+    def side(index):
+        selected = [f"{DIMENSIONS[name][index]} AS d{i}" for i, name in enumerate(group_by)]
+        expressions = [DIMENSIONS[name][index] for name in group_by]
+        if not expressions:
+            return "0 AS level", ""
+        if rollup:
+            return ", ".join(selected + [f"GROUPING({', '.join(expressions)}) AS level"]), f"GROUP BY ROLLUP ({', '.join(expressions)})"
+        return ", ".join(selected + ["0 AS level"]), f"GROUP BY {', '.join(expressions)}"
+
+    holdings_columns, holdings_group = side(1)
+    # Only pay for the latest transaction lookup when a WBR2 dimension is grouped on
+    latest_transaction = LATEST_TRANSACTION_JOIN if any(DIMENSIONS[name][1].startswith("d.") for name in group_by) else ""
+    trades_columns, trades_group = side(2)
+    trade_filters = ["TRUE"]
+    if pan_no:
+        trade_filters.append('w9."PAN_NO" = :pan_no')
+    if trade_date_from:
+        trade_filters.append('w2."TRADDATE" >= :trade_date_from')
+    if trade_date_to:
+        trade_filters.append('w2."TRADDATE" <= :trade_date_to')
+    if rep_date_from:
+        trade_filters.append('w2."REP_DATE" >= :rep_date_from')
+    if rep_date_to:
+        trade_filters.append('w2."REP_DATE" <= :rep_date_to')
+
+    # NULL dimension values are joined through a marker, as FULL JOIN needs plain equality
+    join = " AND ".join(["h.level = t.level"] + [f"COALESCE(h.d{i}, chr(1)) = COALESCE(t.d{i}, chr(1))" for i in range(len(group_by))])
+    dimensions = [f"COALESCE(h.d{i}, t.d{i}) AS d{i}" for i in range(len(group_by))]
+    order = ", ".join(["level"] + [f"d{i} NULLS LAST" for i in range(len(group_by))])
+    return f'''
+        WITH holdings AS (
+            SELECT {holdings_columns},
+                sum(w9."RUPEE_BAL")::float8 AS aum, sum(w9."CLOS_BAL")::float8 AS units, count(*) AS folios
+            FROM "CAMS_WBR9" w9{latest_transaction}
+            WHERE {'w9."PAN_NO" = :pan_no' if pan_no else "TRUE"}
+            {holdings_group}
+        ),
+        trades AS (
+            SELECT {trades_columns},
+                coalesce(sum(w2."AMOUNT") FILTER (WHERE w2.{_type_condition(PURCHASE_TYPES)}), 0)::float8 AS purchases,
+                coalesce(sum(w2."AMOUNT") FILTER (WHERE w2.{_type_condition(REDEMPTION_TYPES)}), 0)::float8 AS redemptions,
+                (coalesce(sum(w2."AMOUNT") FILTER (WHERE w2.{_type_condition(PURCHASE_TYPES)}), 0)
+                    - coalesce(sum(w2."AMOUNT") FILTER (WHERE w2.{_type_condition(REDEMPTION_TYPES)}), 0))::float8 AS net,
+                count(*) AS transactions
+            FROM "CAMS_WBR2" w2
+            JOIN "CAMS_WBR9" w9 ON w9."FOLIOCHK" = w2."FOLIO_NO" AND w9."SCH_NAME" = w2."SCHEME"
+            WHERE {" AND ".join(trade_filters)}
+            {trades_group}
+        )
+        SELECT {", ".join(dimensions + ["coalesce(h.level, t.level) AS level"])},
+            h.aum, h.units, coalesce(h.folios, 0), coalesce(t.purchases, 0), coalesce(t.redemptions, 0),
+            coalesce(t.net, 0), coalesce(t.transactions, 0)
+        FROM holdings h FULL JOIN trades t ON {join}
+        ORDER BY {order}
+    '''
+
+
+def _query(group_by, rollup, filters):
+    sql = aggregate_sql(group_by, rollup, **{name: value is not None for name, value in filters.items()})
+    return text(sql).bindparams(**{name: value for name, value in filters.items() if value is not None})
+
+
+def _rows_to_dicts(rows, group_by, rollup):
+    group_by = list(dict.fromkeys(group_by))
+    labels = [COLUMN_MAPPING[DIMENSIONS[name][0]] for name in group_by]
+    results = []
+    for row in rows:
+        result = dict(zip(labels, row[:len(labels)]))
+        if rollup:
+            # Rows of a rollup level above the full grouping are subtotals (or the grand total)
+            result["Subtotal"] = bool(row[len(labels)])
+        result.update(zip(MEASURES, row[len(labels) + 1:]))
+        results.append(result)
+    return results
+
+
+def get_aggregates(group_by=("amc",), rollup=False, pan_no=None, trade_date_from: date = None,
+                   trade_date_to: date = None, rep_date_from: date = None, rep_date_to: date = None):
+    """
+    Portfolio totals grouped by `group_by` dimensions, computed by PostgreSQL.
+
+    Args:
+        group_by (list): Dimensions of DIMENSIONS; empty for a single grand total.
+        rollup (bool): Add subtotal rows for every prefix of `group_by` and a grand total.
+        pan_no (str, optional): Only the folios of this PAN.
+        trade_date_from, trade_date_to (date, optional): TRADDATE range of the transaction measures.
+        rep_date_from, rep_date_to (date, optional): REP_DATE range of the transaction measures.
+
+    Returns:
+        list: One dict per group with the dimension labels and MEASURES.
+
+    Raises:
+        SQLAlchemyError: The query failed; it is logged and re-raised, so a
+            failure is never mistaken for an empty result.
+    """
+    filters = dict(pan_no=pan_no, trade_date_from=trade_date_from, trade_date_to=trade_date_to,
+                   rep_date_from=rep_date_from, rep_date_to=rep_date_to)
+    query = _query(group_by, rollup, filters)
+    try:
+        with get_engine().connect() as connection:
+            return _rows_to_dicts(connection.execute(query).all(), group_by, rollup)
+    except SQLAlchemyError as e:
+        log.error(f"Error aggregating the portfolio: {e}", extra={"pan": pan_no})
+        raise
+
+
+async def get_aggregates_async(group_by=("amc",), rollup=False, pan_no=None, trade_date_from: date = None,
+                               trade_date_to: date = None, rep_date_from: date = None, rep_date_to: date = None):
+    """
+    `get_aggregates` on the async engine.
+    """
+    filters = dict(pan_no=pan_no, trade_date_from=trade_date_from, trade_date_to=trade_date_to,
+                   rep_date_from=rep_date_from, rep_date_to=rep_date_to)
+    query = _query(group_by, rollup, filters)
+    try:
+        async with get_async_engine().connect() as connection:
+            return _rows_to_dicts((await connection.execute(query)).all(), group_by, rollup)
+    except SQLAlchemyError as e:
+        log.error(f"Error aggregating the portfolio: {e}", extra={"pan": pan_no})
+        raise
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print portfolio totals computed in the database.")
+    parser.add_argument("group_by", nargs="*", default=["amc"], help=f"Dimensions: {', '.join(DIMENSIONS)}")
+    parser.add_argument("--rollup", action="store_true", help="Add subtotals and a grand total")
+    parser.add_argument("--pan", help="Only the folios of this PAN")
+    parser.add_argument("--trade-from", type=date.fromisoformat, help="First TRADDATE of the transaction measures")
+    parser.add_argument("--trade-to", type=date.fromisoformat, help="Last TRADDATE of the transaction measures")
+    parser.add_argument("--rep-date-from", type=date.fromisoformat, help="First REP_DATE of the transaction measures")
+    parser.add_argument("--rep-date-to", type=date.fromisoformat, help="Last REP_DATE of the transaction measures")
+    args = parser.parse_args()
+
+    rows = get_aggregates(args.group_by, args.rollup, args.pan, args.trade_from, args.trade_to, args.rep_date_from, args.rep_date_to)
+    for row in rows:
+        print(row)
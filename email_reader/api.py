@@ -1,7 +1,23 @@
-from fastapi import FastAPI, Depends, HTTPException
+import os
+import time
+from datetime import date
+from typing import List
+import orjson
+from fastapi import FastAPI, Depends, HTTPException, Query, Request
+from fastapi.responses import ORJSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from service import get_user_data
-import uvicorn
+from pydantic import BaseModel, Field
+from aggregates import get_aggregates_async
+from read_model import decode_cursor, encode_cursor
+from service import (
+    USER_DATA_PAGE_SIZE, get_user_data_async, get_user_data_batch_async, get_user_data_page_async, get_xirr_async,
+    iter_user_data_async, normalize_pan,
+)
+from cache import user_data_cache
+import metrics
+
+USER_DATA_MAX_PAGE_SIZE = int(os.environ.get("USER_DATA_MAX_PAGE_SIZE", 5000))
+USER_DATA_BATCH_MAX_PANS = int(os.environ.get("USER_DATA_BATCH_MAX_PANS", 1000))
 
 app = FastAPI()
 
@@ -13,11 +29,106 @@ def authenticate(credentials: HTTPBasicCredentials):
     if credentials.username != correct_username or credentials.password != correct_password:
         raise HTTPException(status_code=401, detail="Unauthorized")
 
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    if not metrics.METRICS_ENABLED:
+        return await call_next(request)
+    start = time.perf_counter()
+    # Statements of a streamed body run after this returns and are not counted
+    with metrics.count_round_trips("unmatched") as labels:
+        response = await call_next(request)
+        route = request.scope.get("route")
+        route = route.path if route else "unmatched"
+        labels["scope"] = f"{request.method} {route}"
+    metrics.HTTP_REQUEST_SECONDS.observe(time.perf_counter() - start, method=request.method, route=route, status=response.status_code)
+    return response
+
 @app.get("/user_data")
-def user_data(pan_no: str = None, credentials: HTTPBasicCredentials = Depends(security)):
+async def user_data(
+    pan_no: str = None,
+    limit: int = Query(None, ge=1, le=USER_DATA_MAX_PAGE_SIZE),
+    cursor: str = None,
+    output: str = Query("json", alias="format", pattern="^(json|ndjson)$"),
+    credentials: HTTPBasicCredentials = Depends(security),
+):
+    authenticate(credentials)
+    pan_no = normalize_pan(pan_no)
+    if output == "ndjson":
+        if limit is not None or cursor is not None:
+            raise HTTPException(status_code=400, detail="limit and cursor page the json format; ndjson streams every folio.")
+        # One folio per line straight from a server-side cursor
+        lines = (orjson.dumps(data) + b"\n" async for data in iter_user_data_async(pan_no))
+        return StreamingResponse(lines, media_type="application/x-ndjson")
+    if limit is not None or cursor is not None:
+        try:
+            after = decode_cursor(cursor) if cursor else None
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        data, next_key = await get_user_data_page_async(pan_no, after, limit or USER_DATA_PAGE_SIZE)
+        return ORJSONResponse({"data": data, "next_cursor": encode_cursor(next_key) if next_key else None})
+    if user_data_cache is None:
+        data = await get_user_data_async(pan_no=pan_no)
+    else:
+        data = await user_data_cache.get_async(pan_no, get_user_data_async)
+    # Already JSON-ready, so it skips jsonable_encoder
+    return ORJSONResponse(data)
+
+class UserDataBatchRequest(BaseModel):
+    pan_nos: List[str] = Field(..., min_length=1, max_length=USER_DATA_BATCH_MAX_PANS)
+
+@app.post("/user_data/batch")
+async def user_data_batch(request: UserDataBatchRequest, credentials: HTTPBasicCredentials = Depends(security)):
+    authenticate(credentials)
+    results, errors = await get_user_data_batch_async(request.pan_nos)
+    return ORJSONResponse({"results": results, "errors": errors})
+
+@app.get("/xirr")
+async def xirr(
+    pan_no: str = None,
+    group_by: str = Query("folio", pattern="^(folio|scheme|pan)$"),
+    as_of: date = None,
+    credentials: HTTPBasicCredentials = Depends(security),
+):
+    authenticate(credentials)
+    try:
+        return ORJSONResponse(await get_xirr_async(normalize_pan(pan_no), group_by, as_of))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@app.get("/aggregates")
+async def aggregates(
+    group_by: List[str] = Query(["amc"]),
+    rollup: bool = False,
+    pan_no: str = None,
+    trade_date_from: date = None,
+    trade_date_to: date = None,
+    rep_date_from: date = None,
+    rep_date_to: date = None,
+    credentials: HTTPBasicCredentials = Depends(security),
+):
+    authenticate(credentials)
+    try:
+        rows = await get_aggregates_async(
+            group_by, rollup, normalize_pan(pan_no), trade_date_from, trade_date_to, rep_date_from, rep_date_to
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return ORJSONResponse(rows)
+
+@app.get("/cache_stats")
+def cache_stats(credentials: HTTPBasicCredentials = Depends(security)):
+    authenticate(credentials)
+    if user_data_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **user_data_cache.stats()}
+
+@app.get("/metrics")
+def metrics_endpoint(credentials: HTTPBasicCredentials = Depends(security)):
     authenticate(credentials)
-    return get_user_data(pan_no=pan_no)
+    # Metrics are kept per process; scrape each worker when uvicorn runs several
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
 
 if __name__ == "__main__":
+    import uvicorn
     uvicorn.run(app, host="127.0.0.1", port=8000)
 
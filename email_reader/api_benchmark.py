@@ -0,0 +1,294 @@
+import argparse
+import asyncio
+import logging
+import math
+import os
+import sys
+import time
+from datetime import datetime
+from ingest_benchmark import BENCH_DB_NAME, PROTECTED_DB_NAMES, RESULTS_DIR, git_revision, previous_result, save_result
+
+# Load test of /user_data: a synthetic book of business is loaded into a
+# scratch database the way ingestion loads reports, then concurrent clients
+# drive the FastAPI app in-process (httpx over ASGI, no network) through each
+# scenario and the latency percentiles, throughput and database statements
+# per request are reported.
+#
+#   python api_benchmark.py --investors 10000 --transactions 50 --skew 1.1
+#   python api_benchmark.py --skip-seed --scenarios single_pan_warm
+#
+# As in ingest_benchmark.py, the project modules are imported only after
+# DB_NAME points at the scratch database.
+
+RESULTS_FILE = os.path.join(RESULTS_DIR, "api.jsonl")
+SCENARIOS = ["single_pan_uncached", "single_pan_cold", "single_pan_warm", "unfiltered", "unfiltered_paged"]
+COMPARED_PARAMETERS = ("investors", "folios", "transactions", "skew", "seed", "concurrency", "requests", "hot_pans", "page_size", "unfiltered_requests", "unfiltered_concurrency")
+SEED_BATCH_ROWS = 200000
+AUTH = ("admin", "password")
+
+
+def seed(args):
+    """
+    Recreate the scratch database and load a synthetic book into it through
+    `bulk_loader.bulk_upsert_batches`, refreshing summaries and data versions
+    like a report load does.
+
+    Returns:
+        dict: Seconds taken and rows loaded per table.
+    """
+    from sqlalchemy import text
+    from bulk_loader import bulk_upsert_batches
+    from data_version import bump_data_versions
+    from db_connection import get_engine
+    from migrations import drop_and_recreate_database, recreate_schema
+    from models import CamsWBR2, CamsWBR9
+    from summary import refresh_touched_summaries
+    from synthetic_reports import synthetic_book
+
+    start = time.perf_counter()
+    drop_and_recreate_database()
+    recreate_schema()
+    wbr9, wbr2 = synthetic_book(args.investors, args.folios, args.transactions, args.skew, args.seed)
+    for model_class, df in ((CamsWBR9, wbr9), (CamsWBR2, wbr2)):
+        def after_merge(session, counts, model_class=model_class):
+            refresh_touched_summaries(session, model_class, counts)
+            bump_data_versions(session, model_class, counts)
+
+        batches = (df.iloc[i:i + SEED_BATCH_ROWS] for i in range(0, len(df), SEED_BATCH_ROWS))
+        if bulk_upsert_batches(batches, model_class, on_merged=after_merge) is None:
+            raise RuntimeError(f"Seeding {model_class.__tablename__} failed.")
+    # Plans are measured on fresh statistics, not on whenever autovacuum gets to the new tables
+    with get_engine().connect() as connection:
+        connection.execute(text('ANALYZE "CAMS_WBR9", "CAMS_WBR2", "PORTFOLIO_SUMMARY", "DATA_VERSION"'))
+        connection.commit()
+    return {"seconds": time.perf_counter() - start, "CAMS_WBR9": len(wbr9), "CAMS_WBR2": len(wbr2)}
+
+
+def book_stats():
+    from sqlalchemy import text
+    from db_connection import get_engine
+    with get_engine().connect() as connection:
+        pans = connection.execute(text('SELECT "PAN_NO", count(*) FROM "CAMS_WBR9" GROUP BY "PAN_NO" ORDER BY "PAN_NO"')).all()
+        transactions = connection.execute(text('SELECT count(*) FROM "CAMS_WBR2"')).scalar()
+    folios = [count for _, count in pans]
+    return [pan for pan, _ in pans], {
+        "pans": len(pans),
+        "folios": sum(folios),
+        "max_folios_per_pan": max(folios, default=0),
+        "transactions": transactions,
+    }
+
+
+class StatementCounter:
+    """
+    Counts the statements the API's async engine sends to PostgreSQL.
+    """
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.count = 0
+        event.listen(engine.sync_engine, "before_cursor_execute", self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+
+def percentile(sorted_values, fraction):
+    # Nearest-rank percentile of an ascending list
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(fraction * len(sorted_values)) - 1)]
+
+
+async def drive(client, requests, concurrency):
+    """
+    Send `requests` (lists of GET params) from `concurrency` clients, each
+    taking the next request as soon as its previous one finished.
+
+    Returns:
+        tuple: (latencies in seconds, error count, response bytes, wall seconds).
+    """
+    pending = iter(requests)
+    latencies = []
+    errors = 0
+    received = 0
+
+    async def client_loop():
+        nonlocal errors, received
+        for params in pending:
+            start = time.perf_counter()
+            response = await client.get("/user_data", params=params, auth=AUTH)
+            body = response.content
+            latencies.append(time.perf_counter() - start)
+            received += len(body)
+            if response.status_code != 200:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client_loop() for _ in range(max(1, min(concurrency, len(requests))))))
+    return latencies, errors, received, time.perf_counter() - start
+
+
+async def walk_pages(client, page_size):
+    # One client following next_cursor to the end of the book
+    latencies = []
+    errors = 0
+    received = 0
+    params = {"limit": page_size}
+    start = time.perf_counter()
+    while True:
+        request_start = time.perf_counter()
+        response = await client.get("/user_data", params=params, auth=AUTH)
+        latencies.append(time.perf_counter() - request_start)
+        received += len(response.content)
+        if response.status_code != 200:
+            errors += 1
+            break
+        cursor = response.json()["next_cursor"]
+        if not cursor:
+            break
+        params = {"limit": page_size, "cursor": cursor}
+    return latencies, errors, received, time.perf_counter() - start
+
+
+def summarize(latencies, errors, received, seconds, statements, concurrency):
+    ordered = sorted(latencies)
+    requests = len(ordered)
+    return {
+        "requests": requests,
+        "errors": errors,
+        "concurrency": concurrency,
+        "p50_ms": round(percentile(ordered, 0.50) * 1000, 2) if requests else None,
+        "p95_ms": round(percentile(ordered, 0.95) * 1000, 2) if requests else None,
+        "p99_ms": round(percentile(ordered, 0.99) * 1000, 2) if requests else None,
+        "max_ms": round(ordered[-1] * 1000, 2) if requests else None,
+        "throughput_rps": round(requests / seconds, 2) if seconds else None,
+        "queries_per_request": round(statements / requests, 2) if requests else None,
+        "bytes_per_request": int(received / requests) if requests else None,
+    }
+
+
+async def run_scenarios(args, pans):
+    import random
+    import httpx
+    import api
+    from async_db import get_async_engine
+    from cache import user_data_cache
+
+    # One INFO line per request would drown the report
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    counter = StatementCounter(get_async_engine())
+    rng = random.Random(args.seed)
+    hot = rng.sample(pans, min(args.hot_pans, len(pans)))
+    results = {}
+    # Failed requests come back as 500s and are counted as errors
+    transport = httpx.ASGITransport(app=api.app, raise_app_exceptions=False)
+    async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+        # Opens the pool's connections so the first scenario does not pay for them
+        await drive(client, [{"pan_no": pan} for pan in hot[:args.concurrency]], args.concurrency)
+
+        for name in args.scenarios:
+            concurrency = args.concurrency
+            cache = user_data_cache
+            if name == "single_pan_uncached":
+                api.user_data_cache = None
+                requests = [{"pan_no": rng.choice(pans)} for _ in range(args.requests)]
+            elif name == "single_pan_cold":
+                # Distinct PANs, so every request misses the cache
+                requests = [{"pan_no": pan} for pan in rng.sample(pans, min(args.requests, len(pans)))]
+            elif name == "single_pan_warm":
+                requests = [{"pan_no": pan} for pan in hot]
+                await drive(client, requests, concurrency)
+                requests = [{"pan_no": rng.choice(hot)} for _ in range(args.requests)]
+            elif name == "unfiltered":
+                concurrency = args.unfiltered_concurrency
+                requests = [{} for _ in range(args.unfiltered_requests)]
+            elif name == "unfiltered_paged":
+                concurrency = 1
+                requests = None
+            else:
+                raise ValueError(f"Unknown scenario {name!r}; expected any of {', '.join(SCENARIOS)}.")
+
+            if cache is not None and name == "single_pan_cold":
+                cache.clear()
+            statements = counter.count
+            try:
+                if requests is None:
+                    measured = await walk_pages(client, args.page_size)
+                else:
+                    measured = await drive(client, requests, concurrency)
+            finally:
+                api.user_data_cache = cache
+            results[name] = summarize(*measured, counter.count - statements, concurrency)
+            print(format_scenario(name, results[name]))
+    await get_async_engine().dispose()
+    return results
+
+
+def format_scenario(name, result, baseline=None):
+    line = (
+        f"  {name:<20} {result['requests']:>6} req x{result['concurrency']:<3} "
+        f"p50 {result['p50_ms']} ms, p95 {result['p95_ms']} ms, p99 {result['p99_ms']} ms, "
+        f"{result['throughput_rps']} req/s, {result['queries_per_request']} queries/req, {result['errors']} errors"
+    )
+    if baseline is not None and baseline.get("p95_ms") and baseline.get("throughput_rps"):
+        line += (
+            f" | vs baseline p95 {(result['p95_ms'] / baseline['p95_ms'] - 1) * 100:+.1f}%, "
+            f"req/s {(result['throughput_rps'] / baseline['throughput_rps'] - 1) * 100:+.1f}%"
+        )
+    return line
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test /user_data on a synthetic book of business.")
+    parser.add_argument("--investors", type=int, default=10000, help="PANs in the synthetic book")
+    parser.add_argument("--folios", type=float, default=3.0, help="Mean folios per PAN")
+    parser.add_argument("--transactions", type=float, default=20.0, help="Mean transactions per folio")
+    parser.add_argument("--skew", type=float, default=1.0, help="Zipf exponent of folios per PAN (0 = even)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--skip-seed", action="store_true", help="Reuse the book already in the scratch database")
+    parser.add_argument("--scenarios", nargs="+", default=SCENARIOS, choices=SCENARIOS)
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent clients")
+    parser.add_argument("--requests", type=int, default=2000, help="Requests per single-PAN scenario")
+    parser.add_argument("--hot-pans", type=int, default=100, help="PANs the warm-cache scenario cycles through")
+    parser.add_argument("--unfiltered-requests", type=int, default=4, help="Requests of the unfiltered scenario")
+    parser.add_argument("--unfiltered-concurrency", type=int, default=1, help="Concurrent clients of the unfiltered scenario")
+    parser.add_argument("--page-size", type=int, default=500, help="Folios per page of the paged scenario")
+    parser.add_argument("--db-name", default=BENCH_DB_NAME, help="Scratch database, dropped and recreated when seeding")
+    parser.add_argument("--results", default=RESULTS_FILE, help="JSON lines file the result is appended to")
+    parser.add_argument("--no-save", action="store_true", help="Print the result without storing it")
+    args = parser.parse_args(argv)
+
+    if args.db_name in PROTECTED_DB_NAMES:
+        parser.error(f"{args.db_name} is dropped and recreated by the benchmark; use a scratch database.")
+    os.environ["DB_NAME"] = args.db_name
+
+    seeded = None if args.skip_seed else seed(args)
+    pans, book = book_stats()
+    if not pans:
+        parser.error(f"{args.db_name} holds no folios; run without --skip-seed.")
+    record = {
+        "revision": git_revision(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "parameters": {name: value for name, value in vars(args).items() if name not in ("db_name", "no_save", "results", "skip_seed")},
+        "book": book,
+        "seed": seeded,
+    }
+    print(
+        f"/user_data benchmark at {record['revision'] or 'unknown revision'}: {book['pans']} PANs, {book['folios']} folios "
+        f"(up to {book['max_folios_per_pan']} per PAN), {book['transactions']} transactions"
+        + (f", seeded in {seeded['seconds']:.1f}s" if seeded else "")
+    )
+    record["scenarios"] = asyncio.run(run_scenarios(args, pans))
+
+    baseline = previous_result(record, args.results, COMPARED_PARAMETERS)
+    if baseline is not None:
+        print(f"Compared with {baseline['revision']} ({baseline['timestamp']}):")
+        for name, result in record["scenarios"].items():
+            print(format_scenario(name, result, baseline["scenarios"].get(name)))
+    if not args.no_save:
+        save_result(record, args.results)
+    return 0 if not any(result["errors"] for result in record["scenarios"].values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,46 @@
+import asyncio
+import threading
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from db_connection import ASYNC_DATABASE_URL, API_STATEMENT_TIMEOUT_MS, POOL_SETTINGS, BindOnFirstUse
+from metrics import instrument_engine
+
+# asyncpg engine for the API. Requests wait on the event loop instead of
+# holding a threadpool worker; at most pool_size + max_overflow queries run at
+# once and the rest queue for up to pool_timeout seconds.
+_async_engine = None
+_async_engine_lock = threading.Lock()
+
+
+def get_async_engine():
+    """
+    Return the process-wide async engine, created on first use.
+    """
+    global _async_engine
+    with _async_engine_lock:
+        if _async_engine is None:
+            _async_engine = create_async_engine(
+                ASYNC_DATABASE_URL,
+                echo=False,
+                connect_args={"server_settings": {"statement_timeout": str(API_STATEMENT_TIMEOUT_MS)}},
+                **POOL_SETTINGS,
+            )
+            instrument_engine(_async_engine)
+        return _async_engine
+
+
+class LazyAsyncSessionmaker(BindOnFirstUse, async_sessionmaker):
+    pass
+
+
+AsyncSessionLocal = LazyAsyncSessionmaker(get_async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+
+async def test_async_connection():
+    async with get_async_engine().connect() as connection:
+        await connection.execute(text("SELECT 1"))
+    print("Async connection to PostgreSQL database successful!")
+
+
+if __name__ == "__main__":
+    asyncio.run(test_async_connection())
@@ -0,0 +1,270 @@
+from io import StringIO
+from db_connection import SessionLocal
+from setup import log
+
+NULL_MARKER = "\\N"
+
+
+def _quote(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _column_list(column_names, alias=None) -> str:
+    prefix = f"{alias}." if alias else ""
+    return ", ".join(prefix + _quote(name) for name in column_names)
+
+
+def _foreign_key_condition(table, alias) -> str:
+    """
+    Build a WHERE clause that keeps only staged rows whose foreign keys resolve,
+    so orphan rows are rejected instead of failing the whole report.
+    """
+    conditions = []
+    for constraint in table.foreign_key_constraints:
+        local_columns = [element.parent.name for element in constraint.elements]
+        target_table = constraint.elements[0].column.table.name
+        join = " AND ".join(
+            f"ref.{_quote(element.column.name)} = {alias}.{_quote(element.parent.name)}"
+            for element in constraint.elements
+        )
+        nulls = " OR ".join(f"{alias}.{_quote(name)} IS NULL" for name in local_columns)
+        conditions.append(f"({nulls} OR EXISTS (SELECT 1 FROM {_quote(target_table)} ref WHERE {join}))")
+    return " AND ".join(conditions) if conditions else "TRUE"
+
+
+def _key_condition(key_columns, alias) -> str:
+    # Rows missing a key column (e.g. a transaction without a trade date) are
+    # rejected like orphans rather than failing the load on NOT NULL
+    return " AND ".join(f"{alias}.{_quote(name)} IS NOT NULL" for name in key_columns)
+
+
+def staging_table_name(table_name) -> str:
+    """
+    Quoted name of the temporary table a load stages `table_name` rows in. It
+    exists until the load transaction commits, so `on_merged` callbacks can read it.
+    """
+    return _quote(f"stage_{table_name}")
+
+
+def moved_table_name(table_name) -> str:
+    """
+    Quoted name of the temporary table that holds the rows a load deleted
+    because their unique key moved to another primary key (see `_delete_moved_sql`).
+    Like the staging table, it exists until the load transaction commits.
+    """
+    return _quote(f"moved_{table_name}")
+
+
+def _create_staging_table(cursor, table_name) -> str:
+    staging_table = staging_table_name(table_name)
+    cursor.execute(
+        f"CREATE TEMP TABLE {staging_table} (LIKE {_quote(table_name)} INCLUDING DEFAULTS) ON COMMIT DROP"
+    )
+    # Arrival order, so the last occurrence of a key wins like the per-row merge did.
+    cursor.execute(f"ALTER TABLE {staging_table} ADD COLUMN _ord BIGSERIAL")
+    return staging_table
+
+
+def write_csv(df, file, column_names):
+    """
+    Render `df` in the CSV format that the staging COPY expects.
+    """
+    df.to_csv(file, columns=column_names, index=False, header=False, na_rep=NULL_MARKER)
+
+
+def _copy_csv(cursor, file, staging_table, column_names) -> int:
+    cursor.copy_expert(
+        f"COPY {staging_table} ({_column_list(column_names)}) FROM STDIN WITH (FORMAT csv, NULL '{NULL_MARKER}')",
+        file,
+    )
+    return cursor.rowcount
+
+
+def _copy_dataframe(cursor, df, staging_table, column_names) -> int:
+    buffer = StringIO()
+    write_csv(df, buffer, column_names)
+    buffer.seek(0)
+    return _copy_csv(cursor, buffer, staging_table, column_names)
+
+
+def _unique_key(table):
+    # Columns that identify a row on their own when the primary key is wider,
+    # e.g. CAMS_WBR2, whose key includes the partition column (see models.py)
+    return list(table.info.get("unique_key") or [column.name for column in table.primary_key.columns])
+
+
+def _accepted_sql(table, staging_table, column_names) -> str:
+    # The `source` (last occurrence of each key) and `accepted` CTEs of a merge
+    key_columns = [column.name for column in table.primary_key.columns]
+    unique_key = _column_list(_unique_key(table))
+    return f"""
+        source AS (
+            SELECT DISTINCT ON ({unique_key}) {_column_list(column_names, 's')}
+            FROM {staging_table} s
+            ORDER BY {unique_key}, s._ord DESC
+        ),
+        accepted AS (
+            SELECT * FROM source s WHERE {_key_condition(key_columns, 's')} AND {_foreign_key_condition(table, 's')}
+        )"""
+
+
+def _delete_moved_sql(table, staging_table, column_names) -> str:
+    """
+    Delete the stored rows whose unique key is staged with a different primary
+    key, e.g. a transaction re-sent with a corrected trade date, so the merge
+    replaces them instead of adding a second row. The deleted rows are kept in
+    `moved_table_name(table.name)`, so callbacks also see the keys they left.
+    """
+    unique_join = " AND ".join(f"t.{_quote(name)} = a.{_quote(name)}" for name in _unique_key(table))
+    key_columns = [column.name for column in table.primary_key.columns]
+    return f"""
+        WITH {_accepted_sql(table, staging_table, column_names)},
+        moved AS (
+            DELETE FROM {_quote(table.name)} t USING accepted a
+            WHERE {unique_join} AND ({_column_list(key_columns, 't')}) IS DISTINCT FROM ({_column_list(key_columns, 'a')})
+            RETURNING t.*
+        )
+        INSERT INTO {moved_table_name(table.name)} SELECT * FROM moved
+    """
+
+
+def _merge_sql(table, staging_table, column_names) -> str:
+    table_name = _quote(table.name)
+    key_columns = [column.name for column in table.primary_key.columns]
+    update_columns = [name for name in column_names if name not in key_columns]
+    keys = _column_list(key_columns)
+    key_join = " AND ".join(f"t.{_quote(name)} = a.{_quote(name)}" for name in key_columns)
+    if update_columns:
+        conflict_action = (
+            "DO UPDATE SET "
+            + ", ".join(f"{_quote(name)} = EXCLUDED.{_quote(name)}" for name in update_columns)
+            + f" WHERE ({_column_list(update_columns, table_name)}) IS DISTINCT FROM ({_column_list(update_columns, 'EXCLUDED')})"
+        )
+    else:
+        conflict_action = "DO NOTHING"
+
+    return f"""
+        WITH {_accepted_sql(table, staging_table, column_names)},
+        merged AS (
+            INSERT INTO {table_name} ({_column_list(column_names)})
+            SELECT {_column_list(column_names)} FROM accepted
+            ON CONFLICT ({keys}) {conflict_action}
+            RETURNING 1
+        ),
+        -- CTEs see the table as it was before the insert. The keys that already
+        -- existed tell inserts from updates; xmax cannot be read from partitioned tables
+        existing AS (
+            SELECT count(*) AS n FROM accepted a
+            WHERE EXISTS (SELECT 1 FROM {table_name} t WHERE {key_join})
+        )
+        SELECT
+            (SELECT count(*) FROM source),
+            (SELECT count(*) FROM accepted),
+            (SELECT count(*) FROM accepted) - (SELECT n FROM existing),
+            (SELECT count(*) FROM merged) - ((SELECT count(*) FROM accepted) - (SELECT n FROM existing))
+    """
+
+
+def _bulk_upsert(model_class, stage, session_factory, on_merged):
+    # `stage(cursor, table)` copies the rows into a staging table and returns
+    # (staging table, column names, staged row count).
+    table = model_class.__table__
+    counts = {"staged": 0, "inserted": 0, "updated": 0, "unchanged": 0, "rejected": 0}
+
+    session = session_factory()
+    try:
+        cursor = session.connection().connection.cursor()
+        try:
+            staging_table, column_names, counts["staged"] = stage(cursor, table)
+            if counts["staged"]:
+                moved = 0
+                if table.info.get("unique_key"):
+                    cursor.execute(
+                        f"CREATE TEMP TABLE {moved_table_name(table.name)} (LIKE {_quote(table.name)}) ON COMMIT DROP"
+                    )
+                    cursor.execute(_delete_moved_sql(table, staging_table, column_names))
+                    moved = cursor.rowcount
+                cursor.execute(_merge_sql(table, staging_table, column_names))
+                distinct_rows, accepted, inserted, updated = cursor.fetchone()
+                # A row whose primary key moved was deleted and inserted again
+                counts.update(
+                    inserted=inserted - moved,
+                    updated=updated + moved,
+                    unchanged=accepted - inserted - updated,
+                    rejected=distinct_rows - accepted,
+                )
+        finally:
+            cursor.close()
+        if on_merged is not None:
+            on_merged(session, counts)
+        session.commit()
+        return counts
+    except Exception as e:
+        session.rollback()
+        log.error(f"Error bulk loading records into {table.name}: {e}")
+        return None
+    finally:
+        session.close()
+
+
+def bulk_upsert_batches(batches, model_class, session_factory=SessionLocal, on_merged=None):
+    """
+    Load an iterable of DataFrame batches into the table of `model_class` in a single transaction.
+
+    Each batch is COPYed into a temporary staging table as soon as it is
+    produced and can be released before the next one is read, so memory is
+    bounded by one batch. When the last batch is staged, the staging table is
+    merged into the target with one INSERT ... ON CONFLICT DO UPDATE. Rows that
+    share a primary key (or the table's `unique_key`) keep the last occurrence,
+    stored rows whose `unique_key` is staged under another primary key are
+    replaced, rows that are identical to
+    the stored ones are left untouched and rows with unresolved foreign keys
+    are rejected. If producing a batch fails, nothing is written.
+
+    Args:
+        batches: Iterable of DataFrames whose columns are a subset of the table columns.
+        model_class: The SQLAlchemy model class corresponding to the table.
+        session_factory: Factory used to open the session for the transaction.
+        on_merged (callable, optional): Called with (session, counts) after the
+            merge and before the commit, to write related rows in the same transaction.
+
+    Returns:
+        dict: Counts of "staged", "inserted", "updated", "unchanged" and
+        "rejected" rows, or None if the load failed and was rolled back.
+    """
+    def stage(cursor, table):
+        staging_table, column_names, staged = None, None, 0
+        for df in batches:
+            if staging_table is None:
+                staging_table = _create_staging_table(cursor, table.name)
+                column_names = [column.name for column in table.columns if column.name in df.columns]
+            if not df.empty:
+                _copy_dataframe(cursor, df, staging_table, column_names)
+                staged += len(df)
+            del df
+        return staging_table, column_names, staged
+
+    return _bulk_upsert(model_class, stage, session_factory, on_merged)
+
+
+def bulk_upsert_csv(file, column_names, model_class, session_factory=SessionLocal, on_merged=None):
+    """
+    Like `bulk_upsert_batches`, for rows already rendered with `write_csv`.
+
+    Args:
+        file: A readable text file in the `write_csv` format.
+        column_names (list): The table columns, in the order of the CSV fields.
+        model_class: The SQLAlchemy model class corresponding to the table.
+    """
+    def stage(cursor, table):
+        staging_table = _create_staging_table(cursor, table.name)
+        return staging_table, column_names, _copy_csv(cursor, file, staging_table, column_names)
+
+    return _bulk_upsert(model_class, stage, session_factory, on_merged)
+
+
+def bulk_upsert_dataframe(df, model_class, session_factory=SessionLocal):
+    """
+    Load a single DataFrame in one transaction, see `bulk_upsert_batches`.
+    """
+    return bulk_upsert_batches([df], model_class, session_factory=session_factory)
@@ -0,0 +1,254 @@
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+import orjson
+from data_version import ALL_PANS, get_data_version, get_data_version_async
+from setup import log
+
+try:
+    import redis
+except ImportError:  # only needed for USER_DATA_CACHE=redis://...
+    redis = None
+
+# "memory" (per process), "local-shared" (stand-in for a shared store), "redis://host:port/db" or "off"
+USER_DATA_CACHE = os.environ.get("USER_DATA_CACHE", "memory")
+USER_DATA_CACHE_SIZE = int(os.environ.get("USER_DATA_CACHE_SIZE", 256))
+# Seconds an entry may be served without being reloaded; 0 keeps it until the data version changes
+USER_DATA_CACHE_TTL = float(os.environ.get("USER_DATA_CACHE_TTL", 0))
+KEY_PREFIX = "user_data:"
+
+
+class MemoryBackend:
+    """
+    In-process LRU cache bounded to `max_entries`, with an optional TTL.
+    Each uvicorn worker has its own.
+    """
+    # Calls never wait on I/O, so async callers make them on the event loop
+    blocking = False
+
+    def __init__(self, max_entries=USER_DATA_CACHE_SIZE, ttl=USER_DATA_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl and time.monotonic() - entry[1] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def incr(self, counter):
+        with self._lock:
+            self._stats[counter] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), max_entries=self.max_entries, ttl=self.ttl)
+
+
+class LocalSharedStore:
+    """
+    Thread-safe stand-in for the subset of the Redis client API SharedBackend
+    uses (get, set with ex, delete, incr, keys). Entries are evicted least
+    recently used first; counters are never evicted. One instance shared by several SharedBackends behaves like several
+    workers talking to one server.
+    """
+    def __init__(self, max_entries=USER_DATA_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def _live(self, key):
+        item = self._data.get(key)
+        if item is not None and item[1] is not None and time.monotonic() > item[1]:
+            del self._data[key]
+            item = None
+        return item
+
+    def get(self, key):
+        with self._lock:
+            if key in self._counters:
+                return self._counters[key]
+            item = self._live(key)
+            if item is None:
+                return None
+            self._data.move_to_end(key)
+            return item[0]
+
+    def set(self, key, value, ex=None):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ex if ex else None)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+        return True
+
+    def delete(self, *keys):
+        with self._lock:
+            return sum(self._data.pop(key, None) is not None for key in keys)
+
+    def incr(self, key, amount=1):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+            return self._counters[key]
+
+    def keys(self, pattern="*"):
+        prefix = pattern.rstrip("*")
+        with self._lock:
+            return [key for key in self._data if key.startswith(prefix)]
+
+
+class SharedBackend:
+    """
+    Cache kept in a shared store (Redis or LocalSharedStore), so every uvicorn
+    worker sees the same entries and counters. Entries must be JSON-ready. Eviction is left to the store,
+    e.g. Redis with maxmemory-policy allkeys-lru.
+    """
+    # The Redis client is synchronous, so async callers run its calls in a thread
+    blocking = True
+
+    def __init__(self, client, ttl=USER_DATA_CACHE_TTL, prefix=KEY_PREFIX):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _key(self, key):
+        return f"{self.prefix}entry:{key}"
+
+    def get(self, key):
+        payload = self.client.get(self._key(key))
+        return orjson.loads(payload) if payload is not None else None
+
+    def set(self, key, value):
+        # JSON rather than pickle, so whoever can write to the store cannot run code here
+        self.client.set(self._key(key), orjson.dumps(value), ex=max(1, int(self.ttl)) if self.ttl else None)
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+    def clear(self):
+        keys = self.client.keys(self._key("*"))
+        if keys:
+            self.client.delete(*keys)
+
+    def incr(self, counter):
+        self.client.incr(f"{self.prefix}stats:{counter}")
+
+    def stats(self):
+        stats = {counter: int(self.client.get(f"{self.prefix}stats:{counter}") or 0) for counter in ("hits", "misses")}
+        # Only the local stand-in can report its evictions; Redis reports them in INFO stats
+        stats["evictions"] = getattr(self.client, "evictions", None)
+        stats["ttl"] = self.ttl
+        return stats
+
+
+class UserDataCache:
+    """
+    Cache of `get_user_data` results keyed by PAN. Every entry remembers the
+    data version of its PAN, and is only served while ingestion has not bumped
+    that version (see data_version.bump_data_versions).
+    """
+    def __init__(self, backend, version_source=get_data_version):
+        self.backend = backend
+        self.version_source = version_source
+
+    def get(self, pan_no, loader):
+        """
+        Return the cached data of `pan_no`, or call `loader(pan_no)` and cache its result.
+        """
+        key = pan_no or ALL_PANS
+        version = self.version_source(pan_no)
+        if version is None:
+            # The version cannot be checked, so the cache cannot be trusted
+            return loader(pan_no)
+        entry = self.backend.get(key)
+        if entry is not None and entry[0] == version:
+            self.backend.incr("hits")
+            return entry[1]
+        self.backend.incr("misses")
+        value = loader(pan_no)
+        self.backend.set(key, (version, value))
+        return value
+
+    async def _call_async(self, method, *args):
+        # Backend calls that wait on a store run in a thread, off the event loop
+        if getattr(self.backend, "blocking", True):
+            return await asyncio.to_thread(method, *args)
+        return method(*args)
+
+    async def get_async(self, pan_no, loader, version_source=get_data_version_async):
+        """
+        `get` for an async `loader`, checking the version with the async `version_source`.
+        """
+        key = pan_no or ALL_PANS
+        version = await version_source(pan_no)
+        if version is None:
+            return await loader(pan_no)
+        entry = await self._call_async(self.backend.get, key)
+        if entry is not None and entry[0] == version:
+            await self._call_async(self.backend.incr, "hits")
+            return entry[1]
+        await self._call_async(self.backend.incr, "misses")
+        value = await loader(pan_no)
+        await self._call_async(self.backend.set, key, (version, value))
+        return value
+
+    def invalidate(self, pan_no=None):
+        self.backend.delete(pan_no or ALL_PANS)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        return self.backend.stats()
+
+
+def create_backend(setting=USER_DATA_CACHE):
+    """
+    Build the cache backend named by the USER_DATA_CACHE setting, or None when caching is off.
+    """
+    if setting == "off":
+        return None
+    if setting == "memory":
+        return MemoryBackend()
+    if setting == "local-shared":
+        return SharedBackend(LocalSharedStore())
+    if setting.startswith(("redis://", "rediss://", "unix://")):
+        if redis is None:
+            raise RuntimeError("USER_DATA_CACHE points at Redis but the redis package is not installed.")
+        return SharedBackend(redis.Redis.from_url(setting))
+    raise ValueError(f"Unknown USER_DATA_CACHE setting {setting!r}.")
+
+
+_backend = create_backend()
+user_data_cache = UserDataCache(_backend) if _backend is not None else None
+if user_data_cache is not None:
+    log.info(f"/user_data cache enabled: {USER_DATA_CACHE}, {USER_DATA_CACHE_SIZE} entries, TTL {USER_DATA_CACHE_TTL or 'none'}.")
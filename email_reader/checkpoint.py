@@ -0,0 +1,83 @@
+from datetime import datetime
+from sqlalchemy import case, func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import SQLAlchemyError
+from db_connection import SessionLocal
+from models import MailboxCheckpoint
+from repository import GenericRepository
+from setup import log
+
+
+def get_checkpoint(mailbox, folder):
+    """
+    Return the stored checkpoint for a mailbox folder, or None on the first run.
+    """
+    return GenericRepository().get(MailboxCheckpoint, (mailbox, folder))
+
+
+def advance_checkpoint(mailbox, folder, uidvalidity=None, last_uid=None, history_id=None, session_factory=SessionLocal):
+    """
+    Move the checkpoint of a mailbox folder forward in a single upsert.
+
+    The stored position never goes backwards while UIDVALIDITY is unchanged, so a
+    run that finishes late cannot rewind a newer one. A new UIDVALIDITY means the
+    server renumbered the folder and the stored UID is replaced outright.
+
+    Args:
+        mailbox (str): The account the checkpoint belongs to.
+        folder (str): The IMAP folder, or the label for the Gmail API path.
+        uidvalidity (int, optional): UIDVALIDITY of the folder the UIDs refer to.
+        last_uid (int, optional): Highest UID that was fully processed.
+        history_id (int, optional): Gmail historyId that was fully processed.
+    """
+    table = MailboxCheckpoint.__table__
+    statement = insert(table).values(
+        MAILBOX=mailbox,
+        FOLDER=folder,
+        UIDVALIDITY=uidvalidity,
+        LAST_UID=last_uid,
+        HISTORY_ID=history_id,
+        UPDATED_AT=datetime.now(),
+    )
+    excluded = statement.excluded
+    statement = statement.on_conflict_do_update(
+        index_elements=[table.c.MAILBOX, table.c.FOLDER],
+        set_={
+            "UIDVALIDITY": func.coalesce(excluded.UIDVALIDITY, table.c.UIDVALIDITY),
+            "LAST_UID": case(
+                (excluded.UIDVALIDITY.is_(None), table.c.LAST_UID),
+                (table.c.UIDVALIDITY.is_not_distinct_from(excluded.UIDVALIDITY), func.greatest(excluded.LAST_UID, table.c.LAST_UID)),
+                else_=excluded.LAST_UID,
+            ),
+            "HISTORY_ID": func.greatest(excluded.HISTORY_ID, table.c.HISTORY_ID),
+            "UPDATED_AT": excluded.UPDATED_AT,
+        },
+    )
+
+    session = session_factory()
+    try:
+        session.execute(statement)
+        session.commit()
+        log.info(f"Checkpoint for {mailbox}/{folder} advanced to UID {last_uid}, historyId {history_id}.")
+    except SQLAlchemyError as e:
+        session.rollback()
+        log.error(f"Error advancing checkpoint for {mailbox}/{folder}: {e}")
+    finally:
+        session.close()
+
+
+def processed_watermark(processed_uids, failed_uids, previous_uid=None, uidnext=None):
+    """
+    Return the highest UID up to which every message was handled.
+
+    Messages are loaded out of UID order (WBR9 before WBR2), so with failures the
+    checkpoint only moves up to just below the first failed UID and the failed
+    messages are retried on the next run. Without failures it moves to the
+    UIDNEXT seen when the folder was selected, which also covers the messages
+    that did not match the search.
+    """
+    if failed_uids:
+        watermark = min(failed_uids) - 1
+    else:
+        watermark = max(list(processed_uids) + ([uidnext - 1] if uidnext else []), default=0)
+    return max(watermark, previous_uid or 0)
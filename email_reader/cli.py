@@ -0,0 +1,58 @@
+import argparse
+import sys
+
+# Command-line entry point. Each command imports its modules only once it
+# runs, so `--help` and argument errors return without loading the database
+# stack, pandas or the Google client libraries.
+#
+#   python cli.py ingest [--folder inbox]
+#   python cli.py gmail [--label INBOX]
+#   python cli.py serve [--host 127.0.0.1] [--port 8000] [--workers 1]
+
+
+def ingest(args):
+    from imap_email_reader import task
+    stats = task(folder=args.folder)
+    return 0 if not any(stage["errors"] for name, stage in stats.items() if name != "wall_seconds") else 1
+
+
+def gmail(args):
+    from email_reader_task import task
+    task(label_id=args.label)
+    return 0
+
+
+def serve(args):
+    import uvicorn
+    # By import string, so every worker imports the app itself
+    uvicorn.run("api:app", host=args.host, port=args.port, workers=args.workers)
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="CAMS report ingestion and portfolio API.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("ingest", help="Load new CAMS reports from the IMAP mailbox")
+    command.add_argument("--folder", default="inbox", help="Mailbox folder to read")
+    command.set_defaults(run=ingest)
+
+    command = commands.add_parser("gmail", help="Download and parse new reports through the Gmail API (does not load the database)")
+    command.add_argument("--label", default="INBOX", help="Gmail label to read")
+    command.set_defaults(run=gmail)
+
+    command = commands.add_parser("serve", help="Run the API server")
+    command.add_argument("--host", default="127.0.0.1")
+    command.add_argument("--port", type=int, default=8000)
+    command.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    command.set_defaults(run=serve)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
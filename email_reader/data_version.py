@@ -0,0 +1,77 @@
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+from async_db import AsyncSessionLocal
+from db_connection import SessionLocal
+from models import DataVersion
+from summary import touched_keys_sql
+from setup import log
+
+ALL_PANS = "*"
+
+
+def bump_data_versions(session, model_class, counts=None):
+    """
+    Increment the data version of every PAN whose folios the current bulk load
+    of `model_class` staged, and of ALL_PANS. Meant for `bulk_loader`
+    `on_merged` callbacks, so readers see the new version exactly when the
+    rows are committed.
+
+    Args:
+        session: The session of the load transaction.
+        model_class: The model that was loaded, CamsWBR2 or CamsWBR9.
+        counts (dict, optional): The load counts; nothing is bumped when no row changed.
+
+    Returns:
+        int: The number of versions bumped.
+    """
+    if counts is not None and not (counts.get("inserted") or counts.get("updated")):
+        return 0
+    cursor = session.connection().connection.cursor()
+    try:
+        cursor.execute(f'''
+            INSERT INTO "DATA_VERSION" ("PAN_NO", "VERSION", "UPDATED_AT")
+            SELECT pan, 1, now() FROM (
+                SELECT DISTINCT w9."PAN_NO" AS pan
+                FROM "CAMS_WBR9" w9
+                JOIN ({touched_keys_sql(model_class)}) t ON t.folio = w9."FOLIOCHK" AND t.scheme = w9."SCH_NAME"
+                UNION SELECT %s
+            ) pans
+            ON CONFLICT ("PAN_NO") DO UPDATE
+            SET "VERSION" = "DATA_VERSION"."VERSION" + 1, "UPDATED_AT" = EXCLUDED."UPDATED_AT"
+        ''', (ALL_PANS,))
+        bumped = cursor.rowcount
+    finally:
+        cursor.close()
+    log.info(f"Bumped the data version of {bumped} PANs after the {model_class.__tablename__} load.")
+    return bumped
+
+
+def _version_query(pan_no=None):
+    return select(DataVersion.VERSION).where(DataVersion.PAN_NO == (pan_no or ALL_PANS))
+
+
+def get_data_version(pan_no=None, session_factory=SessionLocal):
+    """
+    Return the current data version of `pan_no` (ALL_PANS when not given), 0
+    when it was never bumped, or None when it cannot be read.
+    """
+    session = session_factory()
+    try:
+        return session.execute(_version_query(pan_no)).scalar() or 0
+    except SQLAlchemyError as e:
+        log.error(f"Error reading the data version: {e}")
+        return None
+    finally:
+        session.close()
+
+
+async def get_data_version_async(pan_no=None, session_factory=AsyncSessionLocal):
+    """
+    `get_data_version` on the async engine.
+    """
+    async with session_factory() as session:
+        try:
+            return (await session.execute(_version_query(pan_no))).scalar() or 0
+        except SQLAlchemyError as e:
+            log.error(f"Error reading the data version: {e}")
+            return None
@@ -0,0 +1,247 @@
+from __future__ import annotations
+import os
+import shutil
+import struct
+from collections import namedtuple
+from typing import TYPE_CHECKING
+import numpy as np
+
+# pandas is imported by the decoders on first use, so opening archives and
+# reading headers (ingest_ledger, the pipeline's download stage) does not load it
+if TYPE_CHECKING:
+    import pandas as pd
+
+# Set to a directory to keep a copy of every extracted report
+ARCHIVE_DIR = os.environ.get("REPORT_ARCHIVE_DIR")
+# Records decoded and loaded per batch; 0 reads the whole report at once
+INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", 50000))
+
+DbfField = namedtuple("DbfField", ["name", "type", "size", "decimals"])
+DbfHeader = namedtuple("DbfHeader", ["numrec", "lenheader", "lenrecord", "fields"])
+
+
+def read_dbf_header(stream, codec="utf-8") -> DbfHeader:
+    """
+    Read the DBF header and field descriptors, leaving `stream` at the first record.
+
+    The stream is only read forward, so a decrypted ZIP member works as well as a file.
+    """
+    numrec, lenheader, lenrecord = struct.unpack('<xxxxLHH20x', stream.read(32))
+    numfields = (lenheader - 33) // 32
+    fields = []
+    for _ in range(numfields):
+        name, typ, size, decimals = struct.unpack('<11sc4xBB14x', stream.read(32))
+        fields.append(DbfField(name.strip(b'\x00').decode(codec), typ.decode(codec), size, decimals))
+
+    terminator = stream.read(1)
+    if terminator != b'\r':
+        raise ValueError("Invalid DBF header: missing field terminator.")
+    # Skip any padding between the field descriptors and the first record
+    stream.read(lenheader - 33 - 32 * numfields)
+    return DbfHeader(numrec, lenheader, lenrecord, fields)
+
+
+def field_offsets(header: DbfHeader) -> dict:
+    """
+    Byte offset of every field inside a record; byte 0 is the deletion flag.
+    """
+    offsets = {}
+    offset = 1
+    for field in header.fields:
+        offsets[field.name] = offset
+        offset += field.size
+    return offsets
+
+
+def _blank(raw):
+    size = raw.dtype.itemsize
+    return (raw == b" " * size) | (raw == b"")
+
+
+def _decode_text(raw, codec):
+    # Report columns repeat heavily (scheme, folio, investor), so only the
+    # distinct values are stripped and decoded.
+    uniques, inverse = np.unique(raw, return_inverse=True)
+    decoded = np.empty(len(uniques), dtype=object)
+    decoded[:] = [value.strip().decode(codec, "replace") or None for value in uniques.tolist()]
+    return decoded[inverse.ravel()]
+
+
+def _decode_float(raw):
+    blank = _blank(raw)
+    try:
+        return np.where(blank, b"nan", raw).astype(np.float64)
+    except ValueError:
+        # Overflow markers such as "*****" become NaN
+        import pandas as pd
+        return pd.to_numeric(pd.Series(raw).str.decode("ascii").str.strip(), errors="coerce").to_numpy(np.float64)
+
+
+def _decode_integer(raw):
+    import pandas as pd
+    blank = _blank(raw)
+    try:
+        values = np.where(blank, b"0", raw).astype(np.int64)
+    except (ValueError, OverflowError):
+        return pd.array(pd.to_numeric(pd.Series(raw).str.decode("ascii").str.strip(), errors="coerce"), dtype="Int64")
+    return pd.arrays.IntegerArray(values, blank)
+
+
+def _decode_date(raw):
+    import pandas as pd
+    return pd.to_datetime(raw.astype("U8"), format="%Y%m%d", errors="coerce")
+
+
+def _decode_logical(raw):
+    import pandas as pd
+    values = pd.array([None] * len(raw), dtype="boolean")
+    values[np.isin(raw, [b"T", b"t", b"Y", b"y"])] = True
+    values[np.isin(raw, [b"F", b"f", b"N", b"n"])] = False
+    return values
+
+
+def decode_column(raw, field: DbfField, codec="utf-8"):
+    """
+    Convert the raw fixed-width bytes of one DBF column into a typed column.
+
+    C -> object strings (None when blank), N -> Int64 when the field has no
+    decimals and float64 otherwise, F -> float64, D -> datetime64, L -> boolean.
+    """
+    if field.type == "N" and field.decimals == 0:
+        return _decode_integer(raw)
+    if field.type in ("N", "F"):
+        return _decode_float(raw)
+    if field.type == "D":
+        return _decode_date(raw)
+    if field.type == "L":
+        return _decode_logical(raw)
+    return _decode_text(raw, codec)
+
+
+def _column_bytes(records, live, offset, size):
+    return np.ascontiguousarray(records[live, offset:offset + size]).view(f"S{size}").ravel()
+
+
+def decode_records(block: bytes, header: DbfHeader, columns=None, codec="utf-8") -> pd.DataFrame:
+    """
+    Decode a block of whole records into a DataFrame with only `columns`.
+    Deleted records are dropped.
+    """
+    import pandas as pd
+    # View the block as a (records x record length) byte matrix; each column is
+    # then a fixed-width slice that numpy reinterprets as an S<size> array.
+    count = len(block) // header.lenrecord
+    records = np.frombuffer(block, dtype=np.uint8, count=count * header.lenrecord).reshape(count, header.lenrecord)
+    live = records[:, 0] == ord(" ")
+    if live.all():
+        live = slice(None)
+    offsets = field_offsets(header)
+
+    fields = {field.name: field for field in header.fields}
+    columns = list(fields) if columns is None else list(columns)
+    missing = [column for column in columns if column not in fields]
+    if missing:
+        raise KeyError(f"DBF report has no columns {missing}.")
+    return pd.DataFrame(
+        {column: decode_column(_column_bytes(records, live, offsets[column], fields[column].size), fields[column], codec) for column in columns},
+        columns=columns,
+    )
+
+
+def read_dbf(stream, columns=None, codec="utf-8") -> pd.DataFrame:
+    """
+    Read a DBF file from a binary stream into typed columns.
+
+    Args:
+        stream: A readable binary file-like object positioned at the start of the DBF.
+        columns (list, optional): Only decode these columns, in this order.
+        codec (str): Encoding of the character fields.
+
+    Returns:
+        pd.DataFrame: The non-deleted records.
+    """
+    header = read_dbf_header(stream, codec)
+    block = stream.read(header.numrec * header.lenrecord)
+    return decode_records(block, header, columns, codec)
+
+
+def iter_dbf_batches(stream, batch_size=None, columns=None, codec="utf-8"):
+    """
+    Read a DBF file in fixed-size record batches.
+
+    Only one batch of raw records and its decoded DataFrame are held at a time,
+    so memory stays flat however large the report is.
+
+    Args:
+        stream: A readable binary file-like object positioned at the start of the DBF.
+        batch_size (int, optional): Records per batch; the whole file when not set.
+        columns (list, optional): Only decode these columns, in this order.
+        codec (str): Encoding of the character fields.
+
+    Yields:
+        pd.DataFrame: The non-deleted records of each batch.
+    """
+    header = read_dbf_header(stream, codec)
+    batch_size = batch_size or header.numrec
+    remaining = header.numrec
+    while remaining > 0:
+        count = min(batch_size, remaining)
+        block = stream.read(count * header.lenrecord)
+        if not block:
+            break
+        remaining -= count
+        yield decode_records(block, header, columns, codec)
+
+
+def find_dbf_member(z):
+    dbf_file = next((file for file in z.namelist() if file.lower().endswith('.dbf')), None)
+    if not dbf_file:
+        raise FileNotFoundError("No DBF file found in the ZIP archive.")
+    return dbf_file
+
+
+def archive_member(z, member, pwd, archive_dir):
+    """
+    Keep an extracted copy of `member` in `archive_dir`. The copy is written
+    under a temporary name and renamed, so concurrent runs never see a partial file.
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    target = os.path.join(archive_dir, os.path.basename(member))
+    partial = f"{target}.{os.getpid()}.part"
+    with z.open(member, pwd=pwd) as source, open(partial, "wb") as destination:
+        shutil.copyfileobj(source, destination)
+    os.replace(partial, target)
+    return target
+
+
+def read_dbf_from_zip(z, pwd, archive_dir=ARCHIVE_DIR, columns=None):
+    """
+    Parse the DBF report of an open AES ZIP archive straight from the decrypted stream.
+
+    Args:
+        z (pyzipper.AESZipFile): The open archive.
+        pwd (bytes): The archive password.
+        archive_dir (str, optional): Also keep an extracted copy of the report here.
+        columns (list, optional): Only decode these columns.
+
+    Returns:
+        pd.DataFrame: The DBF records as typed columns.
+    """
+    member = find_dbf_member(z)
+    if archive_dir:
+        archive_member(z, member, pwd, archive_dir)
+    with z.open(member, pwd=pwd) as stream:
+        return read_dbf(stream, columns=columns)
+
+
+def iter_dbf_batches_from_zip(z, pwd, batch_size=None, archive_dir=ARCHIVE_DIR, columns=None, wrap_stream=None):
+    """
+    Like `read_dbf_from_zip`, but yields the report in record batches of `batch_size`.
+    `wrap_stream`, when given, wraps the decrypted stream before it is parsed
+    (e.g. `metrics.TimedReader`).
+    """
+    member = find_dbf_member(z)
+    if archive_dir:
+        archive_member(z, member, pwd, archive_dir)
+    with z.open(member, pwd=pwd) as stream:
+        yield from iter_dbf_batches(wrap_stream(stream) if wrap_stream else stream, batch_size=batch_size, columns=columns)
@@ -0,0 +1,142 @@
+import hashlib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from tempfile import SpooledTemporaryFile
+from typing import Any, List, Optional
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from setup import log
+from metrics import INGEST_BYTES, record_stage
+
+DOWNLOAD_WORKERS = 4
+PER_HOST_LIMIT = 2
+DOWNLOAD_RETRIES = 3
+BACKOFF_SECONDS = 1.0
+CHUNK_SIZE = 64 * 1024
+SPOOL_MAX_SIZE = 32 * 1024 * 1024  # archives above this spill to disk
+TIMEOUT = (10, 120)  # (connect, read) seconds
+
+
+@dataclass
+class DownloadResult:
+    url: str
+    file: Optional[Any] = None
+    bytes: int = 0
+    sha256: Optional[str] = None
+    seconds: float = 0.0
+    attempts: int = 0
+    error: Optional[Exception] = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+_session = None
+_session_lock = threading.Lock()
+_host_limits = {}
+
+
+def get_session():
+    """
+    Return the process-wide keep-alive session shared by all downloads.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=DOWNLOAD_WORKERS, pool_maxsize=DOWNLOAD_WORKERS)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+        return _session
+
+
+def _host_limit(url):
+    host = urlparse(url).netloc
+    with _session_lock:
+        if host not in _host_limits:
+            _host_limits[host] = threading.BoundedSemaphore(PER_HOST_LIMIT)
+        return _host_limits[host]
+
+
+def _is_retryable(error):
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        return status == 429 or status >= 500
+    return isinstance(error, requests.exceptions.RequestException)
+
+
+def _stream_to_spool(session, url, verify):
+    spool = SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    digest = hashlib.sha256()
+    try:
+        with session.get(url, stream=True, verify=verify, timeout=TIMEOUT) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                spool.write(chunk)
+                digest.update(chunk)
+        size = spool.tell()
+        spool.seek(0)
+        return spool, size, digest.hexdigest()
+    except Exception:
+        spool.close()
+        raise
+
+
+def download(url, verify=True, session=None) -> DownloadResult:
+    """
+    Stream `url` into a spooled temporary file, retrying transient failures with
+    exponential backoff.
+
+    Args:
+        url (str): The URL to download.
+        verify (bool): Whether to verify the TLS certificate.
+        session (requests.Session, optional): Session to use instead of the shared one.
+
+    Returns:
+        DownloadResult: The open file positioned at the start, with the byte
+        count, SHA-256 and latency, or the last error when every attempt failed.
+    """
+    session = session or get_session()
+    result = DownloadResult(url=url)
+    start = time.perf_counter()
+    with _host_limit(url):
+        for attempt in range(1, DOWNLOAD_RETRIES + 2):
+            result.attempts = attempt
+            try:
+                result.file, result.bytes, result.sha256 = _stream_to_spool(session, url, verify)
+                result.error = None
+                break
+            except requests.exceptions.RequestException as e:
+                result.error = e
+                if attempt > DOWNLOAD_RETRIES or not _is_retryable(e):
+                    break
+                delay = BACKOFF_SECONDS * 2 ** (attempt - 1)
+                log.warning(f"Download of {url} failed ({e}), retrying in {delay:.1f}s ...")
+                time.sleep(delay)
+    result.seconds = time.perf_counter() - start
+    record_stage("download", result.seconds, failed=not result.ok, bytes=result.bytes, attempts=result.attempts)
+    INGEST_BYTES.inc(result.bytes, stage="download")
+
+    if result.ok:
+        log.info(f"Downloaded {result.bytes} bytes in {result.seconds:.2f}s. URL = {url}", extra={"bytes": result.bytes, "duration_ms": round(result.seconds * 1000, 1)})
+    else:
+        log.error(f"Error downloading {url} after {result.attempts} attempts: {result.error}")
+    return result
+
+
+def download_all(urls, workers=DOWNLOAD_WORKERS, verify=True) -> List[DownloadResult]:
+    """
+    Download several URLs concurrently over the shared session.
+
+    Returns:
+        list: One DownloadResult per URL, in the order of `urls`.
+    """
+    if not urls:
+        return []
+    with ThreadPoolExecutor(max_workers=min(workers, len(urls))) as executor:
+        return list(executor.map(lambda url: download(url, verify=verify), urls))
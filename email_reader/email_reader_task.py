@@ -2,24 +2,42 @@ from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
+import httplib2
 import base64
-from email import message_from_bytes, message_from_string
+from email.utils import parseaddr
 from datetime import datetime, timedelta
 import os
-from bs4 import BeautifulSoup
+from typing import TYPE_CHECKING
 import requests
-import zipfile
-import os
-import pandas as pd
-from io import BytesIO
-from simpledbf import Dbf5
-import pyzipper 
+from dbf_reader import read_dbf_from_zip, ARCHIVE_DIR
+from googleapiclient.errors import HttpError
 from setup import log
+from checkpoint import get_checkpoint, advance_checkpoint
+from downloader import download, download_all
+
+# bs4, pyzipper and pandas are imported where they are used, so a run
+# without new reports never loads them
+if TYPE_CHECKING:
+    import pandas as pd
+    from bs4 import BeautifulSoup
 
 
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
+# Point at a local fake discovery service to run this reader without Google, e.g. in tests
+GMAIL_DISCOVERY_URL = os.environ.get("GMAIL_DISCOVERY_URL")
+# Gmail accepts up to 100 calls per batch request
+BATCH_SIZE = 100
+LIST_PAGE_SIZE = 500
+# Exactly what get_email_contents reads: headers, the MIME tree three levels
+# deep and part bodies. A mask cannot pick parts by type, so the bodies of the
+# other leaf parts (e.g. text/plain) are still sent; only text/html is decoded.
+_PART_FIELDS = "mimeType,body(data,attachmentId)"
+MESSAGE_FIELDS = f"id,payload(headers(name,value),{_PART_FIELDS},parts({_PART_FIELDS},parts({_PART_FIELDS},parts({_PART_FIELDS}))))"
 
 def authenticate_gmail():
+    if GMAIL_DISCOVERY_URL:
+        log.info(f"Using the Gmail discovery service at {GMAIL_DISCOVERY_URL} ... ")
+        return build('gmail', 'v1', http=httplib2.Http(), discoveryServiceUrl=GMAIL_DISCOVERY_URL, static_discovery=False)
     log.info("Authenticating with google ... ")
     creds = None
     if os.path.exists('token.json'):
@@ -41,92 +59,254 @@ def search_emails(service, sender_email, start_date, end_date):
     
     query = f'from:{sender_email} after:{start_date[:10]} before:{end_date[:10]}'
 
-    results = service.users().messages().list(userId='me', q=query).execute()
-    messages = results.get('messages', [])
+    messages = []
+    page_token = None
+    while True:
+        results = service.users().messages().list(
+            userId='me', q=query, maxResults=LIST_PAGE_SIZE, pageToken=page_token
+        ).execute()
+        messages.extend(results.get('messages', []))
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            break
     return messages
 
-def get_email_content(service, message_id):
-    message = service.users().messages().get(userId='me', id=message_id, format='raw').execute()
-    msg_str = base64.urlsafe_b64decode(message['raw']).decode('utf-8')
-    mime_msg = message_from_string(msg_str)
-
-    subject = mime_msg['Subject']
-    from_email = mime_msg['From']
-    body = None
-
-    if mime_msg.is_multipart():
-        for part in mime_msg.walk():
-            if part.get_content_type() == 'text/html':
-                body = part.get_payload(decode=True).decode('utf-8')
-    else:
-        body = mime_msg.get_payload(decode=True).decode('utf-8')
+def list_new_message_ids(service, start_history_id, label_id='INBOX'):
+    """
+    Return the ids of the messages added to `label_id` since `start_history_id`,
+    or None when Gmail no longer has history that old and a full search is needed.
+    """
+    log.info(f"Listing messages added since historyId {start_history_id}")
+    message_ids = []
+    page_token = None
+    try:
+        while True:
+            response = service.users().history().list(
+                userId='me',
+                startHistoryId=start_history_id,
+                historyTypes=['messageAdded'],
+                labelId=label_id,
+                pageToken=page_token,
+            ).execute()
+            for history in response.get('history', []):
+                for added in history.get('messagesAdded', []):
+                    message_ids.append(added['message']['id'])
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                break
+    except HttpError as e:
+        if e.resp.status == 404:
+            log.warning(f"historyId {start_history_id} has expired, falling back to a date search.")
+            return None
+        raise
+    return list(dict.fromkeys(message_ids))
+
+def batch_execute(service, requests_by_id):
+    """
+    Run several Gmail API calls through batch requests of up to BATCH_SIZE calls each.
+
+    Args:
+        requests_by_id (dict): Request id -> unexecuted API request.
+
+    Returns:
+        dict: Request id -> response, for the calls that succeeded.
+    """
+    responses = {}
+
+    def collect(request_id, response, exception):
+        if exception is not None:
+            log.error(f"Gmail batch call {request_id} failed: {exception}")
+        else:
+            responses[request_id] = response
+
+    items = list(requests_by_id.items())
+    for i in range(0, len(items), BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=collect)
+        for request_id, request in items[i:i + BATCH_SIZE]:
+            batch.add(request, request_id=request_id)
+        batch.execute()
+    return responses
+
+def _headers(payload):
+    return {header['name'].lower(): header['value'] for header in payload.get('headers', [])}
+
+def filter_messages_by_sender(service, message_ids, sender_email):
+    responses = batch_execute(service, {
+        message_id: service.users().messages().get(
+            userId='me', id=message_id, format='metadata', metadataHeaders=['From'], fields='id,payload/headers'
+        )
+        for message_id in message_ids
+    })
+    messages = []
+    for message_id in message_ids:
+        message = responses.get(message_id)
+        if message and parseaddr(_headers(message['payload']).get('from', ''))[1].lower() == sender_email.lower():
+            messages.append({'id': message_id})
+    return messages
+
+def _html_part(payload):
+    if payload.get('mimeType') == 'text/html':
+        return payload
+    for part in payload.get('parts', []):
+        html_part = _html_part(part)
+        if html_part is not None:
+            return html_part
+    return None
 
-    return {
-        "subject": subject,
-        "from": from_email,
-        "body": body,
-    }
+def _decode_body(data):
+    return base64.urlsafe_b64decode(data).decode('utf-8')
 
-def process_zip_file(url, password):
+def get_email_contents(service, message_ids):
+    """
+    Fetch the subject, sender and HTML body of several messages with batch requests.
+
+    Only the headers, the MIME structure and the part bodies are requested
+    (see MESSAGE_FIELDS), and only the text/html part is decoded; the raw
+    message is never downloaded.
+
+    Returns:
+        dict: Message id -> {"subject", "from", "body"}, for the messages that could be fetched.
+    """
+    responses = batch_execute(service, {
+        message_id: service.users().messages().get(userId='me', id=message_id, format='full', fields=MESSAGE_FIELDS)
+        for message_id in message_ids
+    })
+    email_contents = {}
+    for message_id, message in responses.items():
+        payload = message['payload']
+        headers = _headers(payload)
+        # A single-part message has no parts; its own body is the content
+        part = _html_part(payload) if payload.get('parts') else payload
+        body = None
+        if part is not None:
+            data = part.get('body', {}).get('data')
+            if data is None and part.get('body', {}).get('attachmentId'):
+                # Large parts are not inlined and have to be fetched separately
+                data = service.users().messages().attachments().get(
+                    userId='me', messageId=message_id, id=part['body']['attachmentId']
+                ).execute()['data']
+            if data is not None:
+                body = _decode_body(data)
+        email_contents[message_id] = {
+            "subject": headers.get('subject'),
+            "from": headers.get('from'),
+            "body": body,
+        }
+    return email_contents
+
+def get_email_content(service, message_id):
+    return get_email_contents(service, [message_id]).get(message_id)
+
+def process_zip_file(url, password, zip_file=None, archive_dir=ARCHIVE_DIR, columns=None) -> "pd.DataFrame":
+    import pyzipper
+    downloaded = zip_file is None
     try:
-        log.info(f"Downloading Zip file. URL = {url}")
-        response = requests.get(url)
-        response.raise_for_status()
-        zip_file = BytesIO(response.content)
+        if downloaded:
+            log.info(f"Downloading Zip file. URL = {url}")
+            result = download(url)
+            if not result.ok:
+                return None
+            zip_file = result.file
         with pyzipper.AESZipFile(zip_file, 'r') as z:
-            log.info(f"Extracting file from zip ...")
+            log.info(f"Reading the DBF report from the zip ...")
             password_bytes = password.encode('utf-8')
-            z.extractall("extracted_files", pwd=password_bytes)
-            extracted_files = z.namelist()
-        dbf_file = next((file for file in extracted_files if file.endswith('.dbf')), None)
-        if not dbf_file:
-            raise FileNotFoundError("No DBF file found in the zip archive.")
-        
-        dbf_path = os.path.join("extracted_files", dbf_file)
-        dbf = Dbf5(dbf_path)
-        df = dbf.to_dataframe()
-        df = df.astype(str).where(df.notnull(), None)
+            df = read_dbf_from_zip(z, password_bytes, archive_dir=archive_dir, columns=columns)
         log.info("Successfully parsed the DBF file.")
         return df
 
     except requests.exceptions.RequestException as e:
         log.error(f"Error downloading the zip file: {e}")
-    except zipfile.BadZipFile as e:
+    except pyzipper.BadZipFile as e:
         log.error(f"Error extracting the zip file: {e}")
     except Exception as e:
         log.error(f"An unexpected error occurred: {e}")
+    finally:
+        if downloaded and zip_file is not None:
+            zip_file.close()
 
-def process_cams_data(soup: BeautifulSoup):
+def cams_report_link(soup: "BeautifulSoup"):
     url = soup.find_all('td')[3].a['href']
     report_no = soup.find_all('td')[8].find_all('td')[1].get_text(strip=True)
+    return url, report_no
+
+def karvy_report_link(soup: "BeautifulSoup"):
+    return soup.find('a', string=lambda text: text and "Click Here" in text).get('href')
+
+def process_cams_data(soup: "BeautifulSoup", zip_file=None):
+    import pandas as pd
+    df = pd.DataFrame()
+    url, report_no = cams_report_link(soup)
     if report_no == "WBR2":
-        df = process_zip_file(url, password='123456')
+        df = process_zip_file(url, password='123456', zip_file=zip_file)
         # df.to_sql('transactions', con=engine, if_exists='append', index=False)
     elif report_no == "WBR9":
-        df = process_zip_file(url, password='123456')
+        df = process_zip_file(url, password='123456', zip_file=zip_file)
         # df.to_sql('transactions', con=engine, if_exists='append', index=False)
     return df
 
-def process_karvy_data(soup: BeautifulSoup):
-    url = soup.find('a', string=lambda text: text and "Click Here" in text).get('href')
-    df = process_zip_file(url, password='kfin123456')
+def process_karvy_data(soup: "BeautifulSoup", zip_file=None):
+    url = karvy_report_link(soup)
+    df = process_zip_file(url, password='kfin123456', zip_file=zip_file)
     return df
 
-def task():
+def task(label_id='INBOX'):
     service = authenticate_gmail()
+    profile = service.users().getProfile(userId='me').execute()
+    mailbox = profile['emailAddress']
+    folder = f"gmail-api/{label_id}"
+    # Read before listing so messages that arrive during the run are picked up next time
+    current_history_id = int(profile['historyId'])
+
+    checkpoint = get_checkpoint(mailbox, folder)
+    new_message_ids = None
+    if checkpoint and checkpoint.HISTORY_ID:
+        new_message_ids = list_new_message_ids(service, checkpoint.HISTORY_ID, label_id)
+
+    # The date window is only used until the first checkpoint is written
     end_date = (datetime.now() + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
     start_date = end_date - timedelta(days=1)
+    failed_ids = []
     sender_emails = ['donotreply@camsonline.com', 'distributorcare@kfintech.com']
     for i, sender_email in enumerate(sender_emails):
-        messages = search_emails(service, sender_email, start_date, end_date)
+        if new_message_ids is None:
+            messages = search_emails(service, sender_email, start_date, end_date)
+        else:
+            messages = filter_messages_by_sender(service, new_message_ids, sender_email)
+        email_contents = get_email_contents(service, [msg['id'] for msg in messages])
+        jobs = []
         for msg in messages:
-            email_content = get_email_content(service, msg['id'])
-            log.info(f"Found: {email_content['subject']}")
-            body = email_content['body']
-            soup = BeautifulSoup(body, 'html.parser')
-            if i == 0:
-                process_cams_data(soup)
-            elif i == 1:
-                process_karvy_data(soup)
-
-task()
\ No newline at end of file
+            from bs4 import BeautifulSoup
+            try:
+                email_content = email_contents[msg['id']]
+                log.info(f"Found: {email_content['subject']}")
+                soup = BeautifulSoup(email_content['body'], 'html.parser')
+                url = cams_report_link(soup)[0] if i == 0 else karvy_report_link(soup)
+                jobs.append((msg, soup, url))
+            except Exception as e:
+                log.error(f"Error reading message {msg['id']}: {e}")
+                failed_ids.append(msg['id'])
+
+        # Download every archive concurrently, then process them in order
+        downloads = download_all([url for _, _, url in jobs])
+        for (msg, soup, url), downloaded in zip(jobs, downloads):
+            df = None
+            if downloaded.ok:
+                try:
+                    if i == 0:
+                        df = process_cams_data(soup, zip_file=downloaded.file)
+                    elif i == 1:
+                        df = process_karvy_data(soup, zip_file=downloaded.file)
+                except Exception as e:
+                    log.error(f"Error processing message {msg['id']}: {e}")
+                finally:
+                    downloaded.file.close()
+            if df is None:
+                failed_ids.append(msg['id'])
+
+    if failed_ids:
+        log.warning(f"{len(failed_ids)} messages failed, keeping the checkpoint so they are retried: {failed_ids}")
+    else:
+        advance_checkpoint(mailbox, folder, history_id=current_history_id)
+
+if __name__ == "__main__":
+    task()
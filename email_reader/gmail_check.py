@@ -0,0 +1,133 @@
+import argparse
+import math
+import random
+import sys
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+
+# Runs the Gmail API reader of email_reader_task against
+# synthetic_reports.FakeGmailServer, a local fake of the discovery service and
+# the API, and checks paging, batching, the history path and that only the
+# masked fields are requested. No Google account or database is needed.
+#
+#   python gmail_check.py [--cams 230] [--karvy 20] [--page-size 100]
+
+
+def other_email(number):
+    message = EmailMessage()
+    message["From"] = "Newsletter <news@example.com>"
+    message["Subject"] = f"Newsletter {number}"
+    message.set_content("Nothing to ingest.")
+    return message.as_bytes()
+
+
+def html_body(raw):
+    from email import message_from_bytes
+    for part in message_from_bytes(raw).walk():
+        if part.get_content_type() == "text/html":
+            return part.get_payload(decode=True).decode("utf-8")
+    return None
+
+
+def build_mailbox(cams, karvy, others):
+    """
+    Raw messages, senders interleaved, with their expected sender and HTML body.
+
+    Returns:
+        list: (raw bytes, sender or None, HTML body) per message.
+    """
+    from synthetic_reports import CAMS_SENDER, KARVY_SENDER, cams_email, karvy_email
+    senders = [CAMS_SENDER] * cams + [KARVY_SENDER] * karvy + [None] * others
+    # Mix the KFintech and other mail in among the CAMS mail
+    random.Random(0).shuffle(senders)
+    messages = []
+    for number, sender in enumerate(senders):
+        url = f"http://reports.example.com/{number}.zip"
+        if sender == CAMS_SENDER:
+            raw = cams_email("WBR2" if number % 2 else "WBR9", url)
+        elif sender == KARVY_SENDER:
+            raw = karvy_email(url)
+        else:
+            raw = other_email(number)
+        messages.append((raw, sender, html_body(raw)))
+    return messages
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check the Gmail API reader against a local fake Gmail service.")
+    parser.add_argument("--cams", type=int, default=230, help="CAMS emails in the mailbox")
+    parser.add_argument("--karvy", type=int, default=20, help="KFintech emails in the mailbox")
+    parser.add_argument("--others", type=int, default=5, help="Emails from other senders")
+    parser.add_argument("--page-size", type=int, default=100, help="Messages per list page the fake returns")
+    args = parser.parse_args(argv)
+
+    import email_reader_task
+    from synthetic_reports import CAMS_SENDER, KARVY_SENDER, FakeGmailServer, cams_email
+
+    messages = build_mailbox(args.cams, args.karvy, args.others)
+    results = []
+
+    def check(name, passed, details):
+        results.append(passed)
+        print(f"{'OK  ' if passed else 'FAIL'} {name}: {details}")
+
+    with FakeGmailServer([raw for raw, _, _ in messages], page_size=args.page_size) as gmail:
+        ids = list(gmail.messages)
+        # One message whose parts are too large to inline, so its body is fetched as an attachment
+        large = cams_email("WBR2", "http://reports.example.com/large.zip")
+        ids.append(gmail.add_message(large, inline_limit=64))
+        messages.append((large, CAMS_SENDER, html_body(large)))
+        expected = dict(zip(ids, messages))
+
+        email_reader_task.GMAIL_DISCOVERY_URL = gmail.discovery_url
+        service = email_reader_task.authenticate_gmail()
+        now = datetime.now()
+
+        cams_ids = [message_id for message_id in ids if expected[message_id][1] == CAMS_SENDER]
+        found = [message["id"] for message in email_reader_task.search_emails(service, CAMS_SENDER, now - timedelta(days=1), now)]
+        pages = gmail.stats["calls"].get("messages.list", 0)
+        check(
+            "search follows nextPageToken",
+            found == cams_ids and pages == math.ceil(len(cams_ids) / args.page_size),
+            f"{len(found)} of {len(cams_ids)} CAMS messages in {pages} pages",
+        )
+
+        batches = gmail.stats["batch_requests"]
+        contents = email_reader_task.get_email_contents(service, found)
+        batches = gmail.stats["batch_requests"] - batches
+        wrong = [message_id for message_id in found if (contents.get(message_id) or {}).get("body") != expected[message_id][2]]
+        check(
+            "message bodies come through batch requests",
+            not wrong and batches == math.ceil(len(found) / email_reader_task.BATCH_SIZE),
+            f"{len(found) - len(wrong)} of {len(found)} HTML bodies in {batches} batch requests",
+        )
+        attachments = gmail.stats["calls"].get("attachments.get", 0)
+        check("large parts are fetched as attachments", attachments == 1, f"{attachments} attachment fetches")
+        formats = sorted(call for call in gmail.stats["calls"] if call.startswith("messages.get:"))
+        masks = set(gmail.stats["fields"])
+        check(
+            "only masked fields are requested",
+            formats == ["messages.get:full"] and masks == {email_reader_task.MESSAGE_FIELDS},
+            f"formats {', '.join(formats)}; masks {', '.join(sorted(masks))}",
+        )
+
+        # As if the previous run stopped after the first half of the mailbox
+        start = gmail.first_history_id + len(ids) // 2
+        new_ids = email_reader_task.list_new_message_ids(service, start)
+        check(
+            "history lists the messages added since the checkpoint",
+            new_ids == ids[len(ids) // 2:],
+            f"{len(new_ids or [])} of {len(ids) - len(ids) // 2} new messages",
+        )
+        karvy_ids = [message["id"] for message in email_reader_task.filter_messages_by_sender(service, new_ids or [], KARVY_SENDER)]
+        expected_karvy = [message_id for message_id in new_ids or [] if expected[message_id][1] == KARVY_SENDER]
+        check("new messages are filtered by sender", karvy_ids == expected_karvy, f"{len(karvy_ids)} KFintech messages")
+        expired = email_reader_task.list_new_message_ids(service, gmail.first_history_id - 1)
+        check("expired history falls back to a search", expired is None, f"returned {expired!r}")
+
+    print(f"{gmail.stats['http_requests']} HTTP requests, {gmail.stats['batch_requests']} of them batches.")
+    return 0 if all(results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,20 +1,36 @@
 import imaplib
 import email
+import email.utils
 from email.header import decode_header
 import re
-from bs4 import BeautifulSoup
+import multiprocessing
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from tempfile import TemporaryDirectory
+from typing import TYPE_CHECKING, Optional
 import requests
-import pandas as pd
-from io import BytesIO
-from simpledbf import Dbf5
+from dbf_reader import read_dbf_from_zip, iter_dbf_batches_from_zip, ARCHIVE_DIR, INGEST_BATCH_SIZE
 import os
-import pyzipper
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from setup import log
-from db_connection import engine
 from credentials import IMAP_SERVER, EMAIL, PASSWORD, PORT
 from models import CamsWBR2, CamsWBR9
-from repository import GenericRepository
+from bulk_loader import bulk_upsert_dataframe, bulk_upsert_batches, bulk_upsert_csv, write_csv
+from downloader import download
+from checkpoint import get_checkpoint, advance_checkpoint, processed_watermark
+from ingest_ledger import file_sha256, dbf_sha256, find_ingested, record_ingest
+from summary import refresh_touched_summaries
+from data_version import bump_data_versions
+from pipeline import PipelineConfig, Stage, run_pipeline, format_stats
+from metrics import INGEST_BYTES, INGEST_ROWS, INGEST_STAGE_ERRORS, REPORT_ROWS, TimedReader, record_stage, stage_timer, trace, write_textfile
+
+# bs4, pyzipper and pandas (through dbf_reader) are imported where they are
+# used, so a run without new reports never loads them
+if TYPE_CHECKING:
+    import pandas as pd
+    from bs4 import BeautifulSoup
 
 def authenticate_imap():
     log.info("Authenticating with Gmail IMAP...")
@@ -22,55 +38,138 @@ def authenticate_imap():
     mail.login(EMAIL, PASSWORD)
     return mail
 
-def search_emails_imap(mail, sender_emails, start_date, end_date):
-    log.info(f"Searching emails from {sender_emails} between {start_date} and {end_date}...")
-    mail.select("inbox")
-    
-    # Format date for IMAP
-    start_date = start_date.strftime('%d-%b-%Y')
-    end_date = end_date.strftime('%d-%b-%Y')
-    
-    # Search emails by date range
-    status, messages = mail.search(
-        None,
-        f'(SINCE "{start_date}" BEFORE "{end_date}")'
-    )
+FETCH_BATCH_SIZE = 20
+HEADER_FIELDS = "BODY.PEEK[HEADER.FIELDS (FROM SUBJECT DATE)]"
+
+def _imap_or(criteria):
+    # IMAP OR is binary: OR a OR b c
+    if len(criteria) == 1:
+        return criteria[0]
+    return f"OR {criteria[0]} {_imap_or(criteria[1:])}"
+
+def _imap_quote(value):
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+def build_search_criteria(sender_emails, start_date=None, end_date=None, subject=None, min_uid=None):
+    """
+    Build an IMAP SEARCH query so the server does the sender/subject/date filtering.
+
+    Args:
+        sender_emails (str | list): Sender address or addresses to match.
+        start_date (datetime, optional): Inclusive start of the window.
+        end_date (datetime, optional): Exclusive end of the window.
+        subject (str, optional): Substring the subject must contain.
+        min_uid (int, optional): Only match messages with a UID of at least this value.
+    """
+    if isinstance(sender_emails, str):
+        sender_emails = [sender_emails]
+    criteria = []
+    if min_uid:
+        criteria.append(f"UID {min_uid}:*")
+    if start_date:
+        criteria.append(f'SINCE "{start_date.strftime("%d-%b-%Y")}"')
+    if end_date:
+        criteria.append(f'BEFORE "{end_date.strftime("%d-%b-%Y")}"')
+    criteria.append(_imap_or([f"FROM {_imap_quote(sender)}" for sender in sender_emails]))
+    if subject:
+        criteria.append(f"SUBJECT {_imap_quote(subject)}")
+    return "(" + " ".join(criteria) + ")"
+
+def _batches(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def _fetch_uids(mail, uids, message_parts):
+    """
+    Fetch several UIDs with a single UID FETCH command per batch.
+
+    Yields (uid, payload) pairs for every message the server returned.
+    """
+    for batch in _batches(uids, FETCH_BATCH_SIZE):
+        uid_set = b",".join(uid if isinstance(uid, bytes) else str(uid).encode() for uid in batch)
+        with stage_timer("fetch", messages=len(batch)) as span:
+            status, data = mail.uid("FETCH", uid_set, message_parts)
+            span["bytes"] = sum(len(item[1]) for item in data if isinstance(item, tuple))
+        INGEST_BYTES.inc(span["bytes"], stage="fetch")
+        if status != "OK":
+            INGEST_STAGE_ERRORS.inc(stage="fetch")
+            log.warning(f"Failed to fetch messages {uid_set}.")
+            continue
+        for item in data:
+            if not isinstance(item, tuple):
+                continue
+            match = re.search(rb"UID (\d+)", item[0])
+            if match:
+                yield int(match.group(1)), item[1]
+
+def _decode_subject(raw_subject):
+    if raw_subject is None:
+        return ""
+    subject, encoding = decode_header(raw_subject)[0]
+    if isinstance(subject, bytes):
+        subject = subject.decode(encoding or "utf-8", errors="ignore")
+    return subject
+
+def _response_int(mail, code):
+    _, data = mail.response(code)
+    return int(data[0]) if data and data[0] else None
+
+def select_mailbox(mail, folder="inbox"):
+    """
+    Select `folder` read-only and return its (UIDVALIDITY, UIDNEXT).
+    """
+    status, _ = mail.select(folder, readonly=True)
+    if status != "OK":
+        raise imaplib.IMAP4.error(f"Failed to select {folder}.")
+    return _response_int(mail, "UIDVALIDITY"), _response_int(mail, "UIDNEXT")
+
+def search_emails_imap(mail, sender_emails, start_date=None, end_date=None, subject=None, min_uid=None):
+    """
+    Find the UIDs of the messages sent by `sender_emails` in the selected folder.
+
+    The sender, subject, date and UID filters are pushed into the IMAP SEARCH.
+    Only the From/Subject/Date headers of the candidates are downloaded to
+    confirm the sender, never the message bodies. The folder must already be
+    selected with `select_mailbox`.
+    """
+    if min_uid:
+        log.info(f"Searching emails from {sender_emails} with UID >= {min_uid}...")
+    else:
+        log.info(f"Searching emails from {sender_emails} between {start_date} and {end_date}...")
+    if isinstance(sender_emails, str):
+        sender_emails = [sender_emails]
+
+    with stage_timer("search"):
+        status, messages = mail.uid("SEARCH", None, build_search_criteria(sender_emails, start_date, end_date, subject, min_uid))
     if status != "OK":
+        INGEST_STAGE_ERRORS.inc(stage="search")
         log.error("Failed to fetch emails.")
         return []
-    
-    # Filter messages containing any of the sender emails
-    message_ids = messages[0].split()
-    matching_emails = []
-    if not message_ids:
+
+    uids = messages[0].split()
+    if min_uid:
+        # "n:*" always matches the newest message, even when its UID is below n
+        uids = [uid for uid in uids if int(uid) >= min_uid]
+    if not uids:
         log.info("No emails found.")
-    for msg_id in message_ids:
-        status, msg_data = mail.fetch(msg_id, '(RFC822)')
-        if status != "OK":
-            log.warning(f"Failed to fetch message {msg_id}.")
-            continue
-        
-        # Extract the email content
-        raw_email = msg_data[0][1]
-        email_content = raw_email.decode(errors='ignore').lower()
-        
-        # Check if any sender email is in the content
-        if any(sender_email.lower() in email_content for sender_email in sender_emails):
-            matching_emails.append(msg_id)
-    
-    return matching_emails
+        return []
 
-def get_email_content_imap(mail, msg_id):
-    status, data = mail.fetch(msg_id, "(RFC822)")
-    if status != "OK":
-        log.error(f"Failed to fetch email with ID {msg_id}.")
-        return None
+    # IMAP FROM is a substring match, so confirm the actual sender address from the headers
+    senders = {sender_email.lower() for sender_email in sender_emails}
+    matching_emails = []
+    for uid, raw_headers in _fetch_uids(mail, uids, f"(UID {HEADER_FIELDS})"):
+        headers = email.message_from_bytes(raw_headers)
+        from_address = email.utils.parseaddr(headers.get("From", ""))[1].lower()
+        if from_address in senders:
+            matching_emails.append(uid)
+        else:
+            log.info(f"Skipping message {uid} from {from_address}.")
+
+    return matching_emails
 
-    raw_email = data[0][1]
+def _parse_email(raw_email):
     msg = email.message_from_bytes(raw_email)
-    subject = decode_header(msg["Subject"])[0][0]
-    if isinstance(subject, bytes):
-        subject = subject.decode()
+    subject = _decode_subject(msg["Subject"])
     from_email = msg.get("From")
     body = None
 
@@ -88,27 +187,52 @@ def get_email_content_imap(mail, msg_id):
         "body": body,
     }
 
-def process_zip_file(url, password) -> pd.DataFrame:
+def iter_emails_imap(mail, uids):
+    """
+    Download each of the given messages exactly once, batching the UIDs into
+    as few FETCH commands as possible. BODY.PEEK leaves the messages unread.
+    Messages are yielded as soon as their batch arrives.
+    """
+    for uid, raw_email in _fetch_uids(mail, uids, "(UID BODY.PEEK[])"):
+        email_content = _parse_email(raw_email)
+        email_content["uid"] = uid
+        yield email_content
+
+def fetch_emails_imap(mail, uids):
+    return list(iter_emails_imap(mail, uids))
+
+def get_email_content_imap(mail, msg_id):
+    email_contents = fetch_emails_imap(mail, [msg_id])
+    if not email_contents:
+        log.error(f"Failed to fetch email with ID {msg_id}.")
+        return None
+    return email_contents[0]
+
+def process_zip_file(url, password, zip_file=None, archive_dir=ARCHIVE_DIR, columns=None) -> "pd.DataFrame":
+    """
+    Extract and parse the DBF report of a ZIP archive.
+
+    Args:
+        url (str): Where the archive is downloaded from when `zip_file` is not given.
+        password (str): The archive password.
+        zip_file (file, optional): An already downloaded archive, see `downloader.download_all`.
+        archive_dir (str, optional): Keep an extracted copy of the report in this directory.
+        columns (list, optional): Only read these DBF columns.
+    """
+    import pyzipper
+    downloaded = zip_file is None
     try:
-        log.info(f"Downloading ZIP file. URL = {url}")
-        response = requests.get(url, verify=False)
-        response.raise_for_status()
-        zip_file = BytesIO(response.content)
-        
+        if downloaded:
+            log.info(f"Downloading ZIP file. URL = {url}")
+            result = download(url, verify=False)
+            if not result.ok:
+                return None
+            zip_file = result.file
+
         with pyzipper.AESZipFile(zip_file, 'r') as z:
-            log.info("Extracting files from ZIP...")
+            log.info("Reading the DBF report from the ZIP...")
             password_bytes = password.encode('utf-8')
-            z.extractall("extracted_files", pwd=password_bytes)
-            extracted_files = z.namelist()
-        
-        dbf_file = next((file for file in extracted_files if file.endswith('.dbf')), None)
-        if not dbf_file:
-            raise FileNotFoundError("No DBF file found in the ZIP archive.")
-        
-        dbf_path = os.path.join("extracted_files", dbf_file)
-        dbf = Dbf5(dbf_path)
-        df = dbf.to_dataframe()
-        df = df.astype(str).where(df.notnull(), None)
+            df = read_dbf_from_zip(z, password_bytes, archive_dir=archive_dir, columns=columns)
         log.info("Successfully parsed the DBF file.")
         return df
 
@@ -118,91 +242,385 @@ def process_zip_file(url, password) -> pd.DataFrame:
         log.error(f"Error extracting ZIP file: {e}")
     except Exception as e:
         log.error(f"An unexpected error occurred: {e}")
+    finally:
+        if downloaded and zip_file is not None:
+            zip_file.close()
 
 
 def save_dataframe_to_db(df, model_class):
     """
-    Save a DataFrame to a database table using the GenericRepository.
+    Save a DataFrame to a database table with a set-based bulk upsert.
 
     Args:
         df (pd.DataFrame): The DataFrame to save.
         model_class: The SQLAlchemy model class corresponding to the table.
-        repository (GenericRepository): An instance of the GenericRepository.
     """
-    
-    repository = GenericRepository()
     if df.empty:
         log.warning("The DataFrame is empty. Nothing to save.")
+        return {"staged": 0, "inserted": 0, "updated": 0, "unchanged": 0, "rejected": 0}
+
+    counts = bulk_upsert_dataframe(df, model_class)
+    if counts is None:
         return
+    log.info(
+        f"Saved {len(df)} records to the {model_class.__tablename__} table: "
+        f"{counts['inserted']} inserted, {counts['updated']} updated, "
+        f"{counts['unchanged']} unchanged, {counts['rejected']} rejected."
+    )
+    return counts
 
+
+def process_zip_batches(url, password, zip_file=None, archive_dir=ARCHIVE_DIR, columns=None, batch_size=INGEST_BATCH_SIZE):
+    """
+    Like `process_zip_file`, but yields the DBF report in batches of `batch_size`
+    records so only one batch is in memory at a time.
+
+    Errors are raised rather than logged, so a consumer such as
+    `save_batches_to_db` can roll back the rows it already staged.
+    """
+    import pyzipper
+    downloaded = zip_file is None
     try:
-        # Convert DataFrame rows to a list of model instances
-        records = [
-            model_class(**row) for row in df.to_dict(orient="records")
-        ]
+        if downloaded:
+            log.info(f"Downloading ZIP file. URL = {url}")
+            result = download(url, verify=False)
+            if not result.ok:
+                raise result.error
+            zip_file = result.file
 
-        for record in records:
-            repository.add_or_update(record)
-        
-        log.info(f"Successfully saved {len(records)} records to the {model_class.__tablename__} table.")
+        with pyzipper.AESZipFile(zip_file, 'r') as z:
+            log.info(f"Reading the DBF report from the ZIP in batches of {batch_size or 'all'} records...")
+            password_bytes = password.encode('utf-8')
+            yield from iter_dbf_batches_from_zip(z, password_bytes, batch_size=batch_size, archive_dir=archive_dir, columns=columns)
+        log.info("Successfully parsed the DBF file.")
+    finally:
+        if downloaded and zip_file is not None:
+            zip_file.close()
 
-    except Exception as e:
-        log.error(f"Error saving DataFrame to {model_class.__tablename__}: {e}")
+
+def save_batches_to_db(batches, model_class, on_merged=None):
+    """
+    Stream DataFrame batches into a database table and merge them in one transaction.
+
+    Args:
+        batches: Iterable of DataFrames, e.g. from `process_zip_batches`.
+        model_class: The SQLAlchemy model class corresponding to the table.
+        on_merged (callable, optional): See `bulk_loader.bulk_upsert_batches`.
+    """
+    counts = bulk_upsert_batches(batches, model_class, on_merged=on_merged)
+    if counts is None:
+        return
+    log.info(
+        f"Saved {counts['staged']} records to the {model_class.__tablename__} table: "
+        f"{counts['inserted']} inserted, {counts['updated']} updated, "
+        f"{counts['unchanged']} unchanged, {counts['rejected']} rejected."
+    )
+    return counts
 
 
+CAMS_REPORTS = {"WBR2": CamsWBR2, "WBR9": CamsWBR9}
+CAMS_LOAD_ORDER = ["WBR9", "WBR2"]
+CAMS_ZIP_PASSWORD = '123456'
+KARVY_ZIP_PASSWORD = 'kfin123456'
 
-def process_cams_data(soup: BeautifulSoup):
+def cams_report_link(soup: "BeautifulSoup"):
+    """
+    Return the (download URL, report number) announced in a CAMS email.
+    """
     url = soup.find_all('td')[3].a['href']
     report_no = next((tr.find_all('td')[1].get_text(strip=True) for tr in soup.find_all('tr') if tr.find('td') and tr.find('td').get_text(strip=True).lower().startswith("report no")), None)
-    if report_no == "WBR2":
-        df = process_zip_file(url, password='123456')
-        column_names = [column.name for column in CamsWBR2.__table__.columns]
-        df = df[column_names]
-        log.info("Saving Cams WBR2 entries ...")
-        save_dataframe_to_db(df = df, model_class=CamsWBR2)
-        log.info("Saved Cams WBR2 entries ...")
-    elif report_no == "WBR9":
-        df = process_zip_file(url, password='123456')
-        column_names = [column.name for column in CamsWBR9.__table__.columns]
-        df = df[column_names]
-        log.info("Saving Cams WBR9 entries ...")
-        save_dataframe_to_db(df = df, model_class=CamsWBR9)
-        log.info("Saved Cams WBR9 entries ...")
-    return df
+    return url, report_no
+
+def karvy_report_link(soup: "BeautifulSoup"):
+    return soup.find('a', string=lambda text: text and "Click Here" in text).get('href')
 
-def process_karvy_data(soup: BeautifulSoup):
-    url = soup.find('a', string=lambda text: text and "Click Here" in text).get('href')
-    df = process_zip_file(url, password='kfin123456')
+def _track_rep_date(batches, seen):
+    # REP_DATE of the report for the ingest ledger, read as the batches stream past
+    for df in batches:
+        if "REP_DATE" in df.columns and df["REP_DATE"].notna().any():
+            rep_date = df["REP_DATE"].max().date()
+            seen["rep_date"] = max(seen.get("rep_date") or rep_date, rep_date)
+        yield df
+
+def find_duplicate_report(zip_file, password, archive_sha256=None):
+    """
+    Hash a downloaded archive and its decrypted DBF report and look them up in the ingest ledger.
+
+    Returns:
+        tuple: (archive SHA-256, DBF SHA-256, ledger entry or None).
+    """
+    import pyzipper
+    archive_sha256 = archive_sha256 or file_sha256(zip_file)
+    duplicate = find_ingested(archive_sha256=archive_sha256)
+    if duplicate is not None:
+        return archive_sha256, duplicate.DBF_SHA256, duplicate
+    with stage_timer("dedupe"), pyzipper.AESZipFile(zip_file, 'r') as z:
+        report_sha256 = dbf_sha256(z, password.encode('utf-8'))
+    zip_file.seek(0)
+    return archive_sha256, report_sha256, find_ingested(dbf_sha256=report_sha256)
+
+def process_cams_data(soup: "BeautifulSoup", zip_file=None, archive_sha256=None):
+    """
+    Download and load the report linked from a CAMS email.
+
+    Reports whose archive or DBF hash is already in the ingest ledger are
+    skipped before parsing. A loaded report is added to the ledger in the same
+    transaction as its rows.
+
+    Args:
+        soup (BeautifulSoup): The parsed email body.
+        zip_file (file, optional): The archive, when it was already downloaded.
+        archive_sha256 (str, optional): The archive hash computed while downloading.
+
+    Returns:
+        dict: The load counts, an empty dict when the report type is not
+        ingested or the report was already loaded, or None when the report
+        could not be loaded.
+    """
+    import pyzipper
+    url, report_no = cams_report_link(soup)
+    model_class = CAMS_REPORTS.get(report_no)
+    if model_class is None:
+        log.warning(f"Skipping unsupported CAMS report {report_no}.")
+        return {}
+
+    password = CAMS_ZIP_PASSWORD
+    downloaded = zip_file is None
+    try:
+        if downloaded:
+            log.info(f"Downloading ZIP file. URL = {url}")
+            result = download(url, verify=False)
+            if not result.ok:
+                return None
+            zip_file, archive_sha256 = result.file, result.sha256
+
+        archive_sha256, report_sha256, duplicate = find_duplicate_report(zip_file, password, archive_sha256)
+        if duplicate is not None:
+            log.info(f"Skipping Cams {report_no}: already loaded at {duplicate.LOADED_AT} (DBF {report_sha256[:12]}).")
+            return {}
+
+        column_names = [column.name for column in model_class.__table__.columns]
+        seen = {}
+        batches = _track_rep_date(process_zip_batches(url, password=password, zip_file=zip_file, columns=column_names), seen)
+
+        def after_merge(session, counts):
+            refresh_touched_summaries(session, model_class, counts)
+            bump_data_versions(session, model_class, counts)
+            record_ingest(session, archive_sha256, report_sha256, report_no, rep_date=seen.get("rep_date"), counts=counts, source_url=url)
+
+        log.info(f"Saving Cams {report_no} entries ...")
+        counts = save_batches_to_db(batches, model_class=model_class, on_merged=after_merge)
+        log.info(f"Saved Cams {report_no} entries ...")
+        return counts
+    except pyzipper.BadZipFile as e:
+        log.error(f"Error extracting ZIP file: {e}")
+    except Exception as e:
+        log.error(f"An unexpected error occurred: {e}")
+    finally:
+        if downloaded and zip_file is not None:
+            zip_file.close()
+
+def process_karvy_data(soup: "BeautifulSoup", zip_file=None):
+    url = karvy_report_link(soup)
+    df = process_zip_file(url, password=KARVY_ZIP_PASSWORD, zip_file=zip_file)
     return df
 
 
-def task():
+@dataclass
+class ReportJob:
+    """
+    A CAMS report as it moves through the ingest pipeline.
+    """
+    uid: int
+    subject: str
+    sender: str
+    url: str
+    report_no: str
+    zip_path: Optional[str] = None
+    csv_path: Optional[str] = None
+    archive_sha256: Optional[str] = None
+    dbf_sha256: Optional[str] = None
+    rows: int = 0
+    rep_date: Optional[date] = None
+
+def stage_report_csv(zip_path, password, columns, csv_path, batch_size=INGEST_BATCH_SIZE):
+    """
+    Parse the DBF report of the archive at `zip_path` into `csv_path`, in the
+    format `bulk_loader.bulk_upsert_csv` loads. Runs in a worker process, one
+    batch of records in memory at a time.
+
+    Returns:
+        tuple: (row count, REP_DATE of the report or None, seconds spent
+        decrypting, seconds spent parsing and writing the CSV).
+    """
+    import pyzipper
+    seen = {}
+    rows = 0
+    readers = []
+
+    def timed(stream):
+        readers.append(TimedReader(stream))
+        return readers[-1]
+
+    start = time.perf_counter()
+    with pyzipper.AESZipFile(zip_path, 'r') as z, open(csv_path, "w", encoding="utf-8", newline="") as csv_file:
+        batches = iter_dbf_batches_from_zip(z, password.encode('utf-8'), batch_size=batch_size, columns=columns, wrap_stream=timed)
+        for df in _track_rep_date(batches, seen):
+            write_csv(df, csv_file, columns)
+            rows += len(df)
+    # Decryption happens as the parser reads the member, so it is the time spent in read
+    decrypt_seconds = sum(reader.seconds for reader in readers)
+    return rows, seen.get("rep_date"), decrypt_seconds, time.perf_counter() - start - decrypt_seconds
+
+def _remove(path):
+    if path and os.path.exists(path):
+        os.remove(path)
+
+def iter_report_jobs(mail, sender_emails, min_uid=None, start_date=None, end_date=None, processed_uids=None, failed_uids=None):
+    """
+    Fetch stage of the ingest pipeline: yield a `ReportJob` for each CAMS email,
+    fetching the message bodies in batches as the pipeline consumes them.
+    """
+    if min_uid:
+        uids = search_emails_imap(mail, sender_emails, min_uid=min_uid)
+    else:
+        uids = search_emails_imap(mail, sender_emails, start_date, end_date)
+    for email_content in iter_emails_imap(mail, uids):
+        from bs4 import BeautifulSoup
+        try:
+            soup = BeautifulSoup(email_content['body'], 'html.parser')
+            url, report_no = cams_report_link(soup)
+        except Exception as e:
+            log.error(f"Error reading the report link of email {email_content['uid']}: {e}")
+            failed_uids.append(email_content['uid'])
+            continue
+        if report_no not in CAMS_REPORTS:
+            log.warning(f"Skipping unsupported CAMS report {report_no}: {email_content['subject']}.")
+            processed_uids.append(email_content['uid'])
+            continue
+        yield ReportJob(email_content['uid'], email_content['subject'], email_content['from'], url, report_no)
+
+def report_load_rank(job):
+    # WBR9 (folios) must be loaded before the WBR2 transactions that reference them
+    return CAMS_LOAD_ORDER.index(job.report_no)
+
+def task(folder="inbox", config=None):
+    """
+    Ingest new CAMS reports through a staged pipeline. IMAP fetch, downloads,
+    DBF parsing (in a process pool) and database loads run concurrently,
+    connected by bounded queues; see `pipeline.PipelineConfig` for sizing.
+    """
+    config = config or PipelineConfig()
     mail = authenticate_imap()
+    uidvalidity, uidnext = select_mailbox(mail, folder)
+    checkpoint = get_checkpoint(EMAIL, folder)
+    min_uid = None
+    if checkpoint and checkpoint.UIDVALIDITY == uidvalidity and checkpoint.LAST_UID is not None:
+        min_uid = checkpoint.LAST_UID + 1
+    elif checkpoint:
+        log.warning(f"UIDVALIDITY of {folder} changed from {checkpoint.UIDVALIDITY} to {uidvalidity}, rescanning the date window.")
+    # The date window is only used until the first checkpoint is written
     end_date = datetime.now() + timedelta(hours=24)
     start_date = end_date - timedelta(hours=48)
+
+    processed_uids, failed_uids = [], []
     sender_emails = ["donotreply@camsonline.com"]#, "distributorcare@kfintech.com"] # TODO: add back this when ready
-    for i, sender_email in enumerate(sender_emails):
-        email_contents = []
-        messages = search_emails_imap(mail, sender_email, start_date, end_date)
-        for msg_id in messages:
-            email_content = get_email_content_imap(mail, msg_id)
-            if email_content:  # Only add non-empty results
-                email_contents.append(email_content)
-        if i == 0: # this sorting is only for cams data
-            sorted_email_contents = sorted(
-                email_contents,
-                key=lambda x: (not bool(re.search(r"wbr9", x["subject"], re.IGNORECASE)), x["subject"])
+    source = iter_report_jobs(mail, sender_emails, min_uid, start_date, end_date, processed_uids, failed_uids)
+
+    with TemporaryDirectory(prefix="ingest-") as work_dir, \
+            ProcessPoolExecutor(max_workers=config.parse_workers, mp_context=multiprocessing.get_context("spawn")) as parsers:
+
+        def download_stage(job):
+            with trace(f"email-{job.uid}"):
+                result = download(job.url, verify=False)
+                if not result.ok:
+                    raise result.error
+                try:
+                    job.archive_sha256, job.dbf_sha256, duplicate = find_duplicate_report(result.file, CAMS_ZIP_PASSWORD, result.sha256)
+                    if duplicate is not None:
+                        log.info(f"Skipping Cams {job.report_no}: already loaded at {duplicate.LOADED_AT} (DBF {job.dbf_sha256[:12]}).")
+                        return None
+                    job.zip_path = os.path.join(work_dir, f"{job.uid}.zip")
+                    with open(job.zip_path, "wb") as target:
+                        shutil.copyfileobj(result.file, target)
+                finally:
+                    result.file.close()
+            return job
+
+        def parse_stage(job):
+            columns = [column.name for column in CAMS_REPORTS[job.report_no].__table__.columns]
+            job.csv_path = os.path.join(work_dir, f"{job.uid}.csv")
+            # Decrypting and parsing run in a worker process, which times them
+            # itself, so waiting for a free worker is not counted
+            with trace(f"email-{job.uid}"):
+                try:
+                    job.rows, job.rep_date, decrypt_seconds, parse_seconds = parsers.submit(
+                        stage_report_csv, job.zip_path, CAMS_ZIP_PASSWORD, columns, job.csv_path
+                    ).result()
+                except Exception:
+                    INGEST_STAGE_ERRORS.inc(stage="parse")
+                    raise
+                finally:
+                    _remove(job.zip_path)
+                record_stage("decrypt", decrypt_seconds, report=job.report_no)
+                record_stage("parse", parse_seconds, report=job.report_no, rows=job.rows)
+            REPORT_ROWS.observe(job.rows, report=job.report_no)
+            return job
+
+        def load_stage(job):
+            model_class = CAMS_REPORTS[job.report_no]
+            columns = [column.name for column in model_class.__table__.columns]
+
+            def after_merge(session, counts):
+                refresh_touched_summaries(session, model_class, counts)
+                bump_data_versions(session, model_class, counts)
+                record_ingest(session, job.archive_sha256, job.dbf_sha256, job.report_no, rep_date=job.rep_date, counts=counts, source_url=job.url)
+
+            log.info(f"Processing email: {job.subject}. Sent: {job.sender}.", extra={"uid": job.uid, "report": job.report_no})
+            start = time.perf_counter()
+            with trace(f"email-{job.uid}"), stage_timer("load", report=job.report_no, rows=job.rows):
+                try:
+                    with open(job.csv_path, encoding="utf-8", newline="") as csv_file:
+                        counts = bulk_upsert_csv(csv_file, columns, model_class, on_merged=after_merge)
+                finally:
+                    _remove(job.csv_path)
+                if counts is None:
+                    raise RuntimeError(f"Loading Cams {job.report_no} from email {job.uid} failed.")
+            for result in ("inserted", "updated", "unchanged", "rejected"):
+                INGEST_ROWS.inc(counts[result], report=job.report_no, result=result)
+            log.info(
+                f"Saved {counts['staged']} records to the {model_class.__tablename__} table: "
+                f"{counts['inserted']} inserted, {counts['updated']} updated, "
+                f"{counts['unchanged']} unchanged, {counts['rejected']} rejected.",
+                extra={"uid": job.uid, "report": job.report_no, "rows": counts["staged"], "duration_ms": round((time.perf_counter() - start) * 1000, 1)},
             )
-        for email_content in sorted_email_contents:
-            log.info(f"Processing email: {email_content['subject']}. Sent: {email_content['from']}.")
-            body = email_content['body']
-            soup = BeautifulSoup(body, 'html.parser')
-            if i == 0:
-                process_cams_data(soup)
-            elif i == 1:
-                process_karvy_data(soup)
-    
+            return job
+
+        stages = [
+            Stage("download", download_stage, workers=config.download_workers),
+            Stage("parse", parse_stage, workers=config.parse_workers),
+            Stage("load", load_stage, workers=config.load_workers, ordered=True),
+        ]
+        stats = run_pipeline(
+            source,
+            stages,
+            rank=report_load_rank,
+            config=config,
+            on_complete=lambda job: processed_uids.append(job.uid),
+            on_error=lambda job, stage, error: failed_uids.append(job.uid),
+        )
+    log.info(format_stats(stats))
+
+    previous_uid = min_uid - 1 if min_uid else None
+    last_uid = processed_watermark(processed_uids, failed_uids, previous_uid, uidnext)
+    if last_uid:
+        advance_checkpoint(EMAIL, folder, uidvalidity=uidvalidity, last_uid=last_uid)
+    if failed_uids:
+        log.warning(f"{len(failed_uids)} emails failed and will be retried on the next run: {sorted(failed_uids)}")
+
     mail.logout()
+    write_textfile()
+    return stats
 
 if __name__ == "__main__":
     task()
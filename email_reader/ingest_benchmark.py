@@ -0,0 +1,245 @@
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from tempfile import TemporaryDirectory
+
+# End-to-end ingest benchmark: synthetic CAMS reports are served over local
+# HTTP and announced by a synthetic mailbox, then imap_email_reader.task loads
+# them into a scratch database that is dropped and recreated on every run.
+#
+#   python ingest_benchmark.py --investors 20000 --transactions 25
+#
+# The project modules connect to the database named by DB_NAME when they are
+# imported, so they are imported after the scratch database name is set.
+
+BENCH_DB_NAME = "spiderman_bench"
+PROTECTED_DB_NAMES = {"spiderman", "postgres"}
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_results")
+RESULTS_FILE = os.path.join(RESULTS_DIR, "ingest.jsonl")
+# Run parameters that must match for two results to be compared
+COMPARED_PARAMETERS = ("investors", "folios", "transactions", "skew", "seed", "wbr2_reports", "download_workers", "parse_workers", "load_workers", "batch_size")
+
+
+def git_revision(path=None):
+    """
+    Short hash of the commit checked out at `path` (default: the working
+    directory), with "+dirty" when tracked files are modified.
+    """
+    try:
+        revision = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=path, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=path, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f"{revision}+dirty" if dirty else revision
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux
+    return round(resource.getrusage(who).ru_maxrss / 1024, 1)
+
+
+def _run_task(messages, pipeline_settings):
+    # Runs in a fresh process, so its peak memory is the ingest's alone
+    import imap_email_reader
+    from pipeline import PipelineConfig
+    from synthetic_reports import SyntheticMailbox
+
+    mailbox = SyntheticMailbox(messages)
+    imap_email_reader.authenticate_imap = lambda: mailbox
+    start = time.perf_counter()
+    stats = imap_email_reader.task(config=PipelineConfig(**pipeline_settings))
+    return {
+        "seconds": time.perf_counter() - start,
+        "stats": stats,
+        "imap_commands": len(mailbox.commands),
+        "peak_rss_mb": {"ingest": peak_rss_mb(), "parse_workers": peak_rss_mb(resource.RUSAGE_CHILDREN)},
+    }
+
+
+def build_reports(work_dir, args):
+    """
+    Generate the synthetic book and write one WBR9 and `args.wbr2_reports`
+    WBR2 archives, plus a KFintech archive the CAMS ingest must skip.
+
+    Returns:
+        tuple: ([(report number, archive name, rows)], timings dict).
+    """
+    import numpy as np
+    from imap_email_reader import CAMS_ZIP_PASSWORD, KARVY_ZIP_PASSWORD
+    from models import CamsWBR2, CamsWBR9
+    from synthetic_reports import synthetic_book, write_dbf, write_report_zip
+
+    timings = {}
+    start = time.perf_counter()
+    wbr9, wbr2 = synthetic_book(args.investors, args.folios, args.transactions, args.skew, args.seed)
+    timings["generate"] = time.perf_counter() - start
+
+    stamp = datetime.now().strftime("%d%m%Y%H%M%S")
+    parts = [("WBR9", CamsWBR9, wbr9, CAMS_ZIP_PASSWORD, f"{stamp}_100000000R9")]
+    for number, rows in enumerate(np.array_split(np.arange(len(wbr2)), args.wbr2_reports)):
+        parts.append(("WBR2", CamsWBR2, wbr2.iloc[rows], CAMS_ZIP_PASSWORD, f"{stamp}_1000000{number + 1:02d}R2"))
+    parts.append(("KARVY", CamsWBR2, wbr2.iloc[:100], KARVY_ZIP_PASSWORD, f"{stamp}_kfintech"))
+
+    reports = []
+    start = time.perf_counter()
+    for report_no, model_class, df, password, name in parts:
+        dbf_path = write_dbf(os.path.join(work_dir, f"{name}.dbf"), df, model_class)
+        write_report_zip(os.path.join(work_dir, f"{name}.zip"), dbf_path, password)
+        os.remove(dbf_path)
+        reports.append((report_no, f"{name}.zip", len(df)))
+    timings["archive"] = time.perf_counter() - start
+    return reports, timings
+
+
+def table_counts():
+    from sqlalchemy import text
+    from db_connection import get_engine
+    with get_engine().connect() as connection:
+        return {
+            table: connection.execute(text(f'SELECT count(*) FROM "{table}"')).scalar()
+            for table in ("CAMS_WBR9", "CAMS_WBR2", "PORTFOLIO_SUMMARY")
+        }
+
+
+def previous_result(record, path=RESULTS_FILE, parameters=COMPARED_PARAMETERS):
+    """
+    The latest result stored in `path` whose `parameters` match those of `record`, or None.
+    """
+    if not os.path.exists(path):
+        return None
+    match = None
+    with open(path) as results:
+        for line in results:
+            if not line.strip():
+                continue
+            previous = json.loads(line)
+            if all(previous["parameters"].get(name) == record["parameters"].get(name) for name in parameters):
+                match = previous
+    return match
+
+
+def save_result(record, path=RESULTS_FILE):
+    """
+    Append `record` to the JSON lines file at `path`.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "a") as results:
+        results.write(json.dumps(record) + "\n")
+
+
+def format_report(record, baseline=None):
+    lines = [
+        f"Ingest benchmark at {record['revision'] or 'unknown revision'}: "
+        f"{record['rows']['expected']} rows in {record['reports']} reports",
+        f"  setup: generate {record['setup_seconds']['generate']:.2f}s, archive {record['setup_seconds']['archive']:.2f}s, "
+        f"schema {record['setup_seconds']['schema']:.2f}s",
+        f"  task: {record['task_seconds']:.2f}s, {record['rows_per_second']:.0f} rows/s, "
+        f"peak RSS {record['peak_rss_mb']['ingest']} MB (parse workers {record['peak_rss_mb']['parse_workers']} MB)",
+    ]
+    for name, stage in record["stages"].items():
+        rate = f", {stage['rows_per_second']:.0f} rows/s busy" if stage.get("rows_per_second") else ""
+        lines.append(f"  {name:<9} {stage['items']} items, {stage['errors']} errors, {stage['seconds']:.2f}s busy{rate}")
+    lines.append(f"  loaded: {record['rows']['loaded']}")
+    if baseline is not None:
+        change = (record["rows_per_second"] / baseline["rows_per_second"] - 1) * 100
+        lines.append(
+            f"  vs {baseline['revision']} ({baseline['timestamp']}): {baseline['rows_per_second']:.0f} rows/s, "
+            f"{baseline['task_seconds']:.2f}s -> {change:+.1f}% rows/s"
+        )
+    return "\n".join(lines)
+
+
+def run(args):
+    from migrations import drop_and_recreate_database, recreate_schema
+    from synthetic_reports import ReportServer, cams_email, karvy_email
+
+    setup_seconds = {}
+    start = time.perf_counter()
+    drop_and_recreate_database()
+    recreate_schema()
+    setup_seconds["schema"] = time.perf_counter() - start
+
+    with TemporaryDirectory(prefix="ingest-benchmark-") as work_dir:
+        reports, timings = build_reports(work_dir, args)
+        setup_seconds.update(timings)
+        with ReportServer(work_dir) as server:
+            messages = []
+            for uid, (report_no, name, _) in enumerate(reports, start=100):
+                raw = karvy_email(server.url(name)) if report_no == "KARVY" else cams_email(report_no, server.url(name))
+                messages.append((uid, raw))
+            pipeline_settings = {
+                name: getattr(args, name) for name in ("download_workers", "parse_workers", "load_workers") if getattr(args, name)
+            }
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                result = executor.submit(_run_task, messages, pipeline_settings).result()
+
+    expected = {"WBR9": 0, "WBR2": 0}
+    for report_no, _, rows in reports:
+        if report_no in expected:
+            expected[report_no] += rows
+    rows = sum(expected.values())
+    stages = {}
+    for name, stage in result["stats"].items():
+        if name == "wall_seconds":
+            continue
+        stages[name] = dict(stage)
+        if name != "source" and stage["seconds"]:
+            stages[name]["rows_per_second"] = rows / stage["seconds"]
+    return {
+        "revision": git_revision(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "parameters": {name: value for name, value in vars(args).items() if name not in ("db_name", "no_save", "results")},
+        "reports": sum(report_no != "KARVY" for report_no, _, _ in reports),
+        "rows": {"expected": rows, "loaded": table_counts()},
+        "setup_seconds": setup_seconds,
+        "task_seconds": result["seconds"],
+        "pipeline_wall_seconds": result["stats"]["wall_seconds"],
+        "rows_per_second": rows / result["seconds"],
+        "stages": stages,
+        "imap_commands": result["imap_commands"],
+        "peak_rss_mb": result["peak_rss_mb"],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark imap_email_reader.task on synthetic CAMS reports.")
+    parser.add_argument("--investors", type=int, default=2000, help="PANs in the synthetic book")
+    parser.add_argument("--folios", type=float, default=3.0, help="Mean folios per PAN")
+    parser.add_argument("--transactions", type=float, default=20.0, help="Mean transactions per folio")
+    parser.add_argument("--skew", type=float, default=0.0, help="Zipf exponent of folios per PAN (0 = even)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--wbr2-reports", type=int, default=2, help="Archives the transactions are split into")
+    parser.add_argument("--download-workers", type=int, help="PIPELINE_DOWNLOAD_WORKERS for the run")
+    parser.add_argument("--parse-workers", type=int, help="PIPELINE_PARSE_WORKERS for the run")
+    parser.add_argument("--load-workers", type=int, help="PIPELINE_LOAD_WORKERS for the run")
+    parser.add_argument("--batch-size", type=int, help="INGEST_BATCH_SIZE for the run")
+    parser.add_argument("--db-name", default=BENCH_DB_NAME, help="Scratch database, dropped and recreated")
+    parser.add_argument("--results", default=RESULTS_FILE, help="JSON lines file the result is appended to")
+    parser.add_argument("--no-save", action="store_true", help="Print the result without storing it")
+    args = parser.parse_args(argv)
+
+    if args.db_name in PROTECTED_DB_NAMES:
+        parser.error(f"{args.db_name} is dropped and recreated by the benchmark; use a scratch database.")
+    os.environ["DB_NAME"] = args.db_name
+    if args.batch_size is not None:
+        os.environ["INGEST_BATCH_SIZE"] = str(args.batch_size)
+
+    record = run(args)
+    baseline = previous_result(record, args.results)
+    print(format_report(record, baseline))
+    if not args.no_save:
+        save_result(record, args.results)
+    expected = record["rows"]["expected"]
+    loaded = record["rows"]["loaded"]["CAMS_WBR9"] + record["rows"]["loaded"]["CAMS_WBR2"]
+    return 0 if loaded == expected else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+import argparse
+import hashlib
+from datetime import datetime
+from sqlalchemy import or_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import SQLAlchemyError
+from db_connection import SessionLocal
+from dbf_reader import find_dbf_member
+from models import IngestLedger
+from setup import log
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def _sha256(stream):
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(HASH_CHUNK_SIZE), b""):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_sha256(file) -> str:
+    """
+    Hash an open binary file from the start and rewind it.
+    """
+    file.seek(0)
+    try:
+        return _sha256(file)
+    finally:
+        file.seek(0)
+
+
+def dbf_sha256(z, pwd) -> str:
+    """
+    Hash the decrypted DBF report of an open AES ZIP archive.
+
+    CAMS re-zips a re-sent report with a fresh AES salt, so the archive hash
+    differs while the DBF hash does not.
+    """
+    with z.open(find_dbf_member(z), pwd=pwd) as stream:
+        return _sha256(stream)
+
+
+def find_ingested(archive_sha256=None, dbf_sha256=None, session_factory=SessionLocal):
+    """
+    Return the ledger entry of a report that was already loaded, matched by
+    either hash, or None when the report is new.
+    """
+    conditions = []
+    if archive_sha256:
+        conditions.append(IngestLedger.ARCHIVE_SHA256 == archive_sha256)
+    if dbf_sha256:
+        conditions.append(IngestLedger.DBF_SHA256 == dbf_sha256)
+    if not conditions:
+        return None
+
+    session = session_factory()
+    try:
+        return session.query(IngestLedger).filter(or_(*conditions)).first()
+    except SQLAlchemyError as e:
+        log.error(f"Error reading the ingest ledger: {e}")
+        return None
+    finally:
+        session.close()
+
+
+def record_ingest(session, archive_sha256, dbf_sha256, report_type, rep_date=None, counts=None, source_url=None):
+    """
+    Add a loaded report to the ledger using `session`, so the entry is committed
+    in the same transaction as the report rows. A report with rejected rows is
+    not recorded, so it is loaded again when CAMS re-sends it.
+
+    Args:
+        session: The session of the load transaction.
+        archive_sha256 (str): SHA-256 of the downloaded archive.
+        dbf_sha256 (str): SHA-256 of the decrypted DBF report.
+        report_type (str): The report number, e.g. "WBR2".
+        rep_date (date, optional): The report date, when the report has one.
+        counts (dict, optional): The load counts of `bulk_loader.bulk_upsert_batches`.
+        source_url (str, optional): Where the archive was downloaded from.
+    """
+    counts = counts or {}
+    if counts.get("rejected"):
+        log.warning(f"Not recording {report_type} report {dbf_sha256[:12]} in the ingest ledger: {counts['rejected']} rows were rejected.")
+        return
+    statement = insert(IngestLedger.__table__).values(
+        ARCHIVE_SHA256=archive_sha256,
+        DBF_SHA256=dbf_sha256,
+        REPORT_TYPE=report_type,
+        REP_DATE=rep_date,
+        ROW_COUNT=counts.get("staged"),
+        INSERTED=counts.get("inserted"),
+        UPDATED=counts.get("updated"),
+        SOURCE_URL=source_url,
+        LOADED_AT=datetime.now(),
+    ).on_conflict_do_nothing(index_elements=["ARCHIVE_SHA256"])
+    session.execute(statement)
+
+
+def list_ingested(report_type=None, since=None, limit=50, session_factory=SessionLocal):
+    """
+    List ledger entries, most recently loaded first.
+
+    Args:
+        report_type (str, optional): Only entries of this report number.
+        since (datetime, optional): Only entries loaded at or after this time.
+        limit (int): Maximum number of entries.
+    """
+    session = session_factory()
+    try:
+        query = session.query(IngestLedger)
+        if report_type:
+            query = query.filter(IngestLedger.REPORT_TYPE == report_type)
+        if since:
+            query = query.filter(IngestLedger.LOADED_AT >= since)
+        return query.order_by(IngestLedger.LOADED_AT.desc()).limit(limit).all()
+    except SQLAlchemyError as e:
+        log.error(f"Error reading the ingest ledger: {e}")
+        return []
+    finally:
+        session.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="List the reports recorded in the ingest ledger.")
+    parser.add_argument("--report-type", help="Only this report number, e.g. WBR2")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="Only reports loaded since this ISO date")
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--hash", help="Look up a single archive or DBF SHA-256")
+    args = parser.parse_args()
+
+    if args.hash:
+        entries = [entry for entry in [find_ingested(args.hash, args.hash)] if entry]
+    else:
+        entries = list_ingested(args.report_type, args.since, args.limit)
+    for entry in entries:
+        print(
+            f"{entry.LOADED_AT:%Y-%m-%d %H:%M:%S}  {entry.REPORT_TYPE:<5} rep_date={entry.REP_DATE} "
+            f"rows={entry.ROW_COUNT} inserted={entry.INSERTED} updated={entry.UPDATED}  "
+            f"archive={entry.ARCHIVE_SHA256[:12]} dbf={entry.DBF_SHA256[:12]}  {entry.SOURCE_URL or ''}"
+        )
+    print(f"{len(entries)} entries.")
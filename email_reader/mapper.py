@@ -34,3 +34,22 @@ COLUMN_MAPPING = {
     'SCH_NAME': 'Scheme Name'
 } 
 
+
+# PORTFOLIO_SUMMARY column -> the calculate_values output it stores
+SUMMARY_COLUMN_MAPPING = {
+    'INVESTED_AMOUNT': 'Invested Amount',
+    'REDEEMED_AMOUNT': 'Redeemed Amount',
+    'REDEEMED_UNITS': 'Redeemed Units',
+    'INVESTMENT_LEFT': 'Investment Left',
+    'UNREAL_GAIN_LOSS': 'Unrealized Gain/Loss',
+    'UNREAL_GAIN_LOSS_PCT': 'Unrealized Gain/Loss Percent',
+    'REAL_GAIN_LOSS': 'Realized Gain/Loss',
+    'REAL_GAIN_LOSS_PCT': 'Realized Gain/Loss Percent',
+    'CURRENT_NAV': 'Current NAV',
+    'ADJUSTED_UNITS': 'Adjusted Units',
+    'ADJUSTED_AMOUNT': 'Adjusted Amount',
+    'ADJUSTED_NAV': 'Adjusted NAV',
+    'SOLD_UNITS': 'Sold Units',
+    'TOTAL_COST': 'Total Cost',
+    'ABS_RETURN_PCT': 'Absolute Return Percent'
+}
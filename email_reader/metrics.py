@@ -0,0 +1,292 @@
+import asyncio
+import contextvars
+import functools
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from setup import log
+
+# "0" turns every metric call into a no-op and empties /metrics
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") != "0"
+# "1" logs a span (name, trace id, duration, attributes) for every email, report and ingest stage
+TRACE_SPANS = os.environ.get("TRACE_SPANS", "0") == "1"
+# File the ingest task writes its metrics to when it finishes, for a textfile collector
+METRICS_TEXTFILE = os.environ.get("METRICS_TEXTFILE")
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+ROWS_BUCKETS = (10, 100, 1000, 10000, 50000, 100000, 500000, 1000000, 5000000)
+ROUND_TRIP_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)] + list(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """
+    A monotonically increasing count per label combination.
+    """
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_number(value)}" for key, value in sorted(self._values.items())]
+
+
+class Histogram:
+    """
+    Observations counted into cumulative `buckets` per label combination,
+    with their sum and count, as Prometheus histograms are exposed.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        lines = []
+        with self._lock:
+            values = sorted((key, [list(entry[0]), entry[1], entry[2]]) for key, entry in self._values.items())
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [le])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_number(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """
+        All metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+INGEST_STAGE_SECONDS = REGISTRY.register(Histogram(
+    "ingest_stage_seconds", "Duration of each ingest step: search, fetch, download, dedupe, decrypt, parse, load.", ["stage"]))
+INGEST_STAGE_ERRORS = REGISTRY.register(Counter(
+    "ingest_stage_errors_total", "Ingest steps that raised or failed.", ["stage"]))
+INGEST_BYTES = REGISTRY.register(Counter(
+    "ingest_bytes_total", "Bytes received from IMAP (fetch) and report servers (download).", ["stage"]))
+REPORT_ROWS = REGISTRY.register(Histogram(
+    "ingest_report_rows", "Rows parsed per report.", ["report"], buckets=ROWS_BUCKETS))
+INGEST_ROWS = REGISTRY.register(Counter(
+    "ingest_rows_total", "Rows loaded, by report and outcome (inserted, updated, unchanged, rejected).", ["report", "result"]))
+DB_ROUND_TRIPS = REGISTRY.register(Histogram(
+    "db_round_trips", "SQL statements sent per repository call or API request.", ["scope"], buckets=ROUND_TRIP_BUCKETS))
+HTTP_REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "http_request_seconds", "API latency until the response headers, by route and status.", ["method", "route", "status"]))
+
+# Statement counter of the repository call or request running in this context
+_round_trips = contextvars.ContextVar("round_trips", default=None)
+# Trace id of the email or report being processed in this context
+_trace_id = contextvars.ContextVar("trace_id", default=None)
+
+
+def _count_statement(*args):
+    counter = _round_trips.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+def instrument_engine(engine):
+    """
+    Count the statements `engine` sends towards the round trips of the
+    current repository call or request. Accepts sync and async engines.
+    """
+    if not METRICS_ENABLED:
+        return
+    from sqlalchemy import event
+    event.listen(getattr(engine, "sync_engine", engine), "before_cursor_execute", _count_statement)
+
+
+@contextmanager
+def count_round_trips(scope):
+    """
+    Observe the number of statements run inside the block as `db_round_trips{scope}`.
+    Nested blocks count towards the outer one too. The block may replace the
+    scope through the yielded dict, e.g. once the route of a request is known.
+    """
+    labels = {"scope": scope}
+    if not METRICS_ENABLED:
+        yield labels
+        return
+    outer = _round_trips.get()
+    counter = [0]
+    token = _round_trips.set(counter)
+    try:
+        yield labels
+    finally:
+        _round_trips.reset(token)
+        if outer is not None:
+            outer[0] += counter[0]
+        DB_ROUND_TRIPS.observe(counter[0], **labels)
+
+
+def track_round_trips(scope):
+    """
+    Decorator form of `count_round_trips` for plain and async functions.
+    """
+    def decorate(function):
+        if asyncio.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with count_round_trips(scope):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with count_round_trips(scope):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+@contextmanager
+def trace(trace_id):
+    """
+    Tag the spans logged inside the block with `trace_id`, e.g. "email-123".
+    """
+    token = _trace_id.set(trace_id)
+    try:
+        yield
+    finally:
+        _trace_id.reset(token)
+
+
+def record_stage(stage, seconds, failed=False, **attributes):
+    """
+    Record one ingest step of `seconds` in `ingest_stage_seconds{stage}`,
+    counting it in `ingest_stage_errors_total` when it `failed`. With
+    TRACE_SPANS it is also logged as a span with `attributes`.
+    """
+    INGEST_STAGE_SECONDS.observe(seconds, stage=stage)
+    if failed:
+        INGEST_STAGE_ERRORS.inc(stage=stage)
+    if TRACE_SPANS:
+        details = " ".join(f"{name}={value}" for name, value in attributes.items())
+        log.info(
+            f"span {stage} trace={_trace_id.get() or '-'} {seconds * 1000:.1f}ms{' failed' if failed else ''} {details}".rstrip(),
+            extra={"trace": _trace_id.get(), "stage": stage, "duration_ms": round(seconds * 1000, 1), "rate_limited": False, **attributes},
+        )
+
+
+@contextmanager
+def stage_timer(stage, **attributes):
+    """
+    `record_stage` for the block, failed when it raises. The block may add
+    span attributes (e.g. rows) to the yielded dict.
+    """
+    if not METRICS_ENABLED and not TRACE_SPANS:
+        yield attributes
+        return
+    start = time.perf_counter()
+    failed = False
+    try:
+        yield attributes
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        record_stage(stage, time.perf_counter() - start, failed, **attributes)
+
+
+class TimedReader:
+    """
+    Wrap a binary stream and add up the seconds spent in `read`, e.g. to tell
+    the decryption of an archive member from the parsing of what it yields.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.seconds = 0.0
+
+    def read(self, size=-1):
+        start = time.perf_counter()
+        try:
+            return self.stream.read(size)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+
+def render():
+    return REGISTRY.render() if METRICS_ENABLED else ""
+
+
+def write_textfile(path=METRICS_TEXTFILE):
+    """
+    Write the metrics of this process to `path`, replacing it atomically, so
+    a batch run can be scraped after it exits. Does nothing without a path.
+    """
+    if not path or not METRICS_ENABLED:
+        return
+    try:
+        with open(f"{path}.tmp", "w") as textfile:
+            textfile.write(render())
+        os.replace(f"{path}.tmp", path)
+    except OSError as e:
+        log.error(f"Error writing metrics to {path}: {e}")
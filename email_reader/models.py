@@ -1,6 +1,6 @@
-from sqlalchemy import BigInteger, Column, ForeignKeyConstraint, Numeric, String, Integer, Float, Date, Boolean, ForeignKey, PrimaryKeyConstraint
+from sqlalchemy import BigInteger, Column, ForeignKeyConstraint, Numeric, String, Integer, Float, Date, DateTime, Boolean, ForeignKey, Index, PrimaryKeyConstraint
 from sqlalchemy.orm import relationship
-from db_connection import Base, engine
+from db_connection import Base
 
 class CamsWBR2(Base):
     __tablename__ = "CAMS_WBR2"
@@ -16,13 +16,14 @@ class CamsWBR2(Base):
     SCHEME_TYP = Column(String, nullable=True)
     REP_DATE = Column(Date, nullable=True)
     USERCODE = Column(String, nullable=True)
-    TRADDATE = Column(Date, nullable=True)
+    # Partition key, so it is part of the primary key and cannot be NULL
+    TRADDATE = Column(Date, nullable=False)
     POSTDATE = Column(Date, nullable=True)
     PURPRICE = Column(Numeric, nullable=True)
     UNITS = Column(Numeric, nullable=True)
     AMOUNT = Column(Numeric, nullable=True)
     STAMP_DUTY = Column(Numeric, nullable=True)
-    TRXNNO = Column(String, nullable=True, primary_key=True, unique=True)
+    TRXNNO = Column(String, nullable=False)
     USRTRXNO = Column(String, nullable=True)
     TRXN_NATUR = Column(String, nullable=True)
     TRXNTYPE = Column(String, nullable=True)
@@ -33,17 +34,27 @@ class CamsWBR2(Base):
     CAMS_WBR9_DATA = relationship(
         "CamsWBR9",
         back_populates="CAMS_WBR2_DATA",
-        lazy="selectin",
+        # Loaded on access only, so loading folios does not load them again through their transactions
+        lazy="select",
         primaryjoin=(
             "and_(CamsWBR9.FOLIOCHK == CamsWBR2.FOLIO_NO, "
             "CamsWBR9.SCH_NAME == CamsWBR2.SCHEME)"
         ),
     )
     __table_args__ = (
+        # Range partitioned by trade date (see migrations.py), so the trade
+        # date is part of every unique key
+        PrimaryKeyConstraint("TRXNNO", "TRADDATE", name="pk_cams_wbr2"),
         ForeignKeyConstraint(
             ["FOLIO_NO", "SCHEME"],  # Composite key in CAMS_WBR2
             ["CAMS_WBR9.FOLIOCHK", "CAMS_WBR9.SCH_NAME"],  # Composite key in CAMS_WBR9
         ),
+        # Transactions of a folio in FIFO order
+        Index("ix_cams_wbr2_folio_scheme_trade", "FOLIO_NO", "SCHEME", TRADDATE.asc().nulls_first(), SEQ_NO.asc().nulls_first()),
+        Index("ix_cams_wbr2_rep_date", "REP_DATE"),
+        # TRXNNO alone is not unique in the database any more; bulk_loader keeps
+        # one row per TRXNNO, replacing a stored row re-sent with another TRADDATE
+        {"postgresql_partition_by": 'RANGE ("TRADDATE")', "info": {"unique_key": ("TRXNNO",)}},
     )
 
 
@@ -66,8 +77,100 @@ class CamsWBR9(Base):
             "and_(CamsWBR9.FOLIOCHK == CamsWBR2.FOLIO_NO, "
             "CamsWBR9.SCH_NAME == CamsWBR2.SCHEME)"
         ),
+        # Trade order, the order FIFO matches purchases in (see summary.FIFO_ORDER)
+        order_by="(CamsWBR2.TRADDATE.asc().nulls_first(), CamsWBR2.SEQ_NO.asc().nulls_first(), CamsWBR2.TRXNNO)",
     )
 
     __table_args__ = (
         PrimaryKeyConstraint("FOLIOCHK", "SCH_NAME", name="pk_foliochk_sch_name"),
+        # PAN lookups and the keyset order of /user_data pages
+        Index("ix_cams_wbr9_pan_no", "PAN_NO", "FOLIOCHK", "SCH_NAME"),
+    )
+
+
+class MailboxCheckpoint(Base):
+    __tablename__ = "MAILBOX_CHECKPOINT"
+
+    MAILBOX = Column(String, nullable=False)
+    FOLDER = Column(String, nullable=False)
+    UIDVALIDITY = Column(BigInteger, nullable=True)
+    LAST_UID = Column(BigInteger, nullable=True)
+    HISTORY_ID = Column(BigInteger, nullable=True)
+    UPDATED_AT = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        PrimaryKeyConstraint("MAILBOX", "FOLDER", name="pk_mailbox_folder"),
+    )
+
+
+class IngestLedger(Base):
+    __tablename__ = "INGEST_LEDGER"
+
+    ARCHIVE_SHA256 = Column(String(64), nullable=False)
+    DBF_SHA256 = Column(String(64), nullable=False, index=True)
+    REPORT_TYPE = Column(String, nullable=False)
+    REP_DATE = Column(Date, nullable=True)
+    ROW_COUNT = Column(BigInteger, nullable=True)
+    INSERTED = Column(BigInteger, nullable=True)
+    UPDATED = Column(BigInteger, nullable=True)
+    SOURCE_URL = Column(String, nullable=True)
+    LOADED_AT = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        PrimaryKeyConstraint("ARCHIVE_SHA256", name="pk_ingest_ledger"),
+    )
+
+
+class PortfolioSummary(Base):
+    __tablename__ = "PORTFOLIO_SUMMARY"
+
+    FOLIOCHK = Column(String, nullable=False)
+    SCH_NAME = Column(String, nullable=False)
+    # numeric like the CAMS amounts they come from; read back as float, as calculate_values_batch returns them
+    INVESTED_AMOUNT = Column(Numeric(asdecimal=False), nullable=True)
+    REDEEMED_AMOUNT = Column(Numeric(asdecimal=False), nullable=True)
+    REDEEMED_UNITS = Column(Numeric(asdecimal=False), nullable=True)
+    INVESTMENT_LEFT = Column(Numeric(asdecimal=False), nullable=True)
+    UNREAL_GAIN_LOSS = Column(Numeric(asdecimal=False), nullable=True)
+    UNREAL_GAIN_LOSS_PCT = Column(Numeric(asdecimal=False), nullable=True)
+    REAL_GAIN_LOSS = Column(Numeric(asdecimal=False), nullable=True)
+    REAL_GAIN_LOSS_PCT = Column(Numeric(asdecimal=False), nullable=True)
+    CURRENT_NAV = Column(Numeric(asdecimal=False), nullable=True)
+    ADJUSTED_UNITS = Column(Numeric(asdecimal=False), nullable=True)
+    ADJUSTED_AMOUNT = Column(Numeric(asdecimal=False), nullable=True)
+    ADJUSTED_NAV = Column(Numeric(asdecimal=False), nullable=True)
+    SOLD_UNITS = Column(Numeric(asdecimal=False), nullable=True)
+    TOTAL_COST = Column(Numeric(asdecimal=False), nullable=True)
+    ABS_RETURN_PCT = Column(Numeric(asdecimal=False), nullable=True)
+    TRXN_COUNT = Column(Integer, nullable=True)
+    UPDATED_AT = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        PrimaryKeyConstraint("FOLIOCHK", "SCH_NAME", name="pk_summary_foliochk_sch_name"),
+        ForeignKeyConstraint(["FOLIOCHK", "SCH_NAME"], ["CAMS_WBR9.FOLIOCHK", "CAMS_WBR9.SCH_NAME"]),
+    )
+
+
+class SchemaMigration(Base):
+    __tablename__ = "SCHEMA_MIGRATIONS"
+
+    VERSION = Column(Integer, nullable=False)
+    NAME = Column(String, nullable=False)
+    APPLIED_AT = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        PrimaryKeyConstraint("VERSION", name="pk_schema_migrations"),
+    )
+
+
+class DataVersion(Base):
+    __tablename__ = "DATA_VERSION"
+
+    # A PAN, or "*" for data that is not PAN specific (the PAN-less /user_data)
+    PAN_NO = Column(String, nullable=False)
+    VERSION = Column(BigInteger, nullable=False)
+    UPDATED_AT = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        PrimaryKeyConstraint("PAN_NO", name="pk_data_version"),
     )
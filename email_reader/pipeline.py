@@ -0,0 +1,238 @@
+import heapq
+import itertools
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+from downloader import DOWNLOAD_WORKERS
+from setup import log
+
+PIPELINE_QUEUE_SIZE = int(os.environ.get("PIPELINE_QUEUE_SIZE", 4))
+PIPELINE_DOWNLOAD_WORKERS = int(os.environ.get("PIPELINE_DOWNLOAD_WORKERS", DOWNLOAD_WORKERS))
+PIPELINE_PARSE_WORKERS = int(os.environ.get("PIPELINE_PARSE_WORKERS", os.cpu_count() or 1))
+PIPELINE_LOAD_WORKERS = int(os.environ.get("PIPELINE_LOAD_WORKERS", 1))
+
+_DONE = object()
+
+
+@dataclass
+class PipelineConfig:
+    """
+    Sizing of the ingest pipeline. `queue_size` bounds every queue between two
+    stages, so a slow stage pauses the ones before it instead of piling up work.
+    """
+    queue_size: int = PIPELINE_QUEUE_SIZE
+    download_workers: int = PIPELINE_DOWNLOAD_WORKERS
+    parse_workers: int = PIPELINE_PARSE_WORKERS
+    load_workers: int = PIPELINE_LOAD_WORKERS
+
+
+@dataclass
+class Stage:
+    """
+    One pipeline stage. `fn` takes an item and returns the item for the next
+    stage, or None to drop it. With `ordered`, an item is only handed to `fn`
+    once every item of a lower rank has left the pipeline.
+    """
+    name: str
+    fn: Callable[[Any], Any]
+    workers: int = 1
+    ordered: bool = False
+
+
+@dataclass
+class _Entry:
+    item: Any
+    rank: int
+
+
+class _Tracker:
+    """
+    Counts the items of each rank that are still in the pipeline.
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._outstanding = Counter()
+        self._source_done = False
+
+    def add(self, rank):
+        with self._condition:
+            self._outstanding[rank] += 1
+
+    def finish(self, rank):
+        with self._condition:
+            self._outstanding[rank] -= 1
+            self._condition.notify_all()
+
+    def source_finished(self):
+        with self._condition:
+            self._source_done = True
+            self._condition.notify_all()
+
+    def is_turn(self, rank):
+        with self._condition:
+            return self._source_done and not any(count for r, count in self._outstanding.items() if r < rank)
+
+    def wait(self, timeout):
+        with self._condition:
+            self._condition.wait(timeout)
+
+
+class _Stats:
+    def __init__(self, stage_names):
+        self._lock = threading.Lock()
+        self.stages = {name: {"items": 0, "errors": 0, "seconds": 0.0} for name in stage_names}
+
+    def record(self, name, seconds, error=False):
+        with self._lock:
+            stats = self.stages[name]
+            stats["items"] += 1
+            stats["errors"] += int(error)
+            stats["seconds"] += seconds
+
+
+def _order_gate(in_queue, out_queue, tracker, poll_seconds=0.05):
+    # Holds items back until every lower-rank item has left the pipeline,
+    # then releases them lowest rank first.
+    pending = []
+    sequence = itertools.count()
+    upstream_done = False
+    while True:
+        while pending and tracker.is_turn(pending[0][0]):
+            out_queue.put(heapq.heappop(pending)[2])
+        if upstream_done:
+            if not pending:
+                out_queue.put(_DONE)
+                return
+            tracker.wait(poll_seconds)
+            continue
+        try:
+            entry = in_queue.get(timeout=poll_seconds)
+        except queue.Empty:
+            continue
+        if entry is _DONE:
+            upstream_done = True
+        else:
+            heapq.heappush(pending, (entry.rank, next(sequence), entry))
+
+
+def run_pipeline(source, stages, rank=None, config: Optional[PipelineConfig] = None, on_complete=None, on_error=None):
+    """
+    Run `source` items through `stages`, each stage in its own worker threads,
+    connected by bounded queues.
+
+    Args:
+        source: Iterable of items; consumed in its own thread.
+        stages (list): The `Stage`s in order.
+        rank (callable, optional): Returns the rank of an item for ordered stages.
+        config (PipelineConfig, optional): Queue size; the stage worker counts are set on the stages.
+        on_complete (callable, optional): Called with each item that left the last
+            stage or was dropped by a stage.
+        on_error (callable, optional): Called with (item, stage name, exception)
+            when a stage raised; the item is dropped.
+
+    Returns:
+        dict: Per-stage item, error and busy-second counts, plus "wall_seconds".
+    """
+    config = config or PipelineConfig()
+    rank = rank or (lambda item: 0)
+    tracker = _Tracker()
+    stats = _Stats(["source"] + [stage.name for stage in stages])
+    callback_lock = threading.Lock()
+    failures = []
+
+    def complete(entry):
+        if on_complete is not None:
+            with callback_lock:
+                on_complete(entry.item)
+        tracker.finish(entry.rank)
+
+    def fail(entry, stage_name, error):
+        log.error(f"Pipeline stage {stage_name} failed: {error}")
+        if on_error is not None:
+            with callback_lock:
+                on_error(entry.item, stage_name, error)
+        tracker.finish(entry.rank)
+
+    queues = [queue.Queue(maxsize=config.queue_size) for _ in range(len(stages) + 1)]
+    threads = []
+
+    def produce():
+        start = time.perf_counter()
+        try:
+            for item in source:
+                entry = _Entry(item, rank(item))
+                tracker.add(entry.rank)
+                stats.record("source", time.perf_counter() - start)
+                queues[0].put(entry)
+                start = time.perf_counter()
+        except Exception as e:
+            log.error(f"Pipeline source failed: {e}")
+            failures.append(e)
+        finally:
+            tracker.source_finished()
+            queues[0].put(_DONE)
+
+    def work(stage, in_queue, out_queue, remaining):
+        while True:
+            entry = in_queue.get()
+            if entry is _DONE:
+                in_queue.put(_DONE)  # let the sibling workers see it too
+                with remaining["lock"]:
+                    remaining["count"] -= 1
+                    if remaining["count"] == 0:
+                        out_queue.put(_DONE)
+                return
+            start = time.perf_counter()
+            try:
+                result = stage.fn(entry.item)
+            except Exception as e:
+                stats.record(stage.name, time.perf_counter() - start, error=True)
+                fail(entry, stage.name, e)
+                continue
+            stats.record(stage.name, time.perf_counter() - start)
+            if result is None:
+                complete(entry)
+            elif out_queue is queues[-1]:
+                complete(_Entry(result, entry.rank))
+            else:
+                out_queue.put(_Entry(result, entry.rank))
+
+    wall_start = time.perf_counter()
+    threads.append(threading.Thread(target=produce, name="pipeline-source", daemon=True))
+    for index, stage in enumerate(stages):
+        in_queue, out_queue = queues[index], queues[index + 1]
+        if stage.ordered:
+            gated = queue.Queue(maxsize=config.queue_size)
+            threads.append(threading.Thread(target=_order_gate, args=(in_queue, gated, tracker), name=f"pipeline-{stage.name}-gate", daemon=True))
+            in_queue = gated
+        remaining = {"lock": threading.Lock(), "count": stage.workers}
+        for number in range(stage.workers):
+            threads.append(threading.Thread(target=work, args=(stage, in_queue, out_queue, remaining), name=f"pipeline-{stage.name}-{number}", daemon=True))
+
+    for thread in threads:
+        thread.start()
+    # The last queue only ever receives the final _DONE
+    queues[-1].get()
+    for thread in threads:
+        thread.join()
+
+    result = dict(stats.stages)
+    result["wall_seconds"] = time.perf_counter() - wall_start
+    if failures:
+        raise failures[0]
+    return result
+
+
+def format_stats(stats):
+    """
+    One log line summarising the per-stage statistics of `run_pipeline`.
+    """
+    stages = ", ".join(
+        f"{name} {values['items']} items/{values['errors']} errors/{values['seconds']:.2f}s busy"
+        for name, values in stats.items() if name != "wall_seconds"
+    )
+    return f"Pipeline finished in {stats['wall_seconds']:.2f}s: {stages}."
@@ -0,0 +1,270 @@
+from operator import attrgetter
+import numpy as np
+
+PURCHASE_TYPES = ('P', 'SI', 'TI', 'DR')
+REDEMPTION_TYPES = ('R', 'SO', 'TO')
+# Units are compared as integers at this scale, so the FIFO break point is
+# found exactly as with Decimal arithmetic
+UNIT_SCALE = 10 ** 6
+OUTPUT_DECIMALS = 6
+# Outputs that need the current value (RUPEE_BAL); NaN when it is NULL
+CURRENT_VALUE_OUTPUTS = ("Unrealized Gain/Loss", "Unrealized Gain/Loss Percent", "Current NAV", "Absolute Return Percent")
+
+
+def _starts_with(values, prefixes):
+    mask = np.zeros(len(values), dtype=bool)
+    for prefix in prefixes:
+        mask |= np.char.startswith(values, prefix)
+    return mask
+
+
+def _as_float(values):
+    if isinstance(values, np.ndarray) and values.dtype.kind == "f":
+        return values
+    # None (NULL) becomes NaN
+    return np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+
+
+def _safe_divide(numerator, denominator):
+    # Zero or NULL (NaN) denominators give 0, as `if units else 0` does for Decimal/None
+    result = np.zeros(len(numerator))
+    np.divide(numerator, denominator, out=result, where=(denominator != 0) & ~np.isnan(denominator))
+    return result
+
+
+def fifo_values(group_codes, trxn_types, amounts, units, navs, current_values, current_units):
+    """
+    Compute the `service.calculate_values` figures for many folio/scheme groups at once.
+
+    The transactions of every group are processed in the order given. Per group,
+    the FIFO loop of `calculate_values` stops at the first transaction where the
+    purchased units seen so far reach the redeemed units, or whose units are
+    NULL. The loop is replaced by per-group cumulative sums, and the stop
+    index is found with a single searchsorted over all groups.
+
+    Args:
+        group_codes (array): Group number (0 .. n_groups - 1) of every transaction.
+        trxn_types (array): TRXNTYPE of every transaction.
+        amounts, units, navs (array): AMOUNT, UNITS and PURPRICE; NaN or None for NULL.
+        current_values (array): RUPEE_BAL of every group.
+        current_units (array): CLOS_BAL of every group.
+
+    Returns:
+        dict: Output name -> float array with one value per group, with the same
+        names as `calculate_values`. Groups without transactions are all zeros.
+    """
+    group_codes = np.asarray(group_codes, dtype=np.int64)
+    current_values = _as_float(current_values)
+    current_units = _as_float(current_units)
+    n_groups = len(current_values)
+
+    order = np.argsort(group_codes, kind="stable")
+    group_codes = group_codes[order]
+    trxn_types = np.asarray(trxn_types, dtype=str)[order]
+    amounts = _as_float(amounts)[order]
+    units = _as_float(units)[order]
+    navs = _as_float(navs)[order]
+    n = len(group_codes)
+
+    sizes = np.bincount(group_codes, minlength=n_groups)
+    ends = np.cumsum(sizes)
+    starts = ends - sizes
+    present = sizes > 0
+    occupied_starts = starts[present]
+
+    def group_sum(values):
+        sums = np.zeros(n_groups, dtype=values.dtype)
+        if n:
+            sums[present] = np.add.reduceat(values, occupied_starts)
+        return sums
+
+    purchase = _starts_with(trxn_types, PURCHASE_TYPES)
+    redemption = _starts_with(trxn_types, REDEMPTION_TYPES)
+    missing_units = np.isnan(units)
+
+    invested_amount = group_sum(np.where(purchase, amounts, 0))
+    redeemed_amount = group_sum(np.where(redemption, amounts, 0))
+    redeemed_units = group_sum(np.where(redemption, units, 0))
+
+    # Purchased units before each transaction (exclusive running sum within the group)
+    scaled_units = np.rint(np.where(missing_units, 0, units) * UNIT_SCALE).astype(np.int64)
+    purchased = np.where(purchase, scaled_units, 0)
+    running = np.cumsum(purchased)
+    group_base = np.repeat(running[occupied_starts] - purchased[occupied_starts], sizes[present])
+    sold_before = running - purchased - group_base
+    redeemed_scaled = np.repeat(group_sum(np.where(redemption, scaled_units, 0)), sizes)
+
+    # First transaction of each group where the FIFO loop stops
+    stops = np.flatnonzero(missing_units | (sold_before >= redeemed_scaled))
+    position = np.searchsorted(stops, starts)
+    candidate = stops[np.minimum(position, len(stops) - 1)] if len(stops) else ends
+    found = (position < len(stops)) & (candidate < ends)
+    stop = np.where(found, candidate, ends)
+
+    before_stop = np.arange(n) < np.repeat(stop, sizes)
+    total_cost = group_sum(np.where(purchase & before_stop, units * navs, 0))
+    sold_units = group_sum(np.where(purchase & before_stop, units, 0))
+
+    # Units bought past the redeemed units are put back at the NAV of the stop transaction
+    at_stop = np.minimum(stop, max(n - 1, 0))
+    overshoot = np.zeros(n_groups, dtype=bool)
+    if n:
+        overshoot = found & ~missing_units[at_stop] & (sold_before[at_stop] > redeemed_scaled[at_stop])
+    adjusted_units = np.where(overshoot, sold_units - redeemed_units, 0)
+    adjusted_nav = np.where(overshoot, navs[at_stop] if n else 0, 0)
+    adjusted_amount = adjusted_units * adjusted_nav
+    total_cost = total_cost - adjusted_amount
+
+    investment_left = invested_amount - total_cost
+    unreal_gain_loss = current_values - investment_left
+    real_gain_loss = redeemed_amount - total_cost
+
+    return {
+        "Invested Amount": invested_amount,
+        "Redeemed Amount": redeemed_amount,
+        "Redeemed Units": redeemed_units,
+        "Investment Left": investment_left,
+        "Unrealized Gain/Loss": unreal_gain_loss,
+        "Unrealized Gain/Loss Percent": _safe_divide(unreal_gain_loss, investment_left) * 100,
+        "Realized Gain/Loss": real_gain_loss,
+        "Realized Gain/Loss Percent": _safe_divide(real_gain_loss, total_cost) * 100,
+        "Current NAV": _safe_divide(current_values, current_units),
+        "Adjusted Units": adjusted_units,
+        "Adjusted Amount": adjusted_amount,
+        "Adjusted NAV": adjusted_nav,
+        "Sold Units": sold_units,
+        "Total Cost": total_cost,
+        "Absolute Return Percent": _safe_divide(current_values, investment_left) * 100,
+    }
+
+
+def _column(records, name):
+    return np.fromiter((np.nan if value is None else value for value in map(attrgetter(name), records)), np.float64, len(records))
+
+
+def calculate_values_batch(holdings):
+    """
+    Run `fifo_values` for a list of (transactions, current value, current units)
+    tuples, where transactions are `CamsWBR2` records in FIFO order.
+
+    Returns:
+        list: One `calculate_values`-style dict per holding.
+    """
+    records = [record for transactions, _, _ in holdings for record in transactions]
+    values = fifo_values(
+        np.repeat(np.arange(len(holdings)), [len(transactions) for transactions, _, _ in holdings]),
+        [record.TRXNTYPE for record in records],
+        _column(records, "AMOUNT"),
+        _column(records, "UNITS"),
+        _column(records, "PURPRICE"),
+        [current_value for _, current_value, _ in holdings],
+        [current_units for _, _, current_units in holdings],
+    )
+    names = list(values)
+    # Rounded so float noise such as 37998.100000000006 does not reach the API
+    columns = (np.round(column, OUTPUT_DECIMALS).tolist() for column in values.values())
+    return [dict(zip(names, row)) for row in zip(*columns)]
+
+
+def _random_holdings(count, seed=0):
+    # Synthetic folios covering the FIFO edge cases: no redemptions, exact
+    # matches, overshoot, redemptions beyond the purchases, NULL units and
+    # NULL current values or units
+    from decimal import Decimal
+    from types import SimpleNamespace
+    rng = np.random.default_rng(seed)
+    types = ['P13S', 'SIAP18S', 'TI', 'DR', 'R1', 'SOEQT', 'TO', 'DIV']
+    holdings = []
+    for _ in range(count):
+        records = []
+        for _ in range(int(rng.integers(1, 12))):
+            units = Decimal(int(rng.integers(1, 100000))) / 1000
+            records.append(SimpleNamespace(
+                TRXNTYPE=str(rng.choice(types)),
+                UNITS=None if rng.random() < 0.02 else units,
+                PURPRICE=Decimal(int(rng.integers(1000, 90000))) / 1000,
+                AMOUNT=Decimal(int(rng.integers(100, 10000000))) / 100,
+            ))
+        if rng.random() < 0.3:
+            # Redeem exactly the first purchase
+            first = next((record for record in records if record.TRXNTYPE.startswith(PURCHASE_TYPES) and record.UNITS is not None), None)
+            if first is not None:
+                records.append(SimpleNamespace(TRXNTYPE='R1', UNITS=first.UNITS, PURPRICE=first.PURPRICE, AMOUNT=first.AMOUNT))
+        if any(record.TRXNTYPE.startswith(REDEMPTION_TYPES) and record.UNITS is None for record in records):
+            # calculate_values cannot sum NULL redemption units
+            continue
+        current_value = None if rng.random() < 0.03 else Decimal(int(rng.integers(0, 10000000))) / 100
+        current_units = None if rng.random() < 0.03 else Decimal(int(rng.integers(0, 100000))) / 1000
+        holdings.append((records, current_value, current_units))
+    return holdings
+
+
+def check_parity(holdings, reference, rel_tol=1e-9, abs_tol=1e-6):
+    """
+    Compare `calculate_values_batch` with the per-folio `reference` function.
+    `reference` cannot subtract from a NULL current value, so for those
+    folios it runs with 0 and the CURRENT_VALUE_OUTPUTS are not compared.
+
+    Returns:
+        list: (holding index, output name, expected, actual) for every mismatch.
+    """
+    import math
+    mismatches = []
+    for i, ((transactions, current_value, current_units), actual) in enumerate(zip(holdings, calculate_values_batch(holdings))):
+        expected = reference(transactions, 0 if current_value is None else current_value, current_units)
+        for name, value in expected.items():
+            if current_value is None and name in CURRENT_VALUE_OUTPUTS:
+                continue
+            if not math.isclose(float(value), actual[name], rel_tol=rel_tol, abs_tol=abs_tol):
+                mismatches.append((i, name, value, actual[name]))
+    return mismatches
+
+
+def _report_parity(name, holdings, reference):
+    mismatches = check_parity(holdings, reference)
+    for mismatch in mismatches[:10]:
+        print("MISMATCH", *mismatch)
+    print(f"{name}: {len(holdings)} folios, {len(mismatches)} mismatches.")
+    return mismatches
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    from service import calculate_values
+
+    parser = argparse.ArgumentParser(description="Check calculate_values_batch against calculate_values and time both.")
+    parser.add_argument("--database", action="store_true", help="Also compare them on the folios stored in the database")
+    args = parser.parse_args()
+
+    # The synthetic check needs no database
+    synthetic = _random_holdings(20000)
+    _report_parity("synthetic", synthetic, calculate_values)
+    if args.database:
+        from models import CamsWBR9
+        from repository import GenericRepository
+        stored = [(x.CAMS_WBR2_DATA, x.RUPEE_BAL, x.CLOS_BAL) for x in GenericRepository().filter(CamsWBR9) if x.CAMS_WBR2_DATA]
+        _report_parity("database", stored, calculate_values)
+
+    start = time.perf_counter()
+    for records, current_value, current_units in synthetic:
+        calculate_values(records, 0 if current_value is None else current_value, current_units)
+    loop_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    calculate_values_batch(synthetic)
+    batch_seconds = time.perf_counter() - start
+    codes = np.repeat(np.arange(len(synthetic)), [len(records) for records, _, _ in synthetic])
+    records = [record for records, _, _ in synthetic for record in records]
+    arrays = [
+        np.array([record.TRXNTYPE for record in records]),
+        *(_as_float([getattr(record, column) for record in records]) for column in ("AMOUNT", "UNITS", "PURPRICE")),
+        _as_float([value for _, value, _ in synthetic]),
+        _as_float([units for _, _, units in synthetic]),
+    ]
+    start = time.perf_counter()
+    fifo_values(codes, *arrays)
+    engine_seconds = time.perf_counter() - start
+    print(
+        f"{len(synthetic)} folios: calculate_values {loop_seconds:.3f}s, calculate_values_batch "
+        f"{batch_seconds:.3f}s, fifo_values on arrays {engine_seconds:.3f}s."
+    )
@@ -0,0 +1,270 @@
+import base64
+import os
+from collections import namedtuple
+from decimal import Decimal
+import orjson
+from sqlalchemy import Numeric, String, any_, bindparam, select, tuple_
+from sqlalchemy.dialects.postgresql import ARRAY
+from async_db import get_async_engine
+from db_connection import get_engine
+from mapper import COLUMN_MAPPING, SUMMARY_COLUMN_MAPPING
+from models import CamsWBR2, CamsWBR9, PortfolioSummary
+
+# Rows fetched per round trip by the server-side cursor of stream_holdings_async
+STREAM_FETCH_ROWS = int(os.environ.get("STREAM_FETCH_ROWS", 2000))
+
+WBR9_COLUMNS = list(CamsWBR9.__table__.columns)
+WBR2_COLUMNS = list(CamsWBR2.__table__.columns)
+SUMMARY_COLUMNS = [PortfolioSummary.__table__.columns[column] for column in SUMMARY_COLUMN_MAPPING]
+
+# Transactions keep attribute access, so portfolio_engine.calculate_values_batch
+# can read them like CamsWBR2 records
+Transaction = namedtuple("Transaction", [column.key for column in WBR2_COLUMNS])
+
+_WBR9_END = len(WBR9_COLUMNS)
+# PORTFOLIO_SUMMARY.FOLIOCHK tells whether the folio has a summary row
+_SUMMARY_START = _WBR9_END + 1
+_WBR2_START = _SUMMARY_START + len(SUMMARY_COLUMNS)
+_TRXNNO = _WBR2_START + [column.key for column in WBR2_COLUMNS].index("TRXNNO")
+_KEY = [column.key for column in WBR9_COLUMNS]
+_FOLIOCHK, _SCH_NAME = _KEY.index("FOLIOCHK"), _KEY.index("SCH_NAME")
+_RUPEE_BAL, _CLOS_BAL = _KEY.index("RUPEE_BAL"), _KEY.index("CLOS_BAL")
+# Pages and streams are ordered on this key
+KEYSET_COLUMNS = ("PAN_NO", "FOLIOCHK", "SCH_NAME")
+_KEYSET = [_KEY.index(column) for column in KEYSET_COLUMNS]
+
+
+class Holding:
+    """
+    One CAMS_WBR9 folio/scheme row with its stored summary (a tuple in
+    SUMMARY_COLUMN_MAPPING order, or None) and its transactions in FIFO order.
+    """
+    __slots__ = ("values", "summary", "transactions")
+
+    def __init__(self, values, summary, transactions):
+        self.values = values
+        self.summary = summary
+        self.transactions = transactions
+
+    @property
+    def current_value(self):
+        return self.values[_RUPEE_BAL]
+
+    @property
+    def current_units(self):
+        return self.values[_CLOS_BAL]
+
+
+def holdings_query(pan_no=None, after=None, limit=None, pan_nos=None):
+    """
+    One query returning every folio/scheme of `pan_no` (all PANs when not given)
+    joined to its summary and its transactions, ordered by PAN, folio, scheme
+    and then trade order.
+
+    Args:
+        pan_no (str, optional): Only the folios of this PAN.
+        after (tuple, optional): Keyset cursor; only folios whose
+            (PAN_NO, FOLIOCHK, SCH_NAME) sorts after it.
+        limit (int, optional): At most this many folios (not rows).
+        pan_nos (list, optional): Only the folios of these PANs, matched with
+            a single `= ANY(array)` parameter.
+    """
+    wbr9, wbr2, summary = CamsWBR9.__table__, CamsWBR2.__table__, PortfolioSummary.__table__
+    holdings = wbr9
+    if after is not None or limit is not None:
+        # Pick the page of folios first, so LIMIT counts folios rather than transactions
+        keys = select(wbr9.c.FOLIOCHK, wbr9.c.SCH_NAME).order_by(*(wbr9.c[column] for column in KEYSET_COLUMNS))
+        if pan_no:
+            keys = keys.where(wbr9.c.PAN_NO == pan_no)
+        if after is not None:
+            keys = keys.where(tuple_(*(wbr9.c[column] for column in KEYSET_COLUMNS)) > tuple_(*after))
+        if limit is not None:
+            keys = keys.limit(limit)
+        keys = keys.subquery("page")
+        holdings = wbr9.join(keys, (keys.c.FOLIOCHK == wbr9.c.FOLIOCHK) & (keys.c.SCH_NAME == wbr9.c.SCH_NAME))
+    query = (
+        select(*WBR9_COLUMNS, summary.c.FOLIOCHK, *SUMMARY_COLUMNS, *WBR2_COLUMNS)
+        .select_from(
+            holdings.outerjoin(summary, (summary.c.FOLIOCHK == wbr9.c.FOLIOCHK) & (summary.c.SCH_NAME == wbr9.c.SCH_NAME))
+            .outerjoin(wbr2, (wbr2.c.FOLIO_NO == wbr9.c.FOLIOCHK) & (wbr2.c.SCHEME == wbr9.c.SCH_NAME))
+        )
+        .order_by(
+            *(wbr9.c[column] for column in KEYSET_COLUMNS),
+            wbr2.c.TRADDATE.asc().nulls_first(), wbr2.c.SEQ_NO.asc().nulls_first(), wbr2.c.TRXNNO,
+        )
+    )
+    if pan_no:
+        query = query.where(wbr9.c.PAN_NO == pan_no)
+    if pan_nos is not None:
+        query = query.where(wbr9.c.PAN_NO == any_(bindparam("pan_nos", list(pan_nos), type_=ARRAY(String))))
+    return query
+
+
+def cash_flow_query(pan_no=None, as_of=None):
+    """
+    Every folio/scheme of `pan_no` (all PANs when not given) with its current
+    value and the trade date, type and amount of each of its transactions up
+    to `as_of` (all when not given); folios without such transactions come
+    back once with NULL transaction columns.
+    """
+    wbr9, wbr2 = CamsWBR9.__table__, CamsWBR2.__table__
+    join = (wbr2.c.FOLIO_NO == wbr9.c.FOLIOCHK) & (wbr2.c.SCHEME == wbr9.c.SCH_NAME)
+    if as_of is not None:
+        join = join & (wbr2.c.TRADDATE <= as_of)
+    query = select(
+        wbr9.c.PAN_NO, wbr9.c.FOLIOCHK, wbr9.c.SCH_NAME, wbr9.c.RUPEE_BAL,
+        wbr2.c.TRADDATE, wbr2.c.TRXNTYPE, wbr2.c.AMOUNT,
+    ).select_from(wbr9.outerjoin(wbr2, join))
+    if pan_no:
+        query = query.where(wbr9.c.PAN_NO == pan_no)
+    return query
+
+
+class _Grouper:
+    # Folds query-ordered rows into Holdings; `add` returns the previous
+    # holding once a row of the next folio arrives
+    def __init__(self):
+        self.holding = None
+        self.key = None
+
+    def add(self, row):
+        completed = None
+        row_key = (row[_FOLIOCHK], row[_SCH_NAME])
+        if row_key != self.key:
+            completed = self.holding
+            self.key = row_key
+            summary = tuple(row[_SUMMARY_START:_WBR2_START]) if row[_WBR9_END] is not None else None
+            self.holding = Holding(tuple(row[:_WBR9_END]), summary, [])
+        if row[_TRXNNO] is not None:
+            self.holding.transactions.append(Transaction._make(row[_WBR2_START:]))
+        return completed
+
+
+def group_holdings(rows):
+    """
+    Fold the rows of `holdings_query` into `Holding`s, one per folio/scheme.
+    Rows must arrive in query order; each holding is yielded once complete.
+    """
+    grouper = _Grouper()
+    for row in rows:
+        completed = grouper.add(row)
+        if completed is not None:
+            yield completed
+    if grouper.holding is not None:
+        yield grouper.holding
+
+
+async def group_holdings_async(rows):
+    """
+    `group_holdings` over an async iterable of rows.
+    """
+    grouper = _Grouper()
+    async for row in rows:
+        completed = grouper.add(row)
+        if completed is not None:
+            yield completed
+    if grouper.holding is not None:
+        yield grouper.holding
+
+
+def holding_key(holding):
+    """
+    The keyset cursor of a holding: its (PAN_NO, FOLIOCHK, SCH_NAME).
+    """
+    return tuple(holding.values[i] for i in _KEYSET)
+
+
+def encode_cursor(key) -> str:
+    return base64.urlsafe_b64encode(orjson.dumps(list(key))).decode()
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """
+    Parse a cursor made by `encode_cursor`; raises ValueError when it is malformed.
+    """
+    try:
+        key = orjson.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, orjson.JSONDecodeError) as e:
+        raise ValueError(f"Invalid cursor: {e}")
+    if not isinstance(key, list) or len(key) != len(KEYSET_COLUMNS) or not all(isinstance(value, str) for value in key):
+        raise ValueError("Invalid cursor.")
+    return tuple(key)
+
+
+def _decimal(value):
+    # Same as FastAPI's jsonable_encoder: whole numbers become int, the rest float
+    if value is None:
+        return None
+    exponent = value.as_tuple().exponent
+    return int(value) if isinstance(exponent, int) and exponent >= 0 else float(value)
+
+
+def compile_serializer(columns):
+    """
+    Build a function turning a row tuple of `columns` into a dict keyed by the
+    COLUMN_MAPPING labels. Labels and converters are worked out once per model
+    instead of once per object. Dates are left to the JSON encoder.
+    """
+    labels = [COLUMN_MAPPING[column.key] for column in columns]
+    numeric = [i for i, column in enumerate(columns) if isinstance(column.type, Numeric)]
+
+    def serialize(values):
+        if numeric:
+            values = list(values)
+            for i in numeric:
+                value = values[i]
+                if isinstance(value, Decimal):
+                    values[i] = _decimal(value)
+        return dict(zip(labels, values))
+
+    return serialize
+
+
+serialize_wbr9 = compile_serializer(WBR9_COLUMNS)
+serialize_wbr2 = compile_serializer(WBR2_COLUMNS)
+SUMMARY_LABELS = list(SUMMARY_COLUMN_MAPPING.values())
+
+
+def read_holdings(pan_no=None, bind=None):
+    """
+    Run `holdings_query` and return the grouped holdings.
+    """
+    with (bind or get_engine()).connect() as connection:
+        return list(group_holdings(connection.execute(holdings_query(pan_no))))
+
+
+async def read_holdings_async(pan_no=None, after=None, limit=None, pan_nos=None, bind=None):
+    """
+    `read_holdings` on the async engine; `after` and `limit` select a page and
+    `pan_nos` several PANs at once (see `holdings_query`).
+    """
+    async with (bind or get_async_engine()).connect() as connection:
+        result = await connection.execute(holdings_query(pan_no, after, limit, pan_nos))
+        return list(group_holdings(result))
+
+
+def read_cash_flows(pan_no=None, as_of=None, bind=None):
+    """
+    Run `cash_flow_query` and return its rows.
+    """
+    with (bind or get_engine()).connect() as connection:
+        return connection.execute(cash_flow_query(pan_no, as_of)).all()
+
+
+async def read_cash_flows_async(pan_no=None, as_of=None, bind=None):
+    """
+    `read_cash_flows` on the async engine.
+    """
+    async with (bind or get_async_engine()).connect() as connection:
+        return (await connection.execute(cash_flow_query(pan_no, as_of))).all()
+
+
+async def stream_holdings_async(pan_no=None, bind=None):
+    """
+    Yield holdings as their rows arrive from a server-side cursor, so only one
+    folio is held in memory at a time.
+    """
+    async with (bind or get_async_engine()).connect() as connection:
+        result = await connection.stream(holdings_query(pan_no).execution_options(yield_per=STREAM_FETCH_ROWS))
+        async for holding in group_holdings_async(result):
+            yield holding
@@ -3,10 +3,12 @@ from datetime import datetime
 from typing import Any
 from sqlalchemy.orm import class_mapper
 from sqlalchemy.exc import SQLAlchemyError
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, select
 from db_connection import SessionLocal
+from async_db import AsyncSessionLocal
 from setup import log
 from mapper import COLUMN_MAPPING
+from metrics import track_round_trips
 class GenericRepository:
     """
     A generic repository class for interacting with SQLAlchemy ORM models.
@@ -15,6 +17,7 @@ class GenericRepository:
     def __init__(self, session_factory=SessionLocal):
         self.Session = session_factory
 
+    @track_round_trips("GenericRepository.add")
     def add(self, model_instance):
         """
         Add a new record to the database.
@@ -34,6 +37,7 @@ class GenericRepository:
         finally:
             session.close()
 
+    @track_round_trips("GenericRepository.add_or_update")
     def add_or_update(self, model_instance):
         """
         Add or update a record in the database.
@@ -53,6 +57,7 @@ class GenericRepository:
         finally:
             session.close()
 
+    @track_round_trips("GenericRepository.get")
     def get(self, model_class, id_):
         """
         Retrieve a record by primary key.
@@ -70,6 +75,7 @@ class GenericRepository:
         finally:
             session.close()
 
+    @track_round_trips("GenericRepository.filter")
     def filter(self, model_class, **filters):
         """
         Retrieve records based on filters.
@@ -92,6 +98,7 @@ class GenericRepository:
         finally:
             session.close()
 
+    @track_round_trips("GenericRepository.delete")
     def delete(self, model_class, id_):
         """
         Delete a record by primary key.
@@ -115,6 +122,80 @@ class GenericRepository:
         finally:
             session.close()
 
+class AsyncGenericRepository:
+    """
+    The async counterpart of GenericRepository, on the asyncpg engine. Every
+    call borrows a pooled connection only while its query runs.
+    """
+    def __init__(self, session_factory=AsyncSessionLocal):
+        self.Session = session_factory
+
+    @track_round_trips("AsyncGenericRepository.add")
+    async def add(self, model_instance):
+        async with self.Session() as session:
+            try:
+                session.add(model_instance)
+                await session.commit()
+                return model_instance
+            except SQLAlchemyError as e:
+                await session.rollback()
+                log.error(f"Error adding record: {e}")
+                return None
+
+    @track_round_trips("AsyncGenericRepository.add_or_update")
+    async def add_or_update(self, model_instance):
+        async with self.Session() as session:
+            try:
+                model_instance = await session.merge(model_instance)
+                await session.commit()
+                return model_instance
+            except SQLAlchemyError as e:
+                await session.rollback()
+                log.error(f"Error adding or updating record: {e}")
+                return None
+
+    @track_round_trips("AsyncGenericRepository.get")
+    async def get(self, model_class, id_):
+        async with self.Session() as session:
+            try:
+                return await session.get(model_class, id_)
+            except SQLAlchemyError as e:
+                log.error(f"Error retrieving record: {e}")
+                return None
+
+    @track_round_trips("AsyncGenericRepository.filter")
+    async def filter(self, model_class, **filters):
+        """
+        Retrieve records based on filters. Relationships configured with
+        lazy="selectin" are loaded before the session closes.
+        """
+        async with self.Session() as session:
+            try:
+                query = select(model_class)
+                for key, value in filters.items():
+                    if value is not None:
+                        query = query.where(getattr(model_class, key) == value)
+                result = await session.execute(query)
+                return result.scalars().all()
+            except SQLAlchemyError as e:
+                log.error(f"Error filtering records: {e}")
+                return []
+
+    @track_round_trips("AsyncGenericRepository.delete")
+    async def delete(self, model_class, id_):
+        async with self.Session() as session:
+            try:
+                record = await session.get(model_class, id_)
+                if record:
+                    await session.delete(record)
+                    await session.commit()
+                    log.info(f"Record with id {id_} deleted successfully.")
+                else:
+                    log.warning(f"Record with id {id_} not found.")
+            except SQLAlchemyError as e:
+                await session.rollback()
+                log.error(f"Error deleting record: {e}")
+
 def _serialize_value(value: Any) -> Any:
     """
     Handles the serialization of individual attribute values.
@@ -1,8 +1,31 @@
-from collections import defaultdict
+import asyncio
+import os
+import re
+from datetime import date
 from typing import List
-from models import CamsWBR2, CamsWBR9
-from repository import GenericRepository, sqlalchemy_to_dict
+from models import CamsWBR2
 from mapper import COLUMN_MAPPING
+import numpy as np
+from portfolio_engine import OUTPUT_DECIMALS, calculate_values_batch
+from read_model import (
+    Holding, SUMMARY_LABELS, holding_key, read_cash_flows, read_cash_flows_async, read_holdings, read_holdings_async,
+    serialize_wbr2, serialize_wbr9, stream_holdings_async,
+)
+from xirr_engine import cash_flows, xirr
+
+# Folios per /user_data page when a page is requested without a limit
+USER_DATA_PAGE_SIZE = int(os.environ.get("USER_DATA_PAGE_SIZE", 500))
+# Format of an Indian PAN, e.g. ABCDE1234F
+PAN_PATTERN = re.compile(r"[A-Z]{5}[0-9]{4}[A-Z]")
+# Key columns of the groups get_xirr can solve for
+XIRR_GROUPS = {
+    "folio": ("PAN_NO", "FOLIOCHK", "SCH_NAME"),
+    "scheme": ("SCH_NAME",),
+    "pan": ("PAN_NO",),
+}
+CASH_FLOW_COLUMNS = ("PAN_NO", "FOLIOCHK", "SCH_NAME")
+# Folios assembled together while streaming
+STREAM_CHUNK_SIZE = int(os.environ.get("STREAM_CHUNK_SIZE", 200))
 
 def calculate_current_nav(current_val, units):
     return current_val / units if units else 0
@@ -79,21 +102,168 @@ def calculate_values(data: List[CamsWBR2], current_val, current_units):
         "Absolute Return Percent": abs_return_percent
     }
 
-def get_user_data(pan_no: str = None):
-    filters = {"PAN_NO": pan_no} if pan_no else {}
-    repository = GenericRepository()
-    cams_wbr9: List[CamsWBR9] = repository.filter(CamsWBR9, **filters)
-    serialised_data = sqlalchemy_to_dict(cams_wbr9)
-
-    for i, x in enumerate(cams_wbr9):
-        cams_wbr2_data = x.CAMS_WBR2_DATA
-        if not cams_wbr2_data:
+def _assemble_user_data(holdings: List[Holding]):
+    serialised_data = []
+    pending = []
+    for holding in holdings:
+        data = serialize_wbr9(holding.values)
+        serialised_data.append(data)
+        if not holding.transactions:
             continue
-        serialised_data[i]["CAMS_WBR2_DATA"] = [sqlalchemy_to_dict(y) for y in cams_wbr2_data]
-        calculated_values = calculate_values(cams_wbr2_data, x.RUPEE_BAL, x.CLOS_BAL)
-        serialised_data[i].update(calculated_values)
+        data["CAMS_WBR2_DATA"] = [serialize_wbr2(transaction) for transaction in holding.transactions]
+        if holding.summary is not None:
+            data.update(zip(SUMMARY_LABELS, holding.summary))
+        else:
+            pending.append((data, (holding.transactions, holding.current_value, holding.current_units)))
+
+    # Folios loaded before the summary table existed are calculated on the fly
+    calculated = calculate_values_batch([holding for _, holding in pending])
+    for (data, _), calculated_values in zip(pending, calculated):
+        data.update(calculated_values)
 
     return serialised_data
 
+def normalize_pan(pan_no):
+    # PANs are stored upper case; callers may send lower case or padded values
+    return pan_no.strip().upper() if isinstance(pan_no, str) else pan_no
+
+def get_user_data(pan_no: str = None):
+    # Folios, their PORTFOLIO_SUMMARY metrics and their transactions in one query
+    return _assemble_user_data(read_holdings(pan_no))
+
+async def get_user_data_async(pan_no: str = None):
+    """
+    `get_user_data` on the async engine, so a request waiting on the database
+    does not hold a worker thread. The folios are assembled in a thread, so a
+    large PAN does not stall the event loop.
+    """
+    if not pan_no:
+        # The whole book is fetched from a server-side cursor, so no single
+        # statement runs into API_STATEMENT_TIMEOUT_MS
+        return [data async for data in iter_user_data_async()]
+    return await asyncio.to_thread(_assemble_user_data, await read_holdings_async(pan_no))
+
+async def get_user_data_page_async(pan_no: str = None, after=None, limit: int = USER_DATA_PAGE_SIZE):
+    """
+    One keyset page of `get_user_data`, ordered by (PAN_NO, FOLIOCHK, SCH_NAME).
+
+    Args:
+        pan_no (str, optional): Only the folios of this PAN.
+        after (tuple, optional): The key returned with the previous page.
+        limit (int): Folios per page.
+
+    Returns:
+        tuple: (page data, key of the last folio or None when this was the last page).
+    """
+    holdings = await read_holdings_async(pan_no, after, limit)
+    next_key = holding_key(holdings[-1]) if len(holdings) == limit else None
+    return await asyncio.to_thread(_assemble_user_data, holdings), next_key
+
+async def iter_user_data_async(pan_no: str = None, chunk_size: int = STREAM_CHUNK_SIZE):
+    """
+    Yield the folios of `get_user_data` one by one from a server-side cursor.
+    Folios are assembled `chunk_size` at a time, so folios without a stored
+    summary are still calculated in batches.
+    """
+    chunk = []
+    async for holding in stream_holdings_async(pan_no):
+        chunk.append(holding)
+        if len(chunk) >= chunk_size:
+            for data in await asyncio.to_thread(_assemble_user_data, chunk):
+                yield data
+            chunk = []
+    for data in await asyncio.to_thread(_assemble_user_data, chunk):
+        yield data
+
+async def get_user_data_batch_async(pan_nos: List[str]):
+    """
+    `get_user_data` for several PANs with a single query. All folios go through
+    the calculation path together. PANs are matched upper case and stripped,
+    as /user_data?pan_no= matches them.
+
+    Returns:
+        tuple: ({PAN: folio list} for the PANs found, {PAN: error message} for the rest).
+    """
+    results = {}
+    errors = {}
+    wanted = []
+    for pan_no in dict.fromkeys(pan_nos):
+        normalized = normalize_pan(pan_no)
+        if not isinstance(normalized, str) or not PAN_PATTERN.fullmatch(normalized):
+            errors[pan_no] = "Invalid PAN."
+        elif normalized not in results:
+            wanted.append(normalized)
+            results[normalized] = []
+    if wanted:
+        for data in await asyncio.to_thread(_assemble_user_data, await read_holdings_async(pan_nos=wanted)):
+            results[data["PAN"]].append(data)
+    for pan_no in wanted:
+        if not results[pan_no]:
+            del results[pan_no]
+            errors[pan_no] = "No folios found."
+    return results, errors
+
+def _xirr_by(rows, group_by, as_of):
+    # rows: (PAN_NO, FOLIOCHK, SCH_NAME, RUPEE_BAL, TRADDATE, TRXNTYPE, AMOUNT) of read_cash_flows
+    key_columns = XIRR_GROUPS[group_by]
+    positions = [CASH_FLOW_COLUMNS.index(column) for column in key_columns]
+    groups = {}
+    holdings = {}
+    transactions = []
+    for row in rows:
+        code = groups.setdefault(tuple(row[i] for i in positions), len(groups))
+        holdings.setdefault((row[1], row[2]), (code, row[3]))
+        if row[4] is not None:
+            transactions.append((code, row[4].toordinal(), row[5], row[6]))
+
+    # The current value of every folio is a final inflow on the valuation date
+    terminal = list(holdings.values())
+    codes = np.array([code for code, *_ in transactions] + [code for code, _ in terminal], dtype=np.int64)
+    flows = np.concatenate([
+        cash_flows([trxn_type for *_, trxn_type, _ in transactions], [amount for *_, amount in transactions]),
+        np.array([value or 0 for _, value in terminal], dtype=np.float64),
+    ])
+    days = np.array([day for _, day, _, _ in transactions] + [as_of.toordinal()] * len(terminal), dtype=np.float64)
+    rates = xirr(codes, flows, days, len(groups))
+
+    labels = [COLUMN_MAPPING[column] for column in key_columns]
+    return [
+        {**dict(zip(labels, key)), "XIRR Percent": None if np.isnan(rate) else round(float(rate) * 100, OUTPUT_DECIMALS)}
+        for key, rate in zip(groups, rates)
+    ]
+
+def _valuation_date(as_of):
+    # RUPEE_BAL is today's value and no historical NAV is stored, so a past
+    # valuation date would pair old flows with today's value
+    today = date.today()
+    if as_of is not None and as_of < today:
+        raise ValueError(f"as_of {as_of} is before today; only current values are stored.")
+    return as_of or today
+
+def get_xirr(pan_no: str = None, group_by: str = "folio", as_of: date = None):
+    """
+    Annualized return (XIRR) of every folio/scheme, scheme or PAN, solved for
+    all of them at once by `xirr_engine.xirr`. Purchases are outflows and
+    redemptions inflows on their trade dates up to `as_of`; the current value
+    (RUPEE_BAL) is the final inflow on `as_of` (default: today).
+
+    Args:
+        pan_no (str, optional): Only the folios of this PAN.
+        group_by (str): "folio", "scheme" or "pan".
+        as_of (date, optional): The valuation date, today or later.
+
+    Raises:
+        ValueError: When `as_of` is before today.
+    """
+    as_of = _valuation_date(as_of)
+    return _xirr_by(read_cash_flows(pan_no, as_of), group_by, as_of)
+
+async def get_xirr_async(pan_no: str = None, group_by: str = "folio", as_of: date = None):
+    """
+    `get_xirr` on the async engine, solving in a thread off the event loop.
+    """
+    as_of = _valuation_date(as_of)
+    return await asyncio.to_thread(_xirr_by, await read_cash_flows_async(pan_no, as_of), group_by, as_of)
+
 if __name__ == '__main__':
     print(get_user_data())
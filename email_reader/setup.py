@@ -1,55 +1,154 @@
 from logging import config
+from logging.handlers import QueueListener, RotatingFileHandler
+import atexit
+import json
 import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
 import warnings
 
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")  # console format: "text" or "json"
+# Rotating log file, written as JSON lines; set LOG_FILE to "" to log to the console only
+LOG_FILE = os.environ.get("LOG_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs.log"))
+LOG_FILE_MAX_BYTES = int(os.environ.get("LOG_FILE_MAX_BYTES", 10 * 1024 * 1024))
+LOG_FILE_BACKUPS = int(os.environ.get("LOG_FILE_BACKUPS", 5))
+# Each logging call site may emit LOG_RATE_LIMIT records below WARNING per LOG_RATE_INTERVAL seconds; 0 disables the limit
+LOG_RATE_LIMIT = int(os.environ.get("LOG_RATE_LIMIT", 20))
+LOG_RATE_INTERVAL = float(os.environ.get("LOG_RATE_INTERVAL", 10))
+
+# Attributes passed through `extra=` that the JSON records carry
+STRUCTURED_FIELDS = ("trace", "stage", "uid", "report", "pan", "rows", "bytes", "duration_ms", "suppressed")
+TEXT_FORMAT = "[%(asctime)s] [%(levelname)s] [%(filename)s:%(lineno)d] %(message)s"
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per record with the time, level, source, message and any
+    STRUCTURED_FIELDS set on the record.
+    """
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "source": f"{record.filename}:{record.lineno}",
+            "message": record.getMessage(),
+        }
+        for name in STRUCTURED_FIELDS:
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        return json.dumps(entry, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Let each call site (file and line) through at most `limit` times per
+    `interval` seconds, so a log line inside a per-row or per-request loop
+    cannot flood the output. The first record after a suppressed stretch
+    carries the number of dropped records as `suppressed`. Warnings and errors,
+    and records logged with `extra={"rate_limited": False}`, always pass.
+    """
+    def __init__(self, limit=LOG_RATE_LIMIT, interval=LOG_RATE_INTERVAL):
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not self.limit or not getattr(record, "rate_limited", True):
+            return True
+        key = (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window else 0
+                self._windows[key] = [now, 1, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+                return True
+            if window[1] < self.limit:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+
+def _log_file_path():
+    # Several processes rotating one file race and lose lines, so child
+    # processes (parse workers, uvicorn workers) write logs.<pid>.log instead
+    if not LOG_FILE or multiprocessing.parent_process() is None:
+        return LOG_FILE
+    root, extension = os.path.splitext(LOG_FILE)
+    return f"{root}.{os.getpid()}{extension}"
+
+
+def _formatter(name):
+    return JsonFormatter() if name == "json" else logging.Formatter(TEXT_FORMAT)
+
+
 def configure_get_log():
+    """
+    Send log records through a queue to a background thread that writes them
+    to the console and the rotating LOG_FILE, so logging never blocks the
+    calling thread on I/O.
+    """
     warnings.filterwarnings("ignore")
 
+    console = logging.StreamHandler()
+    console.setFormatter(_formatter(LOG_FORMAT))
+    handlers = [console]
+    log_file = _log_file_path()
+    if log_file:
+        # delay: a worker that never logs creates no file
+        file = RotatingFileHandler(log_file, maxBytes=LOG_FILE_MAX_BYTES, backupCount=LOG_FILE_BACKUPS, encoding="utf-8", delay=True)
+        file.setFormatter(_formatter("json"))
+        handlers.append(file)
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # Drains the queue before the interpreter exits
+    atexit.register(listener.stop)
+
     config.dictConfig(
         {
             "version": 1,
             "disable_existing_loggers": True,  # Disable existing loggers before applying new configuration
-            "formatters": {
-                "default": {
-                    "format": "[%(asctime)s] [%(levelname)s] [%(filename)s:%(lineno)d] %(message)s"
-                }
+            "filters": {
+                "rate_limit": {"()": RateLimitFilter},
             },
             "handlers": {
-                "file": {
-                    "class": "logging.FileHandler",
-                    "formatter": "default",
-                    "filename": "logs.log",
-                },
-                "console": {
-                    "class": "logging.StreamHandler",
-                    "formatter": "default",
+                "queue": {
+                    "class": "logging.handlers.QueueHandler",
+                    "queue": log_queue,
+                    "filters": ["rate_limit"],
                 },
             },
             "loggers": {
                 "root": {
-                    "level": logging.INFO,
-                    "handlers": ["console"],
+                    "level": LOG_LEVEL,
+                    "handlers": ["queue"],
                     "propagate": False,
                 },
                 "sqlalchemy": {  # Disable SQLAlchemy logs explicitly here
                     "level": logging.ERROR,
-                    "handlers": ["console"],
                 },
                 "sqlalchemy.engine": {  # Disable engine logs explicitly here
                     "level": logging.ERROR,
-                    "handlers": ["console"],
                 },
                 "sqlalchemy.orm": {  # Disable ORM logs explicitly here
                     "level": logging.ERROR,
-                    "handlers": ["console"],
                 },
                 "sqlalchemy.dialects": {  # Disable dialect logs explicitly here
                     "level": logging.ERROR,
-                    "handlers": ["console"],
                 },
                 "psycopg2": {  # Disable psycopg2 logs explicitly here
                     "level": logging.ERROR,
-                    "handlers": ["console"],
                 },
             },
         }
@@ -59,4 +158,3 @@ def configure_get_log():
 
 # Configure logging
 log = configure_get_log()
-
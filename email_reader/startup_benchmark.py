@@ -0,0 +1,127 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+from ingest_benchmark import BENCH_DB_NAME, RESULTS_DIR, git_revision, previous_result, save_result
+
+# Cold-start benchmark: every target runs in a fresh interpreter, as an API
+# worker boot or a cron invocation does, and the median time to import it is
+# reported with the modules it pulled in.
+#
+#   python startup_benchmark.py --repeat 9
+#   python startup_benchmark.py --source-dir /path/to/other/checkout
+#
+# `ingest_no_mail` runs imap_email_reader.task against an empty mailbox, the
+# usual cron run. It connects to --db-name (which must have the schema,
+# e.g. from ingest_benchmark.py) and advances its checkpoint.
+
+RESULTS_FILE = os.path.join(RESULTS_DIR, "startup.jsonl")
+TARGETS = {
+    "cli_help": "import cli; cli.build_parser().format_help()",
+    "models": "import models",
+    "api": "import api",
+    "ingest": "import imap_email_reader",
+    "ingest_no_mail": "import imap_email_reader\nimap_email_reader.authenticate_imap = EmptyMailbox\nimap_email_reader.task()",
+}
+# Mailbox stand-in of ingest_no_mail; synthetic_reports.SyntheticMailbox would load pandas itself
+EMPTY_MAILBOX = """
+class EmptyMailbox:
+    def select(self, folder, readonly=False):
+        return "OK", [b"0"]
+    def response(self, code):
+        return code, [b"1"]
+    def uid(self, command, *args):
+        return "OK", [b""]
+    def logout(self):
+        return "BYE", []
+"""
+# Libraries whose loading the targets should only pay for when they need them
+HEAVY_MODULES = ("pandas", "numpy", "bs4", "pyzipper", "requests", "fastapi", "sqlalchemy", "psycopg2", "asyncpg", "uvicorn")
+COMPARED_PARAMETERS = ("repeat",)
+SNIPPET = """
+import json, sys, time
+{mailbox}
+start = time.perf_counter()
+{statement}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "modules": len(sys.modules), "heavy": [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def measure(statement, source_dir, env):
+    """
+    Run `statement` in a fresh interpreter in `source_dir`.
+
+    Returns:
+        dict: Seconds inside the interpreter, wall seconds of the whole process,
+        the number of loaded modules and which HEAVY_MODULES were loaded.
+    """
+    start = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, "-c", SNIPPET.format(mailbox=EMPTY_MAILBOX, statement=statement, heavy=HEAVY_MODULES)],
+        cwd=source_dir, env=env, capture_output=True, text=True, check=True,
+    ).stdout
+    wall_seconds = time.perf_counter() - start
+    result = json.loads(output.strip().splitlines()[-1])
+    result["wall_seconds"] = wall_seconds
+    return result
+
+
+def run_target(statement, source_dir, env, repeat):
+    runs = [measure(statement, source_dir, env) for _ in range(repeat)]
+    return {
+        "median_ms": round(statistics.median(run["seconds"] for run in runs) * 1000, 1),
+        "min_ms": round(min(run["seconds"] for run in runs) * 1000, 1),
+        "process_median_ms": round(statistics.median(run["wall_seconds"] for run in runs) * 1000, 1),
+        "modules": runs[-1]["modules"],
+        "heavy": runs[-1]["heavy"],
+    }
+
+
+def format_target(name, result, baseline=None):
+    line = (
+        f"  {name:<15} median {result['median_ms']:>7} ms (min {result['min_ms']}, process {result['process_median_ms']}), "
+        f"{result['modules']} modules, loads {', '.join(result['heavy']) or 'none'}"
+    )
+    if baseline is not None:
+        line += f" | vs baseline {baseline['median_ms']} ms ({(result['median_ms'] / baseline['median_ms'] - 1) * 100:+.1f}%)"
+    return line
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the cold-start time of the entry points.")
+    parser.add_argument("--targets", nargs="+", default=list(TARGETS), choices=list(TARGETS))
+    parser.add_argument("--repeat", type=int, default=7, help="Fresh interpreters per target")
+    parser.add_argument("--source-dir", default=os.path.dirname(os.path.abspath(__file__)), help="Checkout whose modules are imported")
+    parser.add_argument("--db-name", default=BENCH_DB_NAME, help="Database of the ingest_no_mail target")
+    parser.add_argument("--results", default=RESULTS_FILE, help="JSON lines file the result is appended to")
+    parser.add_argument("--no-save", action="store_true", help="Print the result without storing it")
+    args = parser.parse_args(argv)
+
+    env = dict(os.environ, DB_NAME=args.db_name, PYTHONDONTWRITEBYTECODE="1")
+    # Write the bytecode once, so no target pays for compiling the project
+    subprocess.run([sys.executable, "-m", "compileall", "-q", args.source_dir], check=True)
+    record = {
+        "revision": git_revision(args.source_dir),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "parameters": {"repeat": args.repeat},
+        "targets": {},
+    }
+    print(f"Startup benchmark at {record['revision'] or 'unknown revision'}, {args.repeat} runs per target:")
+    for name in args.targets:
+        record["targets"][name] = run_target(TARGETS[name], args.source_dir, env, args.repeat)
+
+    baseline = previous_result(record, args.results, COMPARED_PARAMETERS)
+    for name, result in record["targets"].items():
+        print(format_target(name, result, baseline["targets"].get(name) if baseline else None))
+    if not args.no_save:
+        save_result(record, args.results)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,151 @@
+import sys
+from datetime import datetime
+import numpy as np
+from bulk_loader import moved_table_name, staging_table_name
+from db_connection import SessionLocal
+from mapper import SUMMARY_COLUMN_MAPPING
+from models import CamsWBR2, CamsWBR9
+from portfolio_engine import OUTPUT_DECIMALS, fifo_values
+from setup import log
+
+# Folio/scheme key columns of the tables whose loads change the summary
+SUMMARY_KEYS = {
+    CamsWBR2.__tablename__: ("FOLIO_NO", "SCHEME"),
+    CamsWBR9.__tablename__: ("FOLIOCHK", "SCH_NAME"),
+}
+# FIFO matches purchases in trade order
+FIFO_ORDER = ('"TRADDATE" NULLS FIRST', '"SEQ_NO" NULLS FIRST', '"TRXNNO"')
+SUMMARY_COLUMNS = list(SUMMARY_COLUMN_MAPPING)
+
+
+def touched_keys_sql(model_class):
+    """
+    SQL selecting the distinct (folio, scheme) keys staged by the current load
+    of `model_class`, and the keys of the rows it moved away from another folio.
+    """
+    table_name = model_class.__tablename__
+    folio, scheme = SUMMARY_KEYS[table_name]
+    sql = f'SELECT DISTINCT "{folio}" AS folio, "{scheme}" AS scheme FROM {staging_table_name(table_name)}'
+    if model_class.__table__.info.get("unique_key"):
+        sql += f' UNION SELECT "{folio}", "{scheme}" FROM {moved_table_name(table_name)}'
+    return sql
+
+
+def _join_touched(keys_sql, alias, folio, scheme):
+    if not keys_sql:
+        return ""
+    return f'JOIN ({keys_sql}) t ON t.folio = {alias}."{folio}" AND t.scheme = {alias}."{scheme}"'
+
+
+def _refresh(cursor, keys_sql=None):
+    # Recompute the summary rows of the folios selected by `keys_sql` (all when None)
+    from psycopg2.extras import execute_values
+    cursor.execute(f'''
+        SELECT w9."FOLIOCHK", w9."SCH_NAME", w9."RUPEE_BAL"::float8, w9."CLOS_BAL"::float8
+        FROM "CAMS_WBR9" w9 {_join_touched(keys_sql, "w9", "FOLIOCHK", "SCH_NAME")}
+    ''')
+    holdings = cursor.fetchall()
+    cursor.execute(f'''
+        SELECT w2."FOLIO_NO", w2."SCHEME", w2."TRXNTYPE", w2."AMOUNT"::float8, w2."UNITS"::float8, w2."PURPRICE"::float8
+        FROM "CAMS_WBR2" w2 {_join_touched(keys_sql, "w2", "FOLIO_NO", "SCHEME")}
+        ORDER BY {", ".join(f"w2.{column}" for column in FIFO_ORDER)}
+    ''')
+    transactions = cursor.fetchall()
+    if not holdings:
+        return 0
+
+    index = {(folio, scheme): i for i, (folio, scheme, _, _) in enumerate(holdings)}
+    codes = np.fromiter((index[(folio, scheme)] for folio, scheme, *_ in transactions), np.int64, len(transactions))
+    columns = list(zip(*transactions)) if transactions else [()] * 6
+    values = fifo_values(
+        codes,
+        list(columns[2]),
+        np.array(columns[3], dtype=np.float64),
+        np.array(columns[4], dtype=np.float64),
+        np.array(columns[5], dtype=np.float64),
+        np.array([rupee_bal for _, _, rupee_bal, _ in holdings], dtype=np.float64),
+        np.array([clos_bal for _, _, _, clos_bal in holdings], dtype=np.float64),
+    )
+    counts = np.bincount(codes, minlength=len(holdings))
+
+    # Folios without transactions have no summary, as get_user_data never calculated one
+    keys = [(folio, scheme) for folio, scheme, _, _ in holdings]
+    with_transactions = np.flatnonzero(counts)
+    without = [keys[i] for i in np.flatnonzero(counts == 0)]
+    if without:
+        execute_values(cursor, 'DELETE FROM "PORTFOLIO_SUMMARY" WHERE ("FOLIOCHK", "SCH_NAME") IN (VALUES %s)', without)
+
+    now = datetime.now()
+    # Rounded like calculate_values_batch, so stored and calculated folios read the same
+    output = [np.round(values[SUMMARY_COLUMN_MAPPING[column]], OUTPUT_DECIMALS).tolist() for column in SUMMARY_COLUMNS]
+    rows = [
+        (*keys[i], *(column[i] for column in output), int(counts[i]), now)
+        for i in with_transactions
+    ]
+    column_list = ", ".join(f'"{column}"' for column in ["FOLIOCHK", "SCH_NAME", *SUMMARY_COLUMNS, "TRXN_COUNT", "UPDATED_AT"])
+    updates = ", ".join(f'"{column}" = EXCLUDED."{column}"' for column in [*SUMMARY_COLUMNS, "TRXN_COUNT", "UPDATED_AT"])
+    # The engine works in float8; the rounded values are stored as numeric
+    template = f"(%s, %s, {', '.join(['%s::numeric'] * len(SUMMARY_COLUMNS))}, %s, %s)"
+    execute_values(
+        cursor,
+        f'INSERT INTO "PORTFOLIO_SUMMARY" ({column_list}) VALUES %s '
+        f'ON CONFLICT ("FOLIOCHK", "SCH_NAME") DO UPDATE SET {updates}',
+        rows,
+        template=template,
+        page_size=1000,
+    )
+    return len(rows)
+
+
+def refresh_touched_summaries(session, model_class, counts=None):
+    """
+    Recompute the summaries of the folios staged by the current bulk load of
+    `model_class`. Meant for `bulk_loader` `on_merged` callbacks, so the summary
+    is committed together with the report rows.
+
+    Args:
+        session: The session of the load transaction.
+        model_class: The model that was loaded, CamsWBR2 or CamsWBR9.
+        counts (dict, optional): The load counts; nothing is recomputed when no row changed.
+
+    Returns:
+        int: The number of summary rows written.
+    """
+    if counts is not None and not (counts.get("inserted") or counts.get("updated")):
+        return 0
+    cursor = session.connection().connection.cursor()
+    try:
+        refreshed = _refresh(cursor, touched_keys_sql(model_class))
+    finally:
+        cursor.close()
+    log.info(f"Refreshed {refreshed} portfolio summaries touched by the {model_class.__tablename__} load.")
+    return refreshed
+
+
+def rebuild_summaries(session_factory=SessionLocal):
+    """
+    Recompute the summary of every folio, e.g. after creating the table.
+    """
+    session = session_factory()
+    try:
+        cursor = session.connection().connection.cursor()
+        try:
+            refreshed = _refresh(cursor)
+        finally:
+            cursor.close()
+        session.commit()
+        log.info(f"Rebuilt {refreshed} portfolio summaries.")
+        return refreshed
+    except Exception as e:
+        session.rollback()
+        log.error(f"Error rebuilding portfolio summaries: {e}")
+        return None
+    finally:
+        session.close()
+
+
+if __name__ == "__main__":
+    if "--rebuild" in sys.argv:
+        rebuild_summaries()
+    else:
+        print("Usage: python summary.py --rebuild")
@@ -0,0 +1,635 @@
+import base64
+import email.utils
+import json
+import os
+import re
+import struct
+import threading
+from datetime import date
+from email import policy
+from email.message import EmailMessage
+from email.parser import BytesParser
+from functools import partial
+from http.server import BaseHTTPRequestHandler, SimpleHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+import numpy as np
+import pandas as pd
+import pyzipper
+from sqlalchemy import BigInteger, Date, Numeric
+from models import CamsWBR2, CamsWBR9
+
+CAMS_SENDER = "donotreply@camsonline.com"
+KARVY_SENDER = "distributorcare@kfintech.com"
+# Transaction types and how often they occur: mostly purchases and SIP
+# instalments, some redemptions and switches
+TRXN_TYPES = ["P", "SIN", "R", "SO", "SI", "TI", "TO"]
+TRXN_WEIGHTS = [0.45, 0.25, 0.12, 0.06, 0.06, 0.03, 0.03]
+SCHEME_TYPES = ["EQUITY", "DEBT", "HYBRID", "LIQUID", "ELSS"]
+SCHEMES = 400
+AMCS = 40
+BROKERS = 25
+# DBF field (type, size, decimals) of the numeric model columns; strings are sized to their longest value
+NUMERIC_FIELD = ("N", 20, 4)
+INTEGER_FIELD = ("N", 18, 0)
+
+
+def _codes(prefix, count, width, start=0):
+    # Zero-padded codes for the numbers start .. start + count - 1; callers index into them
+    return np.array([f"{prefix}{number:0{width}d}" for number in range(start, start + count)], dtype=object)
+
+
+def _pans(count):
+    # Valid-looking PANs (five letters, four digits, a letter) numbered from 0
+    letters = np.array(list("ABCDEFGHIJKLMNOPQRSTUVWXYZ"))
+    numbers = np.arange(count)
+    head = numbers // 10000
+    prefix = ["".join(letters[(value // 26 ** i) % 26] for i in range(4, -1, -1)) for value in head.tolist()]
+    return np.array([f"{p}{n % 10000:04d}P" for p, n in zip(prefix, numbers.tolist())], dtype=object)
+
+
+def folio_counts(investors, folios_per_investor=3.0, skew=0.0, rng=None):
+    """
+    Folios held by each investor. With `skew` 0 every investor holds about
+    `folios_per_investor`; with a larger skew the holdings follow a Zipf-like
+    curve (investor i gets weight 1 / (i + 1) ** skew), so a few investors hold
+    a large share of the book while keeping the same total.
+    """
+    rng = rng or np.random.default_rng(0)
+    total = max(investors, int(round(investors * folios_per_investor)))
+    if skew <= 0:
+        return rng.multinomial(total - investors, np.full(investors, 1 / investors)) + 1
+    weights = 1.0 / np.arange(1, investors + 1) ** skew
+    return rng.multinomial(total - investors, weights / weights.sum()) + 1
+
+
+def synthetic_book(investors=1000, folios_per_investor=3.0, transactions_per_folio=20.0, skew=0.0, seed=0,
+                   first_trade=date(2015, 1, 1), rep_date=None):
+    """
+    Generate a synthetic book of business as CAMS WBR9 (folios) and WBR2
+    (transactions) DataFrames with the columns of `CamsWBR9` and `CamsWBR2`.
+
+    Every transaction belongs to a generated folio, trade dates and SEQ_NO
+    increase within a folio, and CLOS_BAL/RUPEE_BAL follow from the units
+    bought and sold, so the data loads and computes like a real report.
+
+    Args:
+        investors (int): Number of PANs.
+        folios_per_investor (float): Mean folio/scheme rows per PAN.
+        transactions_per_folio (float): Mean transactions per folio (Poisson, at least 1).
+        skew (float): Zipf exponent of folios per PAN; 0 spreads them evenly.
+        seed (int): Random seed; the same arguments always give the same book.
+        first_trade (date): Earliest trade date.
+        rep_date (date, optional): REP_DATE of the transactions; defaults to today.
+
+    Returns:
+        tuple: (WBR9 DataFrame, WBR2 DataFrame).
+    """
+    rng = np.random.default_rng(seed)
+    rep_date = np.datetime64(rep_date or date.today(), "D")
+    counts = folio_counts(investors, folios_per_investor, skew, rng)
+    n_folios = int(counts.sum())
+    owner = np.repeat(np.arange(investors), counts)
+    pans = _pans(investors)
+    names = _codes("INVESTOR ", investors, 6)
+    scheme = rng.integers(0, SCHEMES, n_folios)
+    scheme_names = _codes("SCHEME ", SCHEMES, 3) + " - GROWTH"
+
+    sizes = np.maximum(rng.poisson(transactions_per_folio, n_folios), 1)
+    n_trades = int(sizes.sum())
+    folio = np.repeat(np.arange(n_folios), sizes)
+    first_day = np.datetime64(first_trade, "D")
+    span = max(int((rep_date - first_day).astype(int)), 1)
+    # Sorting by (folio, day) keeps every folio's trades in date order
+    days = rng.integers(0, span, n_trades)
+    order = np.lexsort((days, folio))
+    days = days[order]
+    trade_dates = first_day + days
+    trxn_type = rng.choice(np.array(TRXN_TYPES, dtype=object), n_trades, p=TRXN_WEIGHTS)
+    nav = np.round(10 + (scheme[folio] % 50) * 4 + days / 365 * 3 + rng.random(n_trades), 4)
+    amount = np.round(rng.lognormal(9, 1, n_trades), 2)
+    outflow = np.isin(trxn_type, ["R", "SO", "TO"])
+    amount = np.where(outflow, np.round(amount / 3, 2), amount)
+    units = np.round(amount / nav, 4)
+    start = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    sequence = np.arange(n_trades) - np.repeat(start, sizes) + 1
+
+    signed_units = np.where(outflow, -units, units)
+    balance = np.maximum(np.bincount(folio, weights=signed_units, minlength=n_folios), 0)
+    last_nav = nav[np.cumsum(sizes) - 1]
+
+    folio_numbers = _codes("", n_folios, 8, start=10000000)
+    wbr9 = pd.DataFrame({
+        "FOLIOCHK": folio_numbers,
+        "PAN_NO": pans[owner],
+        "HOLDING_NA": names[owner],
+        "CLOS_BAL": np.round(balance, 4),
+        "RUPEE_BAL": np.round(balance * last_nav, 2),
+        "EMAIL": (_codes("investor", investors, 6) + "@example.com")[owner],
+        "MOBILE_NO": _codes("9", investors, 9, start=100000000)[owner],
+        "SCH_NAME": scheme_names[scheme],
+    }, columns=[column.name for column in CamsWBR9.__table__.columns])
+
+    scheme_of_trade = scheme[folio]
+    broker = owner[folio] % BROKERS
+    wbr2 = pd.DataFrame({
+        "FOLIO_NO": folio_numbers[folio],
+        "SCHEME": scheme_names[scheme_of_trade],
+        "BROKCODE": _codes("ARN-", BROKERS, 6, start=100000)[broker],
+        "SUBBROK": _codes("SB", BROKERS * 4, 4)[broker * 4 + folio % 4],
+        "PAN": pans[owner[folio]],
+        "INV_NAME": names[owner[folio]],
+        "AMC_CODE": _codes("A", AMCS, 2)[scheme_of_trade % AMCS],
+        "PRODCODE": _codes("P", SCHEMES, 4)[scheme_of_trade],
+        "SCHEME_TYP": np.array(SCHEME_TYPES, dtype=object)[scheme_of_trade % len(SCHEME_TYPES)],
+        "REP_DATE": np.full(n_trades, rep_date),
+        "USERCODE": _codes("U", 100, 3)[folio % 100],
+        "TRADDATE": trade_dates,
+        "POSTDATE": trade_dates + 1,
+        "PURPRICE": nav,
+        "UNITS": units,
+        "AMOUNT": amount,
+        "STAMP_DUTY": np.where(outflow, 0.0, np.round(amount * 0.00005, 2)),
+        "TRXNNO": _codes("", n_trades, 10, start=500000000),
+        "USRTRXNO": _codes("", n_trades, 10, start=700000000),
+        "TRXN_NATUR": np.where(outflow, "Redemption", "Purchase"),
+        "TRXNTYPE": trxn_type,
+        "TRXN_SUFFI": np.full(n_trades, None, dtype=object),
+        "SEQ_NO": sequence,
+        "SIPTRXNNO": np.where(trxn_type == "SIN", _codes("S", n_folios, 8)[folio], None),
+        "SYS_REGN_D": trade_dates,
+    }, columns=[column.name for column in CamsWBR2.__table__.columns])
+    return wbr9, wbr2
+
+
+def _number_bytes(values, size, decimals):
+    # Right-aligned decimal text, written digit by digit for all rows at once
+    values = np.asarray(values, dtype=np.float64)
+    missing = np.isnan(values)
+    remaining = np.round(np.abs(np.where(missing, 0, values)) * 10 ** decimals).astype(np.int64)
+    out = np.full((len(values), size), ord(" "), dtype=np.uint8)
+    length = np.zeros(len(values), dtype=np.int64)
+    first_integer = decimals + 1 if decimals else 0
+    for k in range(size):
+        column = size - 1 - k
+        if decimals and k == decimals:
+            out[:, column] = ord(".")
+            continue
+        write = (k <= first_integer) | (remaining > 0)
+        out[write, column] = ord("0") + remaining[write] % 10
+        length[write] = k + 1
+        remaining //= 10
+    negative = (values < 0) & (length < size)
+    out[negative, size - 1 - length[negative]] = ord("-")
+    out[missing] = ord(" ")
+    return out
+
+
+def _date_bytes(values):
+    days = np.asarray(values, dtype="datetime64[D]")
+    text = np.datetime_as_string(days).astype("S10").view(np.uint8).reshape(len(days), 10)
+    out = text[:, [0, 1, 2, 3, 5, 6, 8, 9]].copy()
+    out[np.isnat(days)] = ord(" ")
+    return out
+
+
+def _text_bytes(values):
+    # Left-aligned text sized to the longest value; only the distinct values are encoded
+    codes, uniques = pd.factorize(pd.Series(values), use_na_sentinel=True)
+    encoded = [str(value).encode("utf-8")[:254] for value in uniques.tolist()]
+    size = max(map(len, encoded), default=1) or 1
+    out = np.array(encoded + [b""], dtype=f"S{size}")[codes].view(np.uint8).reshape(len(codes), size).copy()
+    out[out == 0] = ord(" ")
+    return out
+
+
+def _field(column, values):
+    # (DBF field type, decimals, rows x size bytes) of one model column
+    if isinstance(column.type, BigInteger):
+        return INTEGER_FIELD[0], INTEGER_FIELD[2], _number_bytes(values, *INTEGER_FIELD[1:])
+    if isinstance(column.type, Numeric):
+        return NUMERIC_FIELD[0], NUMERIC_FIELD[2], _number_bytes(values, *NUMERIC_FIELD[1:])
+    if isinstance(column.type, Date):
+        return "D", 0, _date_bytes(values)
+    return "C", 0, _text_bytes(values)
+
+
+def write_dbf(path, df, model_class):
+    """
+    Write `df` as a dBase III file with one field per column of `model_class`,
+    the format `dbf_reader` reads from CAMS archives.
+    """
+    columns = list(model_class.__table__.columns)
+    fields = [_field(column, df[column.name].to_numpy()) for column in columns]
+    record_size = 1 + sum(raw.shape[1] for _, _, raw in fields)
+    header_size = 32 + 32 * len(fields) + 1
+    today = date.today()
+
+    records = np.empty((len(df), record_size), dtype=np.uint8)
+    records[:, 0] = ord(" ")
+    offset = 1
+    for _, _, raw in fields:
+        records[:, offset:offset + raw.shape[1]] = raw
+        offset += raw.shape[1]
+
+    with open(path, "wb") as dbf:
+        dbf.write(struct.pack("<BBBBLHH20x", 3, today.year - 1900, today.month, today.day, len(df), header_size, record_size))
+        for column, (field_type, decimals, raw) in zip(columns, fields):
+            dbf.write(struct.pack("<11sc4xBB14x", column.name.encode("ascii"), field_type.encode("ascii"), raw.shape[1], decimals))
+        dbf.write(b"\r")
+        dbf.write(records.tobytes())
+        dbf.write(b"\x1a")
+    return path
+
+
+def write_report_zip(zip_path, dbf_path, password):
+    """
+    Pack the DBF at `dbf_path` into an AES-encrypted ZIP, as CAMS and KFintech send them.
+    """
+    with pyzipper.AESZipFile(zip_path, "w", compression=pyzipper.ZIP_DEFLATED, encryption=pyzipper.WZ_AES) as z:
+        z.setpassword(password.encode("utf-8"))
+        z.write(dbf_path, arcname=os.path.basename(dbf_path))
+    return zip_path
+
+
+def cams_email(report_no, url, sent=None):
+    """
+    Raw bytes of a CAMS mailback email announcing `report_no` at `url`, laid
+    out the way `imap_email_reader.cams_report_link` reads it.
+    """
+    message = EmailMessage()
+    message["From"] = f"CAMS Mailback <{CAMS_SENDER}>"
+    message["Subject"] = f"CAMS Mailback Report {report_no}"
+    message["Date"] = email.utils.formatdate(sent, localtime=True)
+    message.set_content(f"Your report {report_no} is ready: {url}")
+    message.add_alternative(
+        "<html><body><p>Dear Distributor,</p><table>"
+        f"<tr><td>Request Date</td><td>{date.today():%d-%b-%Y}</td></tr>"
+        f'<tr><td>Download Link</td><td><a href="{url}">Click here to download</a></td></tr>'
+        f"<tr><td>Report No</td><td>{report_no}</td></tr>"
+        "</table></body></html>",
+        subtype="html",
+    )
+    return message.as_bytes()
+
+
+def karvy_email(url, sent=None):
+    """
+    Raw bytes of a KFintech report email with its "Click Here" link.
+    """
+    message = EmailMessage()
+    message["From"] = f"KFintech <{KARVY_SENDER}>"
+    message["Subject"] = "KFintech Transaction Report"
+    message["Date"] = email.utils.formatdate(sent, localtime=True)
+    message.set_content(f"Your report is ready: {url}")
+    message.add_alternative(f'<html><body><p>Your report is ready.</p><a href="{url}">Click Here</a></body></html>', subtype="html")
+    return message.as_bytes()
+
+
+class SyntheticMailbox:
+    """
+    In-process stand-in for the `imaplib.IMAP4_SSL` calls `imap_email_reader`
+    makes (select, response, UID SEARCH, UID FETCH, logout). SEARCH honours the
+    FROM and UID criteria and ignores the date window; every message is
+    treated as new.
+
+    Args:
+        messages (list): (UID, raw message bytes) pairs.
+        uidvalidity (int): UIDVALIDITY reported on select.
+    """
+    def __init__(self, messages, uidvalidity=1):
+        self.messages = dict(messages)
+        self.uidvalidity = uidvalidity
+        self.commands = []
+
+    def select(self, folder="inbox", readonly=False):
+        self.commands.append("SELECT")
+        return "OK", [str(len(self.messages)).encode()]
+
+    def response(self, code):
+        if code == "UIDVALIDITY":
+            return code, [str(self.uidvalidity).encode()]
+        if code == "UIDNEXT":
+            return code, [str(max(self.messages, default=0) + 1).encode()]
+        return code, [None]
+
+    def _search(self, criteria):
+        senders = [sender.lower() for sender in re.findall(r'FROM "([^"]*)"', criteria)]
+        uid_range = re.search(r"UID (\d+):\*", criteria)
+        uids = []
+        for uid, raw in sorted(self.messages.items()):
+            if uid_range and uid < int(uid_range.group(1)):
+                continue
+            sender = email.message_from_bytes(raw).get("From", "").lower()
+            if senders and not any(candidate in sender for candidate in senders):
+                continue
+            uids.append(uid)
+        return uids
+
+    def _headers(self, raw):
+        message = email.message_from_bytes(raw)
+        return "".join(f"{name}: {message[name]}\r\n" for name in ("From", "Subject", "Date") if message[name]).encode() + b"\r\n"
+
+    def uid(self, command, *args):
+        self.commands.append(command)
+        if command == "SEARCH":
+            return "OK", [b" ".join(str(uid).encode() for uid in self._search(args[1]))]
+        if command == "FETCH":
+            uid_set, message_parts = args
+            data = []
+            for number, uid in enumerate(int(uid) for uid in uid_set.split(b",")):
+                raw = self.messages.get(uid)
+                if raw is None:
+                    continue
+                payload = self._headers(raw) if "HEADER.FIELDS" in message_parts else raw
+                data.append((f"{number + 1} (UID {uid} BODY[] {{{len(payload)}}}".encode(), payload))
+                data.append(b")")
+            return "OK", data
+        return "NO", [f"{command} is not supported".encode()]
+
+    def logout(self):
+        self.commands.append("LOGOUT")
+        return "BYE", [b"Logging out"]
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class ReportServer:
+    """
+    Serve the files of `directory` over HTTP on 127.0.0.1 from a background
+    thread. Use as a context manager; `url(name)` is the download link of a file.
+    """
+    def __init__(self, directory, port=0):
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), partial(_QuietHandler, directory=directory))
+        self.thread = threading.Thread(target=self.server.serve_forever, name="report-server", daemon=True)
+
+    def url(self, name):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/{name}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _parse_fields(mask):
+    # Gmail `fields` mask -> {name: sub-mask or None}; "a/b" is short for "a(b)"
+    def parse_list(i):
+        fields = {}
+        while True:
+            i = parse_item(i, fields)
+            if i < len(mask) and mask[i] == ",":
+                i += 1
+                continue
+            return fields, i
+
+    def parse_item(i, fields):
+        name = re.match(r"[^,()/]+", mask[i:]).group(0)
+        i += len(name)
+        sub = None
+        if i < len(mask) and mask[i] == "(":
+            sub, i = parse_list(i + 1)
+            i += 1
+        elif i < len(mask) and mask[i] == "/":
+            sub = {}
+            i = parse_item(i + 1, sub)
+        fields[name.strip()] = sub
+        return i
+
+    return parse_list(0)[0]
+
+
+def _apply_fields(value, fields):
+    if fields is None:
+        return value
+    if isinstance(value, list):
+        return [_apply_fields(item, fields) for item in value]
+    if not isinstance(value, dict):
+        return value
+    return {name: _apply_fields(value[name], sub) for name, sub in fields.items() if name in value}
+
+
+def _gmail_payload(message, part_id, inline_limit, attachments):
+    # One MIME part in the shape of a Gmail `MessagePart`
+    payload = {
+        "partId": part_id,
+        "mimeType": message.get_content_type(),
+        "filename": message.get_filename() or "",
+        "headers": [{"name": name, "value": str(value)} for name, value in message.items()],
+    }
+    if message.is_multipart():
+        payload["body"] = {"size": 0}
+        payload["parts"] = [
+            _gmail_payload(part, f"{part_id}.{i}" if part_id else str(i), inline_limit, attachments)
+            for i, part in enumerate(message.get_payload())
+        ]
+        return payload
+    data = message.get_payload(decode=True) or b""
+    if len(data) > inline_limit:
+        # Gmail leaves large parts out of the message and serves them as attachments
+        attachment_id = f"attachment-{len(attachments)}"
+        attachments[attachment_id] = data
+        payload["body"] = {"attachmentId": attachment_id, "size": len(data)}
+    else:
+        payload["body"] = {"size": len(data), "data": base64.urlsafe_b64encode(data).decode()}
+    return payload
+
+
+class _GmailHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body, content_type="application/json"):
+        if not isinstance(body, bytes):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.gmail.count_request()
+        self._reply(*self.server.gmail.handle("GET", self.path))
+
+    def do_POST(self):
+        self.server.gmail.count_request()
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if urlsplit(self.path).path != "/batch":
+            self._reply(404, {"error": {"code": 404, "message": "Not found"}})
+            return
+        self._reply(*self.server.gmail.handle_batch(self.headers["Content-Type"], body))
+
+
+class FakeGmailServer:
+    """
+    Local stand-in for the Gmail API calls `email_reader_task` makes: the
+    discovery document, users.getProfile, messages.list (with `from:` queries
+    and page tokens), messages.get (honouring `fields` masks),
+    messages.attachments.get, history.list and batch requests. Point
+    GMAIL_DISCOVERY_URL at `discovery_url` to use it. `stats` counts the HTTP
+    requests and API calls it served.
+
+    Args:
+        messages (list): Raw message bytes; each is added to the history in order.
+        page_size (int): Most messages or history records per page.
+        inline_limit (int): Parts larger than this are served as attachments.
+        email_address (str): Address of the mailbox.
+    """
+    def __init__(self, messages, page_size=100, inline_limit=4096, email_address="reports@example.com", port=0):
+        import googleapiclient
+        self.page_size = page_size
+        self.email_address = email_address
+        self.attachments = {}
+        self.messages = {}
+        self.history = []
+        # History before this id has expired; history.list then answers 404
+        self.first_history_id = 1000
+        for raw in messages:
+            self.add_message(raw, inline_limit)
+        self.stats = {"http_requests": 0, "batch_requests": 0, "calls": {}, "fields": []}
+        self._lock = threading.Lock()
+        document_path = os.path.join(os.path.dirname(googleapiclient.__file__), "discovery_cache", "documents", "gmail.v1.json")
+        with open(document_path) as document:
+            self.discovery = json.load(document)
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), _GmailHandler)
+        self.server.gmail = self
+        host, port = self.server.server_address[:2]
+        self.root_url = f"http://{host}:{port}/"
+        self.discovery.update(rootUrl=self.root_url, mtlsRootUrl=self.root_url)
+        self.discovery_url = self.root_url + "discovery/{api}/{apiVersion}"
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-gmail", daemon=True)
+
+    @property
+    def history_id(self):
+        return self.first_history_id + len(self.history)
+
+    def add_message(self, raw, inline_limit=4096):
+        """
+        Add a raw message to the mailbox and its history. Returns its id.
+        """
+        message = BytesParser(policy=policy.default).parsebytes(raw)
+        message_id = f"{len(self.messages) + 1:016x}"
+        self.history.append(message_id)
+        self.messages[message_id] = {
+            "id": message_id,
+            "threadId": message_id,
+            "labelIds": ["INBOX"],
+            "historyId": str(self.history_id),
+            "payload": _gmail_payload(message, "", inline_limit, self.attachments),
+        }
+        return message_id
+
+    def count_request(self):
+        with self._lock:
+            self.stats["http_requests"] += 1
+
+    def _count(self, call, fields=None):
+        with self._lock:
+            self.stats["calls"][call] = self.stats["calls"].get(call, 0) + 1
+            if fields:
+                self.stats["fields"].append(fields)
+
+    def _page(self, items, query):
+        start = int(query.get("pageToken", ["0"])[0])
+        size = min(int(query.get("maxResults", [self.page_size])[0]), self.page_size)
+        next_start = start + size
+        return items[start:next_start], str(next_start) if next_start < len(items) else None
+
+    def handle(self, method, path):
+        """
+        Answer one API call. Returns (HTTP status, JSON-ready body).
+        """
+        url = urlsplit(path)
+        query = parse_qs(url.query)
+        parts = url.path.strip("/").split("/")
+        if parts[:1] == ["discovery"]:
+            return 200, self.discovery
+        if parts[:3] != ["gmail", "v1", "users"] or len(parts) < 5:
+            return 404, {"error": {"code": 404, "message": "Not found"}}
+        resource = parts[4:]
+
+        if resource == ["profile"]:
+            self._count("getProfile")
+            return 200, {"emailAddress": self.email_address, "messagesTotal": len(self.messages), "historyId": str(self.history_id)}
+        if resource == ["messages"]:
+            self._count("messages.list")
+            senders = re.findall(r"from:(\S+)", query.get("q", [""])[0])
+            ids = [
+                message_id for message_id, message in self.messages.items()
+                if not senders or any(sender.lower() in _header(message, "from").lower() for sender in senders)
+            ]
+            page, token = self._page(ids, query)
+            response = {"messages": [{"id": message_id, "threadId": message_id} for message_id in page], "resultSizeEstimate": len(ids)}
+            if token:
+                response["nextPageToken"] = token
+            return 200, response
+        if resource[:1] == ["messages"] and len(resource) == 2:
+            fields = query.get("fields", [None])[0]
+            self._count(f"messages.get:{query.get('format', ['full'])[0]}", fields)
+            message = self.messages.get(resource[1])
+            if message is None:
+                return 404, {"error": {"code": 404, "message": "Requested entity was not found."}}
+            return 200, _apply_fields(message, _parse_fields(fields) if fields else None)
+        if resource[:1] == ["messages"] and resource[2:3] == ["attachments"]:
+            self._count("attachments.get")
+            data = self.attachments.get(resource[3])
+            if data is None:
+                return 404, {"error": {"code": 404, "message": "Requested entity was not found."}}
+            return 200, {"size": len(data), "data": base64.urlsafe_b64encode(data).decode()}
+        if resource == ["history"]:
+            self._count("history.list")
+            start = int(query["startHistoryId"][0])
+            if start < self.first_history_id:
+                return 404, {"error": {"code": 404, "message": "Requested entity was not found."}}
+            added = self.history[start - self.first_history_id:]
+            page, token = self._page(added, query)
+            records = [
+                {"id": self.messages[message_id]["historyId"], "messagesAdded": [{"message": {"id": message_id, "labelIds": ["INBOX"]}}]}
+                for message_id in page
+            ]
+            response = {"history": records, "historyId": str(self.history_id)}
+            if token:
+                response["nextPageToken"] = token
+            return 200, response
+        return 404, {"error": {"code": 404, "message": "Not found"}}
+
+    def handle_batch(self, content_type, body):
+        """
+        Answer a multipart/mixed batch request with one HTTP response part per call.
+        """
+        with self._lock:
+            self.stats["batch_requests"] += 1
+        request = BytesParser(policy=policy.compat32).parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+        boundary = "batch_fake_gmail"
+        chunks = []
+        for part in request.get_payload():
+            content_id = "".join(part["Content-ID"].splitlines())
+            request_line = part.get_payload().split("\n", 1)[0].strip()
+            method, path, _ = request_line.split(" ", 2)
+            status, response = self.handle(method, path)
+            chunks.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id[1:]}\r\n\r\n"
+                f"HTTP/1.1 {status} {'OK' if status == 200 else 'Not Found'}\r\nContent-Type: application/json; charset=UTF-8\r\n\r\n"
+                f"{json.dumps(response)}\r\n"
+            )
+        chunks.append(f"--{boundary}--\r\n")
+        return 200, "".join(chunks).encode(), f"multipart/mixed; boundary={boundary}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _header(message, name):
+    return next((header["value"] for header in message["payload"]["headers"] if header["name"].lower() == name), "")